@@ -0,0 +1,110 @@
+##
+#
+# Broker messages, bytes on air and estimated radio-on time per reading of
+# DataLogger with and without batching
+#
+# The sensor returns LevelSensor shaped readings. Radio time is estimated
+# per MQTT publish from the time to wake the radio out of modem sleep, the
+# frames of the PUBLISH and its TCP ACK, and the airtime of the bytes.
+#
+# Usage: poetry run python bench/bench_batch.py
+#
+##
+
+import os
+import sys
+import time
+from unittest.mock import Mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+sys.modules["machine"] = Mock()
+
+from esp_io import DataLogger, Sensor
+from util import Logger
+
+READINGS = 480
+BATCH_SIZES = [1, 2, 4, 8, 16]
+TOPIC = "dam/level"
+
+# Fixed header and topic of an MQTT PUBLISH, TCP/IP and 802.11 headers
+MQTT_OVERHEAD = 4 + len(TOPIC)
+FRAME_OVERHEAD = 40 + 36
+# Milliseconds to bring the radio out of modem sleep and back, and to send
+# the PUBLISH frame and receive the TCP ACK, plus airtime per byte at an
+# effective 6 Mbit/s
+WAKE_MS = 3.0
+FRAMES_MS = 0.6
+MS_PER_BYTE = 8 / 6000
+
+
+class LevelReadings(Sensor):
+    def __init__(self):
+        super().__init__("USLS01", "LevelSensor")
+        self.n = 0
+
+    def stat(self):
+        self.n += 1
+        level = 800 + self.n % 7
+        return [
+            {"type": "Level", "unit": "mm", "value": level},
+            {"type": "Level", "unit": "%", "value": level * 100 // 1500},
+            {"type": "Level", "unit": "liter", "value": level * 83},
+            {"type": "Samples", "unit": "count", "value": 3},
+            {"type": "Spread", "unit": "mm", "value": 2},
+        ]
+
+
+def run(size):
+    messages = []
+    sender = lambda topic, message: messages.append(message)
+    batch = {"size": size} if size > 1 else None
+    logger = DataLogger(
+        "FB20GY", (25.59, -23.54), sender, "1m", TOPIC, LevelReadings(), batch
+    )
+
+    start = time.perf_counter()
+    for i in range(READINGS):
+        logger.run()
+    logger.stop()
+    cpu = (time.perf_counter() - start) / READINGS * 1e6
+
+    payload = sum(len(m) for m in messages)
+    on_air = payload + len(messages) * (MQTT_OVERHEAD + FRAME_OVERHEAD)
+    radio = len(messages) * (WAKE_MS + FRAMES_MS) + on_air * MS_PER_BYTE
+    return {
+        "messages": len(messages),
+        "bytes": payload / READINGS,
+        "radio": radio / READINGS,
+        "cpu": cpu,
+    }
+
+
+def main():
+    # The logger reports every message
+    Logger.getLogger().info = lambda message: None
+
+    print(
+        "{:<8}{:>10}{:>14}{:>16}{:>14}".format(
+            "batch", "messages", "bytes/reading", "radio ms/read", "cpu us/read"
+        )
+    )
+    base = None
+    for size in BATCH_SIZES:
+        r = run(size)
+        base = base or r
+        print(
+            "{:<8}{:>10}{:>14.0f}{:>11.2f} {:>4}{:>14.0f}".format(
+                size,
+                r["messages"],
+                r["bytes"],
+                r["radio"],
+                "/{:.0f}".format(base["radio"] / r["radio"]),
+                r["cpu"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+##
+#
+# Throughput, latency and memory of the whole web stack: Webserver, the
+# request parser, Http routing and the response writers
+#
+# Every workload is run against an in-process mock socket, which measures
+# the server code alone, and against a real loopback socket. Workloads are
+# the captured requests in test/ and synthetic mixes of static and API
+# requests.
+#
+# Reported per workload and transport:
+#   rps          requests per second
+#   p50/p95/p99  latency in microseconds
+#   alloc/req    mean peak bytes allocated while serving one request (mock)
+#   peak         peak traced memory over the whole run (mock)
+#
+# The results are compared with bench/baseline.json if it exists. Memory
+# metrics that are worse by more than --tolerance percent are regressions
+# and make the script exit with 1. Timings depend on the machine the
+# baseline was measured on, slower ones are only reported. Loopback tail
+# latencies are not compared. --save writes the results as the new baseline.
+#
+# Usage: poetry run python bench/bench_http.py [--save] [--tolerance 25]
+#
+##
+
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "src"))
+sys.path.append(os.path.join(ROOT, "tools"))
+
+import build_manifest
+from uhttp import Http, HTTP_METHOD, HttpResponse, JsonStream, Manifest
+from util import ticks_ms
+from webserver import Webserver
+from test.micro_socket import micro_webserver
+
+BASELINE = os.path.join(ROOT, "bench", "baseline.json")
+CAPTURED = ["request1.txt", "request2.txt", "request3.txt", "request4.txt"]
+STATIC = ["/", "/css/style.css", "/js/scripts.js", "/img/silogo42x136.png"]
+COMPRESSED = ["index.html", "css/style.css", "js/scripts.js"]
+
+ROUNDS = 2000
+LOOPBACK_ROUNDS = 500
+MEMORY_ROUNDS = 200
+
+# Metrics where a higher value is worse
+LOWER_IS_BETTER = ("p50", "p95", "p99", "alloc", "peak")
+
+# Metrics that don't depend on the speed of the machine, only these fail
+GATED = ("alloc", "peak")
+
+# The loopback tail latency depends on the scheduler more than on the server
+NOISY = ("loop", ("p95", "p99"))
+
+
+def get(path, **headers):
+    lines = ["GET {} HTTP/1.1".format(path), "Host: 192.168.4.1"]
+    lines += ["{}: {}".format(k.replace("_", "-"), v) for (k, v) in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def post(path, body):
+    body = json.dumps(body).encode()
+    return (
+        "POST {} HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+        "Content-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+            path, len(body)
+        ).encode()
+        + body
+    )
+
+
+def load_capture(name):
+    """
+    A captured request with CRLF line endings and a Content-Length that
+    matches its body
+    """
+    with open(os.path.join(ROOT, "test", name), "rb") as f:
+        (head, _, body) = f.read().partition(b"\n\n")
+    body = body.strip()
+    lines = [line for line in head.split(b"\n") if line]
+    if body:
+        lines = [l for l in lines if not l.lower().startswith(b"content-length:")]
+        lines.append(b"Content-Length: " + str(len(body)).encode())
+    return b"\r\n".join(lines) + b"\r\n\r\n" + body
+
+
+def workloads():
+    from config import config
+
+    static = [get(path, Accept_Encoding="gzip, deflate") for path in STATIC]
+    api = [get("/config"), post("/config", config)]
+
+    rand = random.Random(1)
+    mixed = [rand.choice(static) for i in range(70)]
+    mixed += [rand.choice(api) for i in range(30)]
+    rand.shuffle(mixed)
+
+    return [
+        ("captured", [load_capture(name) for name in CAPTURED]),
+        ("static", static),
+        ("api", api),
+        ("mixed", mixed),
+    ]
+
+
+def www_root():
+    """
+    A copy of www/ with gzip variants and a manifest, like on a device
+    """
+    root = os.path.join(tempfile.mkdtemp(), "www")
+    shutil.copytree(os.path.join(ROOT, "www"), root)
+    for path in COMPRESSED:
+        path = os.path.join(root, path)
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dest:
+            dest.write(src.read())
+    with open(os.path.join(root, Manifest.FILE), "w") as f:
+        json.dump(build_manifest.build(root), f)
+    return root
+
+
+def create_http(root):
+    from config import config
+
+    http = Http()
+    http.set_www_root(root)
+    http.load_manifest()
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/config",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], JsonStream(config)),
+    )
+    http.register_handler(
+        HTTP_METHOD.POST,
+        "/config",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body={"ok": 1}),
+    )
+    return http
+
+
+class MockConnection:
+    """
+    Client connection that has sent one request and discards the response
+    """
+
+    def __init__(self):
+        self.data = b""
+        self.pos = 0
+        self.sent = 0
+
+    def reset(self, data):
+        self.data = data
+        self.pos = 0
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def write(self, buf):
+        self.sent += len(buf)
+        return len(buf)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class MockPoll:
+    def register(self, obj, mask=None):
+        pass
+
+    def unregister(self, obj):
+        pass
+
+
+def serve_mock(web, conn, data):
+    conn.reset(data)
+    web.clients[conn] = [0, ticks_ms()]
+    web.serve(conn)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarise(latencies, elapsed):
+    latencies.sort()
+    return {
+        "rps": round(len(latencies) / elapsed),
+        "p50": round(percentile(latencies, 50), 1),
+        "p95": round(percentile(latencies, 95), 1),
+        "p99": round(percentile(latencies, 99), 1),
+    }
+
+
+def bench_mock(http, requests):
+    web = Webserver(http, keep_alive=False)
+    web.poller = MockPoll()
+    conn = MockConnection()
+    for data in requests:
+        serve_mock(web, conn, data)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        data = requests[i % len(requests)]
+        t = time.perf_counter()
+        serve_mock(web, conn, data)
+        latencies.append((time.perf_counter() - t) * 1e6)
+    result = summarise(latencies, time.perf_counter() - start)
+
+    # Memory is measured in a separate pass, tracing slows everything down
+    tracemalloc.start()
+    allocated = 0
+    peak = 0
+    for i in range(MEMORY_ROUNDS):
+        data = requests[i % len(requests)]
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        serve_mock(web, conn, data)
+        request_peak = tracemalloc.get_traced_memory()[1]
+        allocated += request_peak - before
+        peak = max(peak, request_peak)
+    tracemalloc.stop()
+
+    result["alloc"] = allocated // MEMORY_ROUNDS
+    result["peak"] = peak
+    web.server.close()
+    return result
+
+
+def read_response(stream):
+    status = stream.readline()
+    length = 0
+    chunked = False
+    line = stream.readline()
+    while line != b"\r\n":
+        name = line.lower()
+        if name.startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+        elif name.startswith(b"transfer-encoding:"):
+            chunked = True
+        line = stream.readline()
+
+    if not chunked:
+        stream.read(length)
+        return status
+    size = int(stream.readline(), 16)
+    while size:
+        stream.read(size + 2)
+        size = int(stream.readline(), 16)
+    stream.readline()
+    return status
+
+
+class LoopbackServer:
+    def __init__(self, http):
+        self.web = micro_webserver(Webserver(http, max_requests=1000000))
+        self.web.start(0, "127.0.0.1")
+        self.port = self.web.server.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.web.handle_client(10)
+        self.web.close()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def bench_loopback(http, requests):
+    server = LoopbackServer(http)
+    sock = None
+    latencies = []
+    try:
+        start = time.perf_counter()
+        for i in range(LOOPBACK_ROUNDS):
+            if sock is None:
+                sock = socket.create_connection(("127.0.0.1", server.port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                stream = sock.makefile("rb")
+            t = time.perf_counter()
+            sock.sendall(requests[i % len(requests)])
+            status = read_response(stream)
+            latencies.append((time.perf_counter() - t) * 1e6)
+            if not status.startswith(b"HTTP/1.1 2") and not status.startswith(
+                b"HTTP/1.1 3"
+            ):
+                # The server closes the connection after an error
+                sock.close()
+                sock = None
+        elapsed = time.perf_counter() - start
+    finally:
+        if sock:
+            sock.close()
+        server.stop()
+    return summarise(latencies, elapsed)
+
+
+def compare(results, baseline, tolerance, gated):
+    """
+    Metrics worse than the baseline by more than tolerance percent, the
+    gated metrics if gated is true and the others if not
+    """
+    regressions = []
+    for (key, result) in results.items():
+        for (metric, value) in result.items():
+            if (metric in GATED) != gated:
+                continue
+            old = baseline.get(key, {}).get(metric)
+            if not old or (key.endswith(NOISY[0]) and metric in NOISY[1]):
+                continue
+            change = (value - old) / old * 100
+            if metric not in LOWER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    "{} {}: {} -> {} ({:+.0f}%)".format(key, metric, old, value, change)
+                )
+    return regressions
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--save", action="store_true", help="save as the baseline")
+    args.add_argument("--tolerance", type=float, default=25, help="percent")
+    args = args.parse_args()
+
+    root = www_root()
+    http = create_http(root)
+    results = {}
+    # The server logs every request that isn't routed
+    quiet = open(os.devnull, "w")
+    print(
+        "{:<20} {:>8} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+            "workload", "rps", "p50 us", "p95 us", "p99 us", "alloc/req", "peak"
+        )
+    )
+    try:
+        for (name, requests) in workloads():
+            for (transport, bench) in [("mock", bench_mock), ("loop", bench_loopback)]:
+                key = "{}/{}".format(name, transport)
+                with contextlib.redirect_stdout(quiet):
+                    result = bench(http, requests)
+                results[key] = result
+                print(
+                    "{:<20} {:>8} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+                        key,
+                        result["rps"],
+                        result["p50"],
+                        result["p95"],
+                        result["p99"],
+                        result.get("alloc", "-"),
+                        result.get("peak", "-"),
+                    )
+                )
+    finally:
+        quiet.close()
+        shutil.rmtree(os.path.dirname(root))
+
+    if args.save:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(os.path.relpath(BASELINE, ROOT)))
+        return 0
+
+    if not os.path.exists(BASELINE):
+        print("No baseline, run with --save to create one")
+        return 0
+
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    slower = compare(results, baseline, args.tolerance, False)
+    if slower:
+        print("Slower than the baseline, depends on the machine so not failed:")
+        for line in slower:
+            print("  " + line)
+    regressions = compare(results, baseline, args.tolerance, True)
+    if regressions:
+        print("Regressions against the baseline:")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+##
+#
+# Page load time of the config page with and without keep-alive
+#
+# By default the Webserver is run in-process on the loopback interface and
+# serves the un-minified files in www/. Pass the IP of a node in config mode
+# to measure a real device instead.
+#
+# Usage: poetry run python bench/bench_keepalive.py [ip] [port]
+#
+##
+
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import Http, HTTP_METHOD, HttpResponse
+from webserver import Webserver
+from test.micro_socket import micro_webserver
+
+LOCAL_PAGE = [
+    "/",
+    "/css/style.css",
+    "/js/scripts.js",
+    "/img/silogo42x136.png",
+    "/config",
+]
+DEVICE_PAGE = [
+    "/",
+    "/css/style.min.css",
+    "/js/scripts.min.js",
+    "/img/silogo42x136.png",
+    "/config",
+]
+ROUNDS = 50
+
+
+def read_response(stream):
+    stream.readline()
+    length = 0
+    line = stream.readline()
+    while line != b"\r\n":
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+        line = stream.readline()
+    return stream.read(length)
+
+
+def request(host, path, keep_alive):
+    return "GET {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n\r\n".format(
+        path, host, "keep-alive" if keep_alive else "close"
+    ).encode()
+
+
+def load_page(host, port, page, keep_alive):
+    sock = None
+    for path in page:
+        if sock is None:
+            sock = socket.create_connection((host, port))
+            stream = sock.makefile("rb")
+        sock.sendall(request(host, path, keep_alive))
+        read_response(stream)
+        if not keep_alive:
+            sock.close()
+            sock = None
+    if sock:
+        sock.close()
+
+
+def measure(host, port, page, keep_alive, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        load_page(host, port, page, keep_alive)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def local_server():
+    http = Http()
+    http.set_www_root(os.path.join(ROOT, "www"))
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/config",
+        lambda req: HttpResponse.ok(
+            200, Http.MIME_TYPE["JSON"], body={"networks": ["SenceIt"]}
+        ),
+    )
+    web = micro_webserver(Webserver(http))
+    web.start(0, "127.0.0.1")
+
+    def run():
+        while True:
+            web.handle_client(10)
+
+    threading.Thread(target=run, daemon=True).start()
+    return ("127.0.0.1", web.server.getsockname()[1])
+
+
+def main():
+    if len(sys.argv) > 1:
+        host = sys.argv[1]
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+        (page, rounds) = (DEVICE_PAGE, 5)
+    else:
+        (host, port) = local_server()
+        (page, rounds) = (LOCAL_PAGE, ROUNDS)
+
+    closed = measure(host, port, page, False, rounds)
+    kept = measure(host, port, page, True, rounds)
+    print("Page load ({} requests)".format(len(page)))
+    print("  Connection: close      {:8.2f} ms".format(closed))
+    print("  Connection: keep-alive {:8.2f} ms".format(kept))
+
+
+if __name__ == "__main__":
+    main()
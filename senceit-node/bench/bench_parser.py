@@ -0,0 +1,78 @@
+##
+#
+# Compares the line based RequestStreamParser with the bytes level
+# RequestBufferParser on the captured requests in test/
+#
+# Usage: poetry run python bench/bench_parser.py
+#
+##
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import RequestStreamParser, RequestBufferParser
+
+REQUESTS = ["request1.txt", "request2.txt", "request4.txt"]
+ROUNDS = 2000
+
+
+def parse_lines(stream):
+    parser = RequestStreamParser("\n")
+    status = parser.update(str(stream.readline(), "utf-8"))
+    while status:
+        status = parser.update(str(stream.readline(), "utf-8"))
+    return parser.get_request()
+
+
+def parse_buffer(parser):
+    def parse(stream):
+        parser.clear()
+        return parser.parse(stream)
+
+    return parse
+
+
+def measure(parse, data):
+    # Peak memory of a single request, after a warm up run
+    parse(io.BytesIO(data))
+    stream = io.BytesIO(data)
+    tracemalloc.start()
+    parse(stream)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        parse(io.BytesIO(data))
+    elapsed = time.perf_counter() - start
+
+    return peak, elapsed / ROUNDS * 1e6
+
+
+def main():
+    parser = RequestBufferParser()
+    print(
+        "{:<14}{:>12}{:>12}{:>12}{:>12}".format(
+            "", "line B", "buffer B", "line us", "buffer us"
+        )
+    )
+    for name in REQUESTS:
+        with open(os.path.join(ROOT, "test", name), "rb") as f:
+            data = f.read()
+        line_peak, line_us = measure(parse_lines, data)
+        buf_peak, buf_us = measure(parse_buffer(parser), data)
+        print(
+            "{:<14}{:>12}{:>12}{:>12.1f}{:>12.1f}".format(
+                name, line_peak, buf_peak, line_us, buf_us
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+##
+#
+# Size, encode and decode time and allocations of the payload formats for
+# batches of LevelSensor readings
+#
+# Usage: poetry run python bench/bench_payload.py
+#
+##
+
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+import payload
+
+ROUNDS = 2000
+BATCH_SIZES = [1, 4, 16]
+
+SHARED = {
+    "device_id": "FB20GY",
+    "peripheral_id": "USLS01",
+    "type": "LevelSensor",
+    "location": {"lon": 25.59877, "lat": -23.54654},
+}
+FIELDS = [
+    {"type": "Level", "unit": "mm"},
+    {"type": "Level", "unit": "%"},
+    {"type": "Level", "unit": "liter"},
+    {"type": "Samples", "unit": "count"},
+    {"type": "Spread", "unit": "mm"},
+]
+
+
+def measurements(n):
+    out = []
+    for i in range(n):
+        level = 800 + i % 7
+        out.append([1600000000 + i * 900, level, level * 100 // 1500, level * 83, 3, 2])
+    return out
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        f(*args)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def allocated(f, *args):
+    tracemalloc.start()
+    f(*args)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run(fmt, size):
+    m = measurements(size)
+    data = payload.encode(fmt, SHARED, FIELDS, m)
+    assert payload.decode(data)["measurements"] == m
+    return {
+        "bytes": len(data),
+        "encode": timed(payload.encode, fmt, SHARED, FIELDS, m),
+        "decode": timed(payload.decode, data),
+        "alloc": allocated(payload.encode, fmt, SHARED, FIELDS, m),
+    }
+
+
+ROW = "{:<8}{:<8}{:>8}{:>8}{:>12.1f}{:>12.1f}{:>10}"
+
+
+def main():
+    print(
+        "{:<8}{:<8}{:>8}{:>8}{:>12}{:>12}{:>10}".format(
+            "batch", "format", "bytes", "/json", "encode us", "decode us", "alloc"
+        )
+    )
+    for size in BATCH_SIZES:
+        base = None
+        for fmt in payload.FORMATS:
+            r = run(fmt, size)
+            base = base or r
+            ratio = "{:.2f}".format(r["bytes"] / base["bytes"])
+            print(
+                ROW.format(
+                    size, fmt, r["bytes"], ratio, r["encode"], r["decode"], r["alloc"]
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
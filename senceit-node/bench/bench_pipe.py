@@ -0,0 +1,88 @@
+##
+#
+# Throughput of Stream.pipe against the previous 100 byte read/write loop,
+# using a mock socket that accepts at most one TCP segment per write
+#
+# Usage: poetry run python bench/bench_pipe.py
+#
+##
+
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import Stream
+
+FILES = ["www/index.html", "www/js/scripts.js", "www/img/silogo42x136.png"]
+ROUNDS = 500
+HEAD = b"HTTP/1.1 200 OK\r\nServer: SenceIt muWebServer/1.0\r\n\r\n"
+
+
+class MockSocket:
+    MSS = 1460
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, buf):
+        n = min(len(buf), self.MSS)
+        self.writes += 1
+        self.bytes += n
+        return n
+
+
+def pipe_100(path, dest):
+    dest.write(HEAD)
+    with open(path, "rb") as reader:
+        buf = reader.read(100)
+        while buf != b"":
+            dest.write(buf)
+            buf = reader.read(100)
+
+
+def pipe_buffered(path, dest):
+    Stream(path).pipe(dest, HEAD)
+
+
+def measure(pipe, path):
+    pipe(path, MockSocket())
+
+    dest = MockSocket()
+    tracemalloc.start()
+    pipe(path, dest)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        pipe(path, MockSocket())
+    elapsed = (time.perf_counter() - start) / ROUNDS
+
+    return (dest.writes, peak, dest.bytes / elapsed / 1e6)
+
+
+def main():
+    print("Chunk size: {} bytes".format(len(Stream.buffer())))
+    print(
+        "{:<28}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+            "(100 B / buffered)", "writes", "writes", "peak B", "peak B", "MB/s", "MB/s"
+        )
+    )
+    for name in FILES:
+        path = os.path.join(ROOT, name)
+        old = measure(pipe_100, path)
+        new = measure(pipe_buffered, path)
+        print(
+            "{:<28}{:>8}{:>8}{:>10}{:>10}{:>10.1f}{:>10.1f}".format(
+                name, old[0], new[0], old[1], new[1], old[2], new[2]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
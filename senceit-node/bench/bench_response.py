@@ -0,0 +1,84 @@
+##
+#
+# Peak memory and time to send a response: str(resp) versus writing it
+# straight to the socket with HttpResponse.write
+#
+# Usage: poetry run python bench/bench_response.py
+#
+##
+
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import Http, HttpResponse, Stream
+
+ROUNDS = 5000
+
+
+class MockSocket:
+    def write(self, buf):
+        return len(buf)
+
+
+def send_str(resp, dest):
+    dest.write(str(resp))
+
+
+def send_direct(resp, dest):
+    resp.write(dest)
+
+
+def responses():
+    from config import config
+
+    body = dict(config)
+    body["networks"] = ["SenceIt-{}".format(i) for i in range(10)]
+    return {
+        "config": HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=body),
+        "error": HttpResponse.err(404, "File not found"),
+        "not modified": HttpResponse(
+            304, Http.MIME_TYPE["JS"], {"ETag": '"3f2a9c1d3f2a9c1d"'}
+        ),
+    }
+
+
+def measure(send, resp):
+    dest = MockSocket()
+    send(resp, dest)
+
+    tracemalloc.start()
+    send(resp, dest)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        send(resp, dest)
+    return (peak, (time.perf_counter() - start) / ROUNDS * 1e6)
+
+
+def main():
+    # The shared buffer is allocated once at startup
+    Stream.buffer()
+    print(
+        "{:<16}{:>10}{:>10}{:>10}{:>10}".format(
+            "", "str B", "write B", "str us", "write us"
+        )
+    )
+    for (name, resp) in responses().items():
+        (str_peak, str_us) = measure(send_str, resp)
+        (write_peak, write_us) = measure(send_direct, resp)
+        print(
+            "{:<16}{:>10}{:>10}{:>10.1f}{:>10.1f}".format(
+                name, str_peak, write_peak, str_us, write_us
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
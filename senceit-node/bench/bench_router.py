@@ -0,0 +1,67 @@
+##
+#
+# Dispatch cost of the compiled Router as the number of registered API
+# routes grows, compared to a linear scan over all routes
+#
+# Usage: poetry run python bench/bench_router.py
+#
+##
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import Http, HTTP_METHOD, Route
+
+ROUNDS = 20000
+
+
+def linear_match(handlers, route):
+    matched = [r for r in handlers.keys() if r == route]
+    return matched[0] if matched else False
+
+
+def timeit(fn, route):
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        fn(route)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    print(
+        "{:>8}{:>12}{:>12}{:>12}{:>12}".format(
+            "routes", "linear us", "exact us", "param us", "static us"
+        )
+    )
+    for n in [1, 10, 50, 100]:
+        http = Http()
+        handler = lambda req: None
+        for i in range(n):
+            http.register_handler(
+                HTTP_METHOD.GET, "/api/v1/endpoint{}".format(i), handler
+            )
+            http.register_handler(
+                HTTP_METHOD.GET, "/api/v{}/items/{{id}}".format(i), handler
+            )
+
+        last = Route(HTTP_METHOD.GET, "/api/v1/endpoint{}".format(n - 1))
+        param = Route(HTTP_METHOD.GET, "/api/v{}/items/42".format(n - 1))
+        static = Route(HTTP_METHOD.GET, "/js/scripts.min.js")
+
+        print(
+            "{:>8}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.2f}".format(
+                n,
+                timeit(lambda r: linear_match(http.handlers, r), last),
+                timeit(http.router.match, last),
+                timeit(http.router.match, param),
+                timeit(http.router.match, static),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
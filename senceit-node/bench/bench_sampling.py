@@ -0,0 +1,152 @@
+##
+#
+# Time, energy and accuracy of LevelSensor.stat with adaptive sampling
+# against the fixed 8 readings per measurement
+#
+# The HC-SR04 is simulated: every reading returns the true distance plus
+# noise, spikes from stray echoes or an echo timeout, and advances a virtual
+# clock by the time the real driver would spend busy-waiting on the echo
+# pin. Energy is estimated from the busy time at full power and the sleeps
+# between readings at idle power.
+#
+# Usage: poetry run python bench/bench_sampling.py
+#
+##
+
+import os
+import random
+import sys
+from unittest.mock import Mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+# The driver's pins are replaced by the simulated echo below
+sys.modules["machine"] = Mock()
+
+import esp_io
+from esp_io import LevelSensor
+from util import Logger
+
+ROUNDS = 2000
+
+SENSOR_HEIGHT = 1700
+DAM_HEIGHT = 1500
+DISTANCE = 900
+
+# Microseconds of one reading on top of the echo: trigger pulse and the
+# ultrasonic burst before the echo pin goes high
+OVERHEAD_US = 500
+# Round trip time of sound per mm
+US_PER_MM = 5.82
+# HCSR04 default echo_timeout_us
+TIMEOUT_US = 30000
+
+# Milliwatts of the ESP8266 busy-waiting with the sensor ranging, and of the
+# ESP8266 idling in sleep_ms with the radio on
+ACTIVE_MW = 3.3 * 80 + 5 * 15
+IDLE_MW = 3.3 * 20
+
+# (name, noise standard deviation in mm, spike rate, timeout rate)
+SCENARIOS = [
+    ("calm", 1.5, 0, 0),
+    ("ripples", 6, 0, 0),
+    ("stray echoes", 1.5, 0.15, 0),
+    ("timeouts", 1.5, 0, 0.1),
+    ("rough", 6, 0.1, 0.05),
+]
+
+
+class Clock:
+    def __init__(self):
+        self.busy_us = 0
+        self.idle_us = 0
+
+    def sleep_ms(self, ms):
+        self.idle_us += ms * 1000
+
+
+class SimulatedEcho:
+    def __init__(self, clock, rand, noise, spikes, timeouts):
+        self.clock = clock
+        self.rand = rand
+        self.noise = noise
+        self.spikes = spikes
+        self.timeouts = timeouts
+        self.readings = 0
+
+    def distance_mm(self):
+        self.readings += 1
+        r = self.rand.random()
+        if r < self.timeouts:
+            self.clock.busy_us += OVERHEAD_US + TIMEOUT_US
+            raise OSError("Out of range")
+        if r < self.timeouts + self.spikes:
+            distance = self.rand.uniform(100, SENSOR_HEIGHT)
+        else:
+            distance = self.rand.gauss(DISTANCE, self.noise)
+        self.clock.busy_us += OVERHEAD_US + distance * US_PER_MM
+        return int(distance)
+
+
+def run(mode, scenario):
+    (_, noise, spikes, timeouts) = scenario
+    parameters = {
+        "dam_height": {"value": DAM_HEIGHT, "unit": "mm"},
+        "sensor_height": {"value": SENSOR_HEIGHT, "unit": "mm"},
+        "sampling": {"mode": mode},
+    }
+    sensor = LevelSensor("USLS01", {"trigger_pin": 4, "echo_pin": 5}, parameters)
+    clock = Clock()
+    esp_io.time = clock
+    sensor.sensor = SimulatedEcho(clock, random.Random(1), noise, spikes, timeouts)
+
+    errors = []
+    for i in range(ROUNDS):
+        stat = sensor.stat()
+        errors.append(abs(SENSOR_HEIGHT - DISTANCE - stat[0]["value"]))
+    errors.sort()
+
+    busy = clock.busy_us / ROUNDS
+    idle = clock.idle_us / ROUNDS
+    return {
+        "readings": sensor.sensor.readings / ROUNDS,
+        "ms": (busy + idle) / 1000,
+        "busy": busy / 1000,
+        "mJ": (busy * ACTIVE_MW + idle * IDLE_MW) / 1e6,
+        "err": sum(errors) / ROUNDS,
+        "p95": errors[int(ROUNDS * 0.95)],
+    }
+
+
+ROW = "{:<14}{:<10}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.2f}{:>10.1f}{:>10}"
+
+
+def main():
+    # stat() logs every measurement
+    Logger.getLogger().info = lambda message: None
+
+    print(
+        "{:<14}{:<10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "scenario", "mode", "readings", "ms", "busy ms", "mJ", "err mm", "p95 mm"
+        )
+    )
+    for scenario in SCENARIOS:
+        for mode in (LevelSensor.FIXED, LevelSensor.ADAPTIVE):
+            r = run(mode, scenario)
+            print(
+                ROW.format(
+                    scenario[0],
+                    mode,
+                    r["readings"],
+                    r["ms"],
+                    r["busy"],
+                    r["mJ"],
+                    r["err"],
+                    r["p95"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
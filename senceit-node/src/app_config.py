@@ -5,19 +5,34 @@
 #
 ##
 
-import time
 import gc
-from machine import Timer, Pin
+import json
+from machine import Pin
 
-from util import Logger
+from util import Logger, ticks_ms, ticks_diff
 
 from webserver import Webserver
-from uhttp import Http, HTTP_METHOD, HttpResponse, HttpRequest, HttpError
+from uhttp import (
+    Http,
+    HTTP_METHOD,
+    HttpResponse,
+    HttpRequest,
+    HttpError,
+    JsonStream,
+    EventStream,
+)
 from esp8266 import ESP8266
+from scheduler import HIGH
 
 log = Logger.getLogger()
 device = ESP8266()
 
+# Milliseconds between readings pushed to /events subscribers
+LIVE_INTERVAL = 5000
+
+# Seconds between runs of the scheduler tasks in the uasyncio server
+SCAN_CHECK = 1
+
 
 def get_config(request: HttpRequest):
     """
@@ -32,8 +47,20 @@ def get_config(request: HttpRequest):
     global device
     from config import config
 
+    # Cached, a scan would stall the server for seconds
     config["networks"] = device.wifi_networks
-    return HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=config)
+    # Encoded while it is sent, the config never exists as one JSON string
+    return HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=JsonStream(config))
+
+
+def get_networks(request: HttpRequest):
+    """
+    Wifi networks from the cache, `?refresh=1` waits for a new scan
+    """
+    global device
+    if request.query.get("refresh") == "1":
+        device.networks.refresh()
+    return HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=device.networks.json())
 
 
 def save_config(req: HttpRequest):
@@ -41,8 +68,6 @@ def save_config(req: HttpRequest):
     Save config
     """
 
-    import json
-
     global device
     resp = {}
     resp["success"] = True
@@ -62,11 +87,9 @@ def save_config(req: HttpRequest):
     log.info("Enabling run mode")
     device.enable_run_mode()
 
-    # start timer to reboot device in 5 s
+    # reboot once the response went out, the server loop runs the task
     log.info("Rebooting in 5 seconds...")
-    timer = Timer(-1)
-    cb = lambda _: device.reboot()
-    timer.init(period=5000, mode=Timer.ONE_SHOT, callback=cb)
+    device.scheduler.after(5000, device.reboot, "reboot", HIGH)
 
     return HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=resp)
 
@@ -79,26 +102,131 @@ def main():
     log.info("Free memory: {}".format(gc.mem_free()))
 
     http = Http()
+    http.load_manifest()
 
     # Register handler for each path
     http.register_handler(HTTP_METHOD.GET, "/config", get_config)
     http.register_handler(HTTP_METHOD.POST, "/config", save_config)
+    http.register_handler(HTTP_METHOD.GET, "/networks", get_networks)
+    http.serve_metrics()
+    events = EventStream()
+    http.serve_events("/events", events)
 
     # Start the server @ port 80
     log.info("IP: {}".format(device.get_ip()))
     log.info("Device ID: {}".format(device.id))
+
+    # Scanned before serving so the first page load finds networks
+    device.networks.start(device.scheduler)
+
+    asyncio = uasyncio()
+    if asyncio:
+        serve_async(asyncio, http, events)
+    else:
+        serve_polling(http, events)
+
+
+def uasyncio():
+    """
+    The uasyncio module if it has the v3 API that AsyncWebserver uses, None
+    otherwise
+
+    The 1.12 firmware ships uasyncio v2, its start_server() never returns
+    and its streams only have awrite() and aclose().
+    """
+    try:
+        import uasyncio as asyncio
+    except ImportError:
+        return None
+    if not hasattr(getattr(asyncio, "StreamWriter", None), "drain"):
+        log.info("uasyncio v2, serving without it")
+        return None
+    return asyncio
+
+
+def serve_async(asyncio, http: Http, events: EventStream):
+    """
+    Serve every client connection from its own coroutine
+    """
+    from async_webserver import AsyncWebserver
+
+    web = AsyncWebserver(http)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(web.start(80))
+    loop.create_task(run_tasks(asyncio, web, events, live_sensors()))
+    gc.collect()
+
+    device.indicate_ready()
+
+    try:
+        loop.run_forever()
+    except Exception as err:
+        log.severe("Unhandled exception: " + str(err))
+    finally:
+        web.close()
+        device.networks.stop()
+
+
+async def run_tasks(asyncio, web, events: EventStream, sensors):
+    last = ticks_ms()
+    while True:
+        await asyncio.sleep(SCAN_CHECK)
+        last = publish_readings(events, sensors, last)
+        device.scheduler.run_pending()
+        # The scan blocks the event loop, only run it between page loads
+        if web.idle():
+            device.networks.update()
+
+
+def live_sensors():
+    """
+    Sensors of the configured peripherals, for live readings while the node
+    is being installed
+    """
+    try:
+        device.get_config()
+        device.init_peripherals(lambda topic, message: None)
+        return [logger.sensor for logger in device.loggers.values()]
+    except Exception as err:
+        log.warn("No live readings: " + str(err))
+        return []
+
+
+def publish_readings(events: EventStream, sensors, last):
+    """
+    Publish readings every LIVE_INTERVAL, only while someone is watching.
+    Returns the ticks of the last readings.
+    """
+    if not events.subscribers or ticks_diff(ticks_ms(), last) < LIVE_INTERVAL:
+        return last
+    for sensor in sensors:
+        events.publish(json.dumps(sensor.stat()), str(sensor.id))
+    return ticks_ms()
+
+
+def serve_polling(http: Http, events: EventStream):
+    """
+    Fallback for firmware without uasyncio v3, serves one client at a time
+    """
     web = Webserver(http)
     web.start(80)
+    sensors = live_sensors()
     gc.collect()
 
     device.indicate_ready()
 
     try:
+        last = ticks_ms()
         while True:
-            # Let server process requests
-            web.handle_client()
-            time.sleep_ms(50)
+            # Block until a client connects instead of sleeping between polls
+            web.handle_client(Webserver.POLL_TIMEOUT)
+            last = publish_readings(events, sensors, last)
+            device.scheduler.run_pending()
+            # Scan between page loads, not while a browser is connected
+            if not web.clients:
+                device.networks.update()
     except Exception as err:
         log.severe("Unhandled exception: " + str(err))
     finally:
         web.close()
+        device.networks.stop()
@@ -7,9 +7,11 @@
 
 import time
 import machine
-from umqtt.robust import MQTTClient
+from umqtt.simple import MQTTClient
 
 from esp8266 import ESP8266
+from outbox import Outbox, open_outbox
+from scheduler import HIGH
 from util import Logger
 import gc
 
@@ -17,6 +19,11 @@ log = Logger.getLogger()
 
 device = ESP8266()
 
+# Milliseconds between checks of the broker connection and replays
+POLL_MS = 500
+# Milliseconds a poll may take when it reconnects to the broker
+RECONNECT_MS = 5000
+
 
 def setup():
     """
@@ -34,26 +41,61 @@ def setup():
     log.info("Free memory: {}".format(gc.mem_free()))
 
     mqtt = MQTTClient(id, ip)
+    outbox = create_outbox(mqtt)
     time.sleep_ms(50)
     try:
         status = mqtt.connect()
         log.info("Connected successfully - status: {}".format(status))
-    except:
+    except OSError:
+        # Readings are stored until the outbox reconnects
         log.severe("Could not connect to MQTT broker")
-        mqtt.reconnect()
+        outbox.offline()
+
+    device.init_peripherals(outbox.send)
+
+    return (mqtt, outbox)
+
+
+def create_outbox(mqtt) -> Outbox:
+    """
+    Readings that can't be published are stored on flash and replayed once
+    the broker is back
+    """
+    return open_outbox(
+        device.config["outbox"],
+        lambda topic, message: mqtt.publish(topic, message),
+        lambda: mqtt.connect(),
+    )
 
-    # Create sender
-    sender = lambda topic, message: mqtt.publish(topic, message)
-    device.init_peripherals(sender)
 
-    return mqtt
+def poll(mqtt, outbox):
+    """
+    Check the broker connection and replay stored readings
+    """
+    if outbox.online:
+        try:
+            mqtt.check_msg()
+        except OSError:
+            log.severe("Lost connection to MQTT broker")
+            outbox.offline()
+    outbox.replay()
 
 
 def main():
-    mqtt = setup()
+    device.get_config()
+    if device.config["deepsleep"]:
+        import app_sleep
+
+        log.info("Running app in deep sleep mode")
+        return app_sleep.main()
+
+    (mqtt, outbox) = setup()
     gc.collect()
+    # A reconnect may take seconds before it fails
+    device.scheduler.every(
+        POLL_MS, lambda: poll(mqtt, outbox), "mqtt", HIGH, budget=RECONNECT_MS
+    )
     device.start()
 
-    while True:
-        log.info("Awaiting action...")
-        mqtt.wait_msg()
+    log.info("Awaiting action...")
+    device.scheduler.run_forever(time.sleep_ms)
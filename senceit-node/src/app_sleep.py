@@ -0,0 +1,120 @@
+##
+#
+# Deep sleep run mode for sensor-only nodes, see deepsleep.DutyCycle
+#
+# main.py starts here straight after a deep sleep wake. Nothing that a
+# reading doesn't need is done: no LED, no scheduler, and the radio, Wifi
+# and MQTT are only brought up when there is something to send.
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import machine
+import network
+
+from deepsleep import DutyCycle
+from esp8266 import ESP8266
+from outbox import open_outbox
+from util import Logger
+
+log = Logger.getLogger()
+
+device = ESP8266()
+
+# Milliseconds to wait for Wifi before readings are stored instead
+WIFI_TIMEOUT_MS = 10000
+
+# Bursts of stored readings replayed per wake
+REPLAY_BURSTS = 4
+
+
+class Uplink:
+    """
+    Turns the radio on and connects to Wifi and the MQTT broker on the first
+    publish, a wake with nothing to send leaves them off
+    """
+
+    def __init__(self):
+        self.mqtt = None
+
+    def connect(self):
+        from umqtt.simple import MQTTClient
+
+        device.connect_to_wifi(WIFI_TIMEOUT_MS)
+        mqtt = MQTTClient(device.id, device.get_mqtt_broker())
+        try:
+            mqtt.connect()
+        except Exception as err:
+            # MQTTException when the broker refuses, stored like a timeout
+            raise OSError("Could not connect to MQTT broker: " + str(err))
+        self.mqtt = mqtt
+
+    def publish(self, topic, message):
+        if self.mqtt is None:
+            self.connect()
+        self.mqtt.publish(topic, message)
+
+    def close(self):
+        if self.mqtt:
+            try:
+                self.mqtt.disconnect()
+            except OSError:
+                pass
+            self.mqtt = None
+
+
+def radio_off():
+    """
+    The ESP8266 reconnects to the last network at boot, which costs most of
+    what sleeping saves on a wake that sends nothing. connect_to_wifi turns
+    the radio back on.
+    """
+    sta_if = network.WLAN(network.STA_IF)
+    if sta_if.active():
+        sta_if.active(False)
+
+
+def forward(outbox, uplink: Uplink):
+    """
+    Replay stored readings, connecting first if the wake sent nothing
+    """
+    if not len(outbox.ring) or not outbox.online:
+        return
+    if uplink.mqtt is None:
+        try:
+            uplink.connect()
+        except OSError as err:
+            log.severe(str(err))
+            return
+    for i in range(REPLAY_BURSTS):
+        if not outbox.replay():
+            break
+
+
+def main():
+    radio_off()
+    device.get_config()
+    uplink = Uplink()
+    # Every wake is a new chance to reconnect, so replay right away
+    outbox = open_outbox(
+        device.config["outbox"],
+        uplink.publish,
+        uplink.connect,
+        interval_ms=0,
+        retry_ms=0,
+    )
+    device.init_peripherals(outbox.send)
+
+    cycle = DutyCycle(device.loggers, machine.RTC(), machine)
+    if not cycle.restore():
+        log.info("Starting duty cycle")
+    cycle.run()
+    device.log_counters()
+    forward(outbox, uplink)
+
+    uplink.close()
+    outbox.ring.close()
+    radio_off()
+    cycle.sleep()
@@ -0,0 +1,386 @@
+##
+#
+# A non-blocking HTTP server built on (u)asyncio
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import gc
+import io
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from metrics import Metrics
+from uhttp import (
+    Http,
+    RequestBufferParser,
+    HttpRequest,
+    HttpError,
+    HttpResponse,
+    ConnectionClosed,
+    Stream,
+)
+from util import Logger, ticks_us, ticks_diff, mem_free
+from webserver import Webserver, intro, shed_response, low_memory
+
+log = Logger.getLogger()
+
+# Nothing left to read, the parser reads from it once the request is buffered
+EMPTY = io.BytesIO(b"")
+
+
+class AsyncWebserver:
+    """
+    Asynchronous counterpart of `webserver.Webserver`
+
+    Every client connection is served by its own coroutine, so a slow client
+    only holds up itself. Each read from the client has a deadline of
+    `read_timeout` seconds, after which the client gets a 408 and is
+    disconnected.
+
+    Connections are kept alive like in `Webserver`, an idle connection is
+    closed after `keep_alive_timeout` seconds.
+
+    Admission control is the same as in `Webserver`: a connection beyond
+    `max_clients` open connections, or a request while the free heap is
+    below `min_free` bytes, is shed with a prebuilt 503.
+
+    Requests are parsed in place by a `RequestBufferParser` with a buffer per
+    connection and dispatched to the same `Http` handler, so registered
+    routes work unchanged. The JSON body is decoded by `JsonDecoder` from
+    the buffer. Unlike in `Webserver` a body larger than the buffer can't be
+    decoded while it is received, the rest of it is read ahead as bytes
+    first.
+
+    Requests are recorded in the metrics of the http handler like in
+    `Webserver`, the wall time includes the time spent waiting for the client.
+
+    A request answered with an `EventStream` subscribes the connection to
+    it, its coroutine then sends the published events until the client
+    disconnects.
+
+    NOTE: `Http.handle` stores the response and route label on the handler
+    instance. It is safe to share between coroutines because nothing is
+    awaited between `handle()` and `get_response()`.
+    """
+
+    READ_TIMEOUT = 5
+    CHUNK_SIZE = 512
+
+    # Seconds an idle keep-alive connection stays open
+    KEEP_ALIVE_TIMEOUT = 5
+
+    # Requests served on a connection before it is closed
+    MAX_REQUESTS = 20
+
+    # Seconds between checks for events to send to a subscriber
+    EVENT_POLL = 0.5
+
+    # Seconds to wait for the rest of a request that is shed
+    SHED_READ = 0.05
+
+    def __init__(
+        self,
+        http_handler: Http,
+        read_timeout=READ_TIMEOUT,
+        keep_alive=True,
+        keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+        max_requests=MAX_REQUESTS,
+        max_clients=Webserver.MAX_CLIENTS,
+        min_free=Webserver.MIN_FREE,
+        retry_after=Webserver.RETRY_AFTER,
+    ):
+        self.http_handler = http_handler
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_requests = max_requests
+        self.max_clients = max_clients
+        self.min_free = min_free
+        self.shed_response = shed_response(retry_after)
+        # Open client connections, and those subscribed to events
+        self.clients = 0
+        self.streams = 0
+        self.server = None
+
+    def idle(self) -> bool:
+        """
+        True if no client is being served, subscribers only wait for events
+        """
+        return self.clients == self.streams
+
+    @property
+    def shed(self):
+        """
+        Number of requests answered with a 503
+        """
+        return self.http_handler.metrics.shed
+
+    async def start(self, port, host="0.0.0.0", backlog=5):
+        intro(port)
+        self.server = await asyncio.start_server(
+            self.handle_client, host, port, backlog=backlog
+        )
+        return self.server
+
+    async def serve_forever(self, port, host="0.0.0.0"):
+        await self.start(port, host)
+        while True:
+            await asyncio.sleep(3600)
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def handle_client(self, reader, writer):
+        if self.clients >= self.max_clients:
+            await self._shed(reader, writer, "too many connections")
+            await self._close(writer)
+            return
+        self.clients += 1
+        # Allocated per connection, a coroutine may wait halfway a request
+        parser = RequestBufferParser()
+        served = 0
+        label = Metrics.INVALID
+        start = ticks_us()
+        free = mem_free()
+        try:
+            while True:
+                if not parser.buffered():
+                    try:
+                        # Wait for the next request on a kept alive connection
+                        n = await asyncio.wait_for(
+                            self._readinto(reader, parser.space()),
+                            self.keep_alive_timeout if served else self.read_timeout,
+                        )
+                    except asyncio.TimeoutError:
+                        if served:
+                            break
+                        raise
+                    if not n:
+                        break
+                    parser.filled(n)
+                if low_memory(self.min_free):
+                    await self._shed(reader, writer, "low memory")
+                    break
+
+                start = ticks_us()
+                free = mem_free()
+                request = await self.get_request(reader, parser)
+                self.http_handler.handle(request)
+                resp = self.http_handler.get_response()
+                label = self.http_handler.label
+                served += 1
+
+                keep_alive = (
+                    self.keep_alive
+                    and request.keep_alive()
+                    and served < self.max_requests
+                )
+                stream = resp.body if resp.is_event_stream() else None
+                if stream:
+                    keep_alive = True
+                resp.headers["Connection"] = "keep-alive" if keep_alive else "close"
+                size = await self.send(writer, resp)
+                self.http_handler.metrics.record(
+                    label, resp.status, ticks_diff(ticks_us(), start), free, size
+                )
+                if stream:
+                    await self.send_events(reader, writer, stream)
+                    break
+                if not keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            log.warn("Client read timed out")
+            await self._send_error(writer, 408, "Request Timeout")
+        except (OSError, EOFError) as err:
+            log.severe(str(err))
+        except MemoryError as memerr:
+            self.http_handler.metrics.memory_errors += 1
+            gc.collect()
+            log.severe(str(memerr))
+        except HttpError as err:
+            log.severe(err.message)
+            size = await self._send_error(writer, err.code, err.message)
+            self.http_handler.metrics.record(
+                Metrics.INVALID, err.code, ticks_diff(ticks_us(), start), free, size
+            )
+        except Exception as err:
+            # E.g. a streamed body that failed while it was sent, the status
+            # line may be out already so the client is only disconnected
+            log.severe("Response failed: " + str(err))
+            self.http_handler.metrics.record(
+                label, 500, ticks_diff(ticks_us(), start), free, 0
+            )
+        finally:
+            self.clients -= 1
+            await self._close(writer)
+
+    async def get_request(self, reader, parser) -> HttpRequest:
+        """
+        Read until the headers are buffered and parse the request in place
+        """
+        while not parser.head_buffered():
+            n = await self._with_deadline(self._readinto(reader, parser.space()))
+            if not n:
+                raise ConnectionClosed("Connection closed by client")
+            parser.filled(n)
+
+        if parser.parse_head(EMPTY):
+            missing = parser.body_missing()
+            body = EMPTY
+            if missing > parser.room():
+                # Only the rest of a body larger than the buffer is read
+                # ahead, as bytes
+                body = io.BytesIO(
+                    await self._with_deadline(reader.readexactly(missing))
+                )
+            while body is EMPTY and parser.body_missing():
+                space = parser.space()[: parser.body_missing()]
+                n = await self._with_deadline(self._readinto(reader, space))
+                if not n:
+                    raise ConnectionClosed("Connection closed by client")
+                parser.filled(n)
+            parser.parse_body(body)
+        return parser.get_request()
+
+    async def _readinto(self, reader, mv):
+        """
+        Read into the buffer, the asyncio of CPython and older uasyncio
+        streams have no readinto
+        """
+        if hasattr(reader, "readinto"):
+            return await reader.readinto(mv)
+        data = await reader.read(len(mv))
+        mv[: len(data)] = data
+        return len(data)
+
+    async def send(self, writer, resp: HttpResponse):
+        """
+        Returns the number of bytes sent
+        """
+        if resp.is_chunked():
+            return await self._send_chunked(writer, resp)
+        data = str(resp).encode("utf-8")
+        size = len(data)
+        writer.write(data)
+        await writer.drain()
+        if resp.has_stream():
+            size += await self._send_file(writer, resp.body)
+        return size
+
+    async def _send_file(self, writer, stream: Stream):
+        """
+        Copy a file body through the buffer shared by all streams. The writer
+        copies what it is given, so the buffer is free again before the
+        drain lets another coroutine run.
+        """
+        mv = memoryview(Stream.buffer())
+        remaining = stream.length
+        size = 0
+        with stream.open() as reader:
+            while remaining is None or remaining > 0:
+                end = len(mv) if remaining is None else min(len(mv), remaining)
+                n = reader.readinto(mv[:end])
+                if not n:
+                    break
+                if remaining is not None:
+                    remaining -= n
+                size += n
+                writer.write(mv[:n])
+                await writer.drain()
+        return size
+
+    async def _send_chunked(self, writer, resp: HttpResponse):
+        """
+        Send a JsonStream body while it is encoded, in chunks of about
+        CHUNK_SIZE bytes
+        """
+        data = resp.head().encode("utf-8")
+        size = len(data)
+        writer.write(data)
+        chunk = bytearray()
+        for piece in resp.body.pieces():
+            chunk.extend(piece.encode("utf-8"))
+            if len(chunk) >= self.CHUNK_SIZE:
+                size += await self._write_chunk(writer, chunk)
+                chunk = bytearray()
+        if chunk:
+            size += await self._write_chunk(writer, chunk)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return size + 5
+
+    async def _write_chunk(self, writer, chunk):
+        head = "{:x}\r\n".format(len(chunk)).encode()
+        writer.write(head)
+        writer.write(chunk)
+        writer.write(b"\r\n")
+        await writer.drain()
+        return len(head) + len(chunk) + 2
+
+    async def send_events(self, reader, writer, stream):
+        """
+        Subscribe the client to an EventStream and send it the published
+        events until it disconnects
+        """
+        stream.subscribe(writer)
+        queue = stream.subscribers[writer][0]
+        self.streams += 1
+        try:
+            while True:
+                while queue:
+                    writer.write(queue.pop(0))
+                    await writer.drain()
+                try:
+                    # A subscriber never sends anything, EOF is a disconnect
+                    if not await asyncio.wait_for(reader.read(1), self.EVENT_POLL):
+                        break
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.streams -= 1
+            stream.unsubscribe(writer)
+
+    def _with_deadline(self, coro):
+        return asyncio.wait_for(coro, self.read_timeout)
+
+    async def _send_error(self, writer, code, message):
+        resp = HttpResponse.err(code, message)
+        resp.headers["Connection"] = "close"
+        try:
+            return await self.send(writer, resp)
+        except OSError as oserr:
+            log.severe(str(oserr))
+            return 0
+
+    async def _shed(self, reader, writer, reason):
+        """
+        Answer with a 503 without parsing the request
+        """
+        self.http_handler.metrics.shed += 1
+        log.warn("Shedding request: " + reason)
+        try:
+            # Read what the client already sent, closing a socket with unread
+            # data resets the connection and the client may lose the 503
+            try:
+                await asyncio.wait_for(reader.read(self.CHUNK_SIZE), self.SHED_READ)
+            except asyncio.TimeoutError:
+                pass
+            writer.write(self.shed_response)
+            await writer.drain()
+        except OSError as oserr:
+            log.severe(str(oserr))
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except OSError:
+            pass
@@ -23,4 +23,12 @@ config = {
     },
     "topic_prefix": {"sensor": "stat", "actuator": "cmnd"},
     "pin_mapping": {"USLS01": {"trigger_pin": 4, "echo_pin": 5},},
+    # Payload format by topic, "json", "cbor" or "struct", JSON if not listed
+    "payload": {},
+    # Store and forward of readings while the broker can't be reached, see
+    # outbox.RingLog and outbox.Outbox
+    "outbox": {"path": "outbox.log"},
+    # Deep sleep between readings instead of staying connected, see
+    # deepsleep.DutyCycle
+    "deepsleep": False,
 }
@@ -0,0 +1,171 @@
+##
+#
+# Duty cycled run mode: wake, take the readings that are due, publish or
+# store them and deep sleep until the next one
+#
+# What the loggers have to remember between readings, their counters,
+# deadband, filter state and batched readings, is kept in RTC memory, which
+# survives a deep sleep but not a power cycle.
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import time
+
+from payload import cbor_dumps, cbor_loads
+from util import Logger
+
+log = Logger.getLogger()
+
+
+class RtcState:
+    """
+    State saved in RTC memory as CBOR after a schema byte, the state format
+    in the high and its version in the low nibble
+    """
+
+    SCHEMA = 0x31
+    # Bytes of RTC memory on the ESP8266
+    SIZE = 492
+
+    def __init__(self, rtc, size=SIZE):
+        self.rtc = rtc
+        self.size = size
+
+    def load(self):
+        """
+        The saved state, None if there is none or it can't be read
+        """
+        data = self.rtc.memory()
+        if not data or data[0] != self.SCHEMA:
+            return None
+        try:
+            (state, end) = cbor_loads(data, 1)
+        except (ValueError, IndexError):
+            return None
+        return state if end == len(data) else None
+
+    def save(self, state):
+        """
+        Raises ValueError if the state doesn't fit
+        """
+        data = cbor_dumps(state, bytearray([self.SCHEMA]))
+        if len(data) > self.size:
+            raise ValueError("State too large for RTC memory")
+        self.rtc.memory(data)
+
+    def clear(self):
+        self.rtc.memory(b"")
+
+
+class DutyCycle:
+    """
+    Runs the loggers from deep sleep to deep sleep
+
+    Every wake restores the loggers, runs the ones that are due and sleeps
+    until the next is due. Deadlines are RTC seconds and stay on the
+    interval grid of each logger, so a slow wake doesn't delay later
+    readings. State is only restored after a deep sleep, any other reset
+    starts over.
+
+    machine is the machine module or a shim with reset_cause(),
+    DEEPSLEEP_RESET and deepsleep(ms). On the ESP8266 GPIO16 has to be wired
+    to RST for the RTC to wake it.
+    """
+
+    # Longest deep sleep, the ESP8266 can't sleep much more than 71 minutes
+    MAX_SLEEP_MS = 3600000
+
+    # Seconds before its deadline that a logger is run rather than sleeping
+    # again for a moment
+    SLACK = 2
+
+    def __init__(self, loggers: dict, rtc, machine, clock=time.time):
+        self.loggers = loggers
+        self.state = RtcState(rtc)
+        self.machine = machine
+        self.clock = clock
+        self.wakes = 0
+        # RTC seconds each logger is due
+        self.due = {}
+
+    def restore(self) -> bool:
+        """
+        Restore the state saved before the deep sleep, False after any other
+        reset or without a valid state
+        """
+        if self.machine.reset_cause() != self.machine.DEEPSLEEP_RESET:
+            return False
+        state = self.state.load()
+        if state is None:
+            log.warn("No saved state, starting over")
+            return False
+        try:
+            (self.wakes, loggers) = state
+            for (key, due, logger) in loggers:
+                if key in self.loggers:
+                    self.loggers[key].restore(logger)
+                    self.due[key] = due
+        except (ValueError, TypeError, IndexError) as err:
+            log.warn("Could not restore state: " + str(err))
+            return False
+        return True
+
+    def run(self) -> int:
+        """
+        Run the loggers that are due, returns the number run
+        """
+        self.wakes += 1
+        now = int(self.clock())
+        n = 0
+        for (key, logger) in self.loggers.items():
+            due = self.due.get(key, now)
+            if due - now > self.SLACK:
+                continue
+            logger.run()
+            n += 1
+            interval = max(logger.interval // 1000, 1)
+            due += interval
+            if due <= now:
+                # Slept through readings, the next stays on the grid
+                due += ((now - due) // interval + 1) * interval
+            self.due[key] = due
+        return n
+
+    def sleep_ms(self) -> int:
+        """
+        Milliseconds until the next logger is due
+        """
+        if not self.due:
+            return self.MAX_SLEEP_MS
+        delay = (min(self.due.values()) - int(self.clock())) * 1000
+        return min(max(delay, 0), self.MAX_SLEEP_MS)
+
+    def save(self):
+        try:
+            self.state.save(self._state())
+        except ValueError as err:
+            # Send the batched readings rather than losing them
+            log.warn(str(err) + ", sending batched readings")
+            for logger in self.loggers.values():
+                logger.flush()
+            self.state.save(self._state())
+
+    def sleep(self):
+        """
+        Save the state and deep sleep until the next logger is due, doesn't
+        return on the device
+        """
+        ms = self.sleep_ms()
+        self.save()
+        log.info("Sleeping for {} ms after wake {}".format(ms, self.wakes))
+        self.machine.deepsleep(ms)
+
+    def _state(self) -> list:
+        loggers = [
+            [key, self.due.get(key, 0), logger.save()]
+            for (key, logger) in self.loggers.items()
+        ]
+        return [self.wakes, loggers]
@@ -8,25 +8,108 @@
 import network
 import machine
 
-from util import Logger
+from scheduler import Scheduler, LOW
+from util import Logger, ticks_ms, ticks_diff
 
 log = Logger.getLogger()
 
 
+class NetworkCache:
+    """
+    Wifi networks found by the last scan
+
+    A scan blocks for seconds, so requests are answered from the cache. A
+    scheduler task marks the cache as due every ttl milliseconds and the
+    server loop calls `update` between requests to scan again.
+    """
+
+    # Milliseconds before the networks are scanned again
+    TTL = 60000
+
+    def __init__(self, scan, ttl=TTL):
+        self.scan = scan
+        self.ttl = ttl
+        self.networks = []
+        # ticks_ms of the last scan, None before the first
+        self.scanned = None
+        self.due = True
+        self.scheduler = None
+        self.task = None
+
+    def start(self, scheduler: Scheduler):
+        """
+        Scan now and then in the background every ttl milliseconds
+        """
+        self.refresh()
+        self.scheduler = scheduler
+        self.task = scheduler.every(self.ttl, self._expire, "networks", LOW)
+
+    def stop(self):
+        if self.task:
+            self.scheduler.cancel(self.task)
+            self.task = None
+
+    def _expire(self):
+        # Only flag the scan, the server loop scans when no client waits
+        self.due = True
+
+    def update(self):
+        """
+        Scan if the cache is due, returns True if it scanned
+        """
+        if not self.due:
+            return False
+        self.refresh()
+        return True
+
+    def refresh(self):
+        self.due = False
+        try:
+            self.networks = self.scan()
+        except OSError as err:
+            # Keep the last networks, the next update tries again
+            log.warn("Wifi scan failed: " + str(err))
+        self.scanned = ticks_ms()
+
+    def age(self):
+        """
+        Milliseconds since the last scan, None before the first
+        """
+        if self.scanned is None:
+            return None
+        return ticks_diff(ticks_ms(), self.scanned)
+
+    def json(self) -> dict:
+        return {"networks": self.networks, "age": self.age()}
+
+
 class ESP8266:
+
+    # Milliseconds between log lines with the logger counters
+    COUNTERS_MS = 3600000
+
     def __init__(self, config_path=""):
         self.config_path = config_path
-        self.status_timer = None
+        # Runs the loggers, the status LED and housekeeping from the main loop
+        self.scheduler = Scheduler()
         self.hard_reset_ref = self.hard_reset
         p_reset = machine.Pin(0, machine.Pin.IN)
         p_reset.irq(self.handle_reset, trigger=machine.Pin.IRQ_FALLING)
         self.led = machine.Pin(2, mode=machine.Pin.OUT)
         self.led.value(1)
+        self.networks = NetworkCache(self.scan_networks)
+        self.loggers = {}
 
     @property
     def wifi_networks(self):
         """
-        Get available Wifi networks
+        Wifi networks found by the last scan, never waits for a scan
+        """
+        return self.networks.networks
+
+    def scan_networks(self):
+        """
+        Scan for open Wifi networks, blocks for a few seconds
         """
         import time
 
@@ -95,9 +178,35 @@ class ESP8266:
 
         self.reboot()
 
+    def stop(self):
+        """
+        Stop the loggers, batched readings are sent before they stop
+        """
+        for l in self.loggers.values():
+            try:
+                l.stop()
+            except Exception as err:
+                log.severe("Could not stop logger: " + str(err))
+
+    def counters(self) -> dict:
+        """
+        Readings taken, published and suppressed by the logger of each
+        peripheral
+        """
+        return dict((k, l.counters()) for (k, l) in self.loggers.items())
+
+    def log_counters(self):
+        for (k, c) in self.counters().items():
+            log.info(
+                "{}: {} readings, {} published, {} suppressed, {} heartbeats".format(
+                    k, c["readings"], c["published"], c["suppressed"], c["heartbeats"]
+                )
+            )
+
     def reboot(self):
         """
         """
+        self.stop()
         log.info("Rebooting SenceIt Node {}".format(self.id))
         machine.reset()
 
@@ -120,9 +229,10 @@ class ESP8266:
             essid=ssid, password=pwd, authmode=network.AUTH_WPA_WPA2_PSK
         )  # set the ESSID of the access point
 
-    def sta_config(self, ap_if, ssid, pwd):
+    def sta_config(self, ap_if, ssid, pwd, timeout_ms=None):
         """
-        activate station config
+        activate station config, raises OSError if it isn't connected within
+        timeout_ms
         """
         # Connect to Wi-Fi if not connected
         sta_if = network.WLAN(network.STA_IF)
@@ -132,19 +242,26 @@ class ESP8266:
             log.info("Connecting to {}...".format(ssid))
             sta_if.connect(ssid, pwd)
             # Wait for connecting to Wi-Fi
+            start = ticks_ms()
             while not sta_if.isconnected():
-                pass
+                if timeout_ms is None:
+                    continue
+                if ticks_diff(ticks_ms(), start) > timeout_ms:
+                    raise OSError("Wifi connection timed out")
 
         return sta_if
 
-    def connect_to_wifi(self):
+    def connect_to_wifi(self, timeout_ms=None):
         # Disable AP interface
         ap_if = network.WLAN(network.AP_IF)
         if ap_if.active():
             ap_if.active(False)
 
         sta_if = self.sta_config(
-            ap_if, self.config["wifi"]["ssid"], self.config["wifi"]["password"]
+            ap_if,
+            self.config["wifi"]["ssid"],
+            self.config["wifi"]["password"],
+            timeout_ms,
         )
         # Show IP address
         ip = sta_if.ifconfig()[0]
@@ -169,20 +286,28 @@ class ESP8266:
                 None,
                 self._get_pin_mapping(k),
                 self._get_parameters(k),
+                batch=self._get_batch(k),
+                fmt=self._get_format(k),
+                publish=self._get_publish(k),
             )
 
     def start(self):
-
-        self.status_timer = machine.Timer(-1)
-        cb = lambda _: self.led.value(0) if self.led.value() == 1 else self.led.value(1)
-        self.status_timer.init(period=5000, mode=machine.Timer.PERIODIC, callback=cb)
+        """
+        Schedule the status LED and the loggers, the main loop runs them
+        with `scheduler.run_forever`
+        """
+        self.scheduler.every(5000, self.toggle_led, "status", LOW)
+        self.scheduler.every(self.COUNTERS_MS, self.log_counters, "counters", LOW)
 
         for k, l in self.loggers.items():
-            l.start()
+            l.start(self.scheduler)
 
         self.indicate_ready()
         machine.idle()
 
+    def toggle_led(self):
+        self.led.value(0 if self.led.value() == 1 else 1)
+
     def indicate_ready(self):
         import time
 
@@ -259,6 +384,28 @@ class ESP8266:
 
         return self.config["peripherals"][key]["config"]["interval"]
 
+    def _get_batch(self, key):
+        """
+        Batching of the readings, None to send every reading on its own
+        """
+
+        return self.config["peripherals"][key]["config"].get("batch")
+
+    def _get_publish(self, key):
+        """
+        Report on change settings, None to publish every reading
+        """
+
+        return self.config["peripherals"][key]["config"].get("publish")
+
+    def _get_format(self, key):
+        """
+        Payload format of the peripheral's topic, JSON unless "payload" maps
+        the topic to another format
+        """
+
+        return self.config["payload"].get(self._get_topic(key), "json")
+
     def _get_parameters(self, key):
         """
         """
@@ -6,13 +6,16 @@
 ##
 
 import ultrasonic
+import filters
+import payload
 import json
 import re
 import math
-from machine import Timer
 import time
 
-from util import Logger, signal_filter
+from scheduler import Scheduler
+
+from util import Logger, signal_filter, ticks_ms, ticks_diff, ticks_add
 
 
 log = Logger.getLogger()
@@ -52,31 +55,84 @@ class Sensor(Peripheral):
     def __init__(self, id, _type):
         super().__init__(id, _type)
 
-    def _create_payload(self, id, loc):
-        return json.dumps(
-            {
-                "timestamp": time.time(),
-                "device_id": id,
-                "peripheral_id": self.id,
-                "type": self._type,
-                "location": {"lon": loc[0], "lat": loc[1]},
-                "measurement": self.stat(),
-            }
-        )
+    def _create_payload(self, id, loc, measurement=None):
+        payload = self._shared_fields(id, loc)
+        payload["timestamp"] = time.time()
+        payload["measurement"] = self.stat() if measurement is None else measurement
+        return json.dumps(payload)
+
+    def _shared_fields(self, id, loc) -> dict:
+        """
+        Fields that are the same in every payload of the sensor
+        """
+        return {
+            "device_id": id,
+            "peripheral_id": self.id,
+            "type": self._type,
+            "location": {"lon": loc[0], "lat": loc[1]},
+        }
 
     def stat(self):
         pass
 
+    # True if the sensor can measure without blocking, see DataLogger.start
+    nonblocking = False
+
 
 class LevelSensor(Sensor):
+    """
+    Ultrasonic level sensor, each measurement is filtered from several
+    distance readings
+
+    By default stat() always takes `samples` readings. With "sampling":
+    {"mode": "adaptive"} in the parameters it stops as soon as the middle
+    readings, the ones signal_filter averages, agree within `tolerance` and
+    only takes up to `max_samples` readings when they keep disagreeing. Its
+    measurements also report the number of readings and their spread.
+
+    A "filter" in the parameters, see filters.create, smooths the distance
+    over consecutive measurements.
+
+    "driver": "irq" selects the interrupt driven ultrasonic.HCSR04Irq. The
+    sensor is then nonblocking: measure() starts a measurement and poll()
+    takes the readings as their echoes come in, so a scheduler task that
+    polls it doesn't hold up the others while the sound is in flight. stat()
+    still waits for the readings.
+    """
+
+    # Sampling modes
+    FIXED = "fixed"
+    ADAPTIVE = "adaptive"
+
+    # Readings per measurement in fixed mode
+    SAMPLES = 8
+
+    # Readings per measurement in adaptive mode
+    MIN_SAMPLES = 3
+    MAX_SAMPLES = 12
+
+    # Largest spread in mm of the middle readings that ends adaptive sampling
+    TOLERANCE = 5
+
     def __init__(self, id, pin_mapping, config):
         super().__init__(id, "LevelSensor")
         trigger = pin_mapping["trigger_pin"]
         echo = pin_mapping["echo_pin"]
         log.info("Configured trigger @ pin {} and echo @ pin {}".format(trigger, echo))
-        self.sensor = ultrasonic.HCSR04(trigger, echo)
+        if config.get("driver") == "irq":
+            # Timestamps the echo in an interrupt instead of busy-waiting
+            self.sensor = ultrasonic.HCSR04Irq(trigger, echo, self._reading)
+            self.nonblocking = True
+        else:
+            self.sensor = ultrasonic.HCSR04(trigger, echo)
         self.config = config
         self.dh, self.sh, self.dd = self.parse_parameters()
+        self.parse_sampling()
+        self.filter = filters.create(config.get("filter"))
+        # Sorted readings of the measurement in flight and readings taken
+        self.pending = None
+        self.taken = 0
+        self.complete = False
 
     def calc_volume(self, distance, dam_height, sensor_height, diameter=None):
         """
@@ -113,6 +169,21 @@ class LevelSensor(Sensor):
 
         return tuple(out)
 
+    def parse_sampling(self):
+        sampling = self.config.get("sampling", {})
+        self.mode = sampling.get("mode", self.FIXED)
+        if self.mode not in (self.FIXED, self.ADAPTIVE):
+            raise AttributeError("Unsupported sampling mode")
+        self.samples = int(sampling.get("samples", self.SAMPLES))
+        self.min_samples = max(1, int(sampling.get("min_samples", self.MIN_SAMPLES)))
+        self.max_samples = max(
+            self.min_samples, int(sampling.get("max_samples", self.MAX_SAMPLES))
+        )
+        tolerance = sampling.get("tolerance", self.TOLERANCE)
+        if type(tolerance) == dict:
+            tolerance = self.convert(tolerance)
+        self.tolerance = tolerance
+
     def convert(self, m):
         if m["unit"] == "mm":
             mult = 1
@@ -125,54 +196,461 @@ class LevelSensor(Sensor):
 
         return mult * int(m["value"])
 
+    def sample(self) -> list:
+        """
+        Sorted distance readings of one measurement. Readings closer than
+        the full dam level and readings out of range are dropped, but count
+        towards the number of readings taken.
+        """
+        d = []
+        for i in range(self.readings()):
+            if i:
+                time.sleep_ms(1)
+            try:
+                t = self.sensor.distance_mm()
+            except OSError:
+                continue
+            if self._add(d, t):
+                break
+        return d
+
+    def readings(self) -> int:
+        """
+        Most readings taken for a measurement
+        """
+        return self.max_samples if self.mode == self.ADAPTIVE else self.samples
+
+    def _add(self, d, t) -> bool:
+        """
+        Add a reading to the sorted readings d, returns True once adaptive
+        sampling has enough
+        """
+        if t is None or t <= self.sh - self.dh:
+            return False
+
+        # Insertion keeps the readings sorted for the spread check
+        j = len(d)
+        while j and d[j - 1] > t:
+            j -= 1
+        d.insert(j, t)
+        return (
+            self.mode == self.ADAPTIVE
+            and len(d) >= self.min_samples
+            and self.spread(d) <= self.tolerance
+        )
+
+    def measure(self):
+        """
+        Start a measurement without waiting for the echoes, poll() takes the
+        readings. Only for a nonblocking sensor.
+        """
+        self.pending = []
+        self.taken = 0
+        self.complete = False
+        self.sensor.start()
+
+    def _reading(self, t):
+        # Called by the driver with a distance, or None without an echo
+        if self.pending is None:
+            return
+        self.taken += 1
+        if self._add(self.pending, t) or self.taken >= self.readings():
+            self.complete = True
+
+    def poll(self):
+        """
+        The measurement like stat() once all its readings are in, None while
+        they are in flight
+        """
+        if self.pending is None:
+            return None
+        self.sensor.poll()
+        if self.complete:
+            d = self.pending
+            self.pending = None
+            return self._stat(d)
+        if not self.sensor.busy():
+            self.sensor.start()
+        return None
+
+    @staticmethod
+    def spread(samples) -> int:
+        """
+        Spread of the middle three of the sorted samples, the readings that
+        signal_filter averages, or of all samples if there are fewer
+        """
+        n = len(samples)
+        if n > 3:
+            m = n // 2
+            return samples[m + 1] - samples[m - 1]
+        return samples[-1] - samples[0] if n else 0
+
     def stat(self):
         """
         """
+        return self._stat(self.sample())
 
-        min = self.sh - self.dh
-        d = []
-        for i in range(8):
-            t = self.sensor.distance_mm()
-            if t > min:
-                d.append(t)
-            time.sleep_ms(1)
+    def _stat(self, d):
+        spread = self.spread(d)
         dist = signal_filter(d)
-        log.info("Measured distance: {} mm".format(dist))
+        if self.filter:
+            # A measurement without readings leaves the filter as it was
+            dist = self.filter.update(dist) if d else (self.filter.value or 0)
+        log.info(
+            "Measured distance: {} mm from {} samples, spread {} mm".format(
+                dist, len(d), spread
+            )
+        )
         level, pct, vol = self.calc_volume(dist, self.dh, self.sh, self.dd)
-        return [
+        measurement = [
             {"type": "Level", "unit": "mm", "value": level},
             {"type": "Level", "unit": "%", "value": pct},
             {"type": "Level", "unit": "liter", "value": vol},
         ]
+        if self.mode == self.ADAPTIVE:
+            # Fixed mode keeps the message shape of earlier firmware
+            measurement.append({"type": "Samples", "unit": "count", "value": len(d)})
+            measurement.append({"type": "Spread", "unit": "mm", "value": spread})
+        return measurement
+
+
+class Batch:
+    """
+    Readings of one sensor waiting to be sent together, at most `size`
+
+    Each reading is kept as a compact tuple (timestamp, value, ...) in a
+    list allocated up front. The type and unit of the values are kept once
+    for the batch, a reading with other fields can't join it.
+    """
+
+    def __init__(self, size, max_age):
+        self.size = size
+        # Milliseconds the oldest reading may wait
+        self.max_age = max_age
+        self.readings = [None] * size
+        self.count = 0
+        self.fields = None
+        # ticks_ms when the oldest reading was added
+        self.started = 0
+
+    def accepts(self, measurement) -> bool:
+        if not self.count:
+            return True
+        fields = self.fields
+        if len(measurement) != len(fields):
+            return False
+        for i in range(len(fields)):
+            m = measurement[i]
+            if m["type"] != fields[i]["type"] or m["unit"] != fields[i]["unit"]:
+                return False
+        return True
+
+    def add(self, timestamp, measurement):
+        if not self.count:
+            self.fields = [{"type": m["type"], "unit": m["unit"]} for m in measurement]
+            self.started = ticks_ms()
+        self.readings[self.count] = (timestamp,) + tuple(
+            m["value"] for m in measurement
+        )
+        self.count += 1
+
+    def full(self) -> bool:
+        return self.count >= self.size
+
+    def age(self) -> int:
+        return ticks_diff(ticks_ms(), self.started) if self.count else 0
+
+    def payload(self, shared: dict, fmt=payload.JSON):
+        """
+        The shared fields once and an array of [timestamp, value, ...]
+        """
+        return payload.encode(fmt, shared, self.fields, self.readings[: self.count])
+
+    def clear(self):
+        for i in range(self.count):
+            self.readings[i] = None
+        self.count = 0
+        self.fields = None
+
+    def save(self):
+        """
+        The batched readings as [[type, unit], ...] and [[timestamp, value,
+        ...], ...], None if there are none
+        """
+        if not self.count:
+            return None
+        fields = [[f["type"], f["unit"]] for f in self.fields]
+        return [fields, [list(r) for r in self.readings[: self.count]]]
+
+    def restore(self, state, now):
+        """
+        Batch the saved readings again, their age follows from the
+        timestamp of the oldest and the time now in seconds
+        """
+        self.clear()
+        if not state:
+            return
+        (fields, readings) = state
+        self.fields = [{"type": f[0], "unit": f[1]} for f in fields]
+        for r in readings[: self.size]:
+            self.readings[self.count] = tuple(r)
+            self.count += 1
+        age = max(now - readings[0][0], 0) * 1000
+        self.started = ticks_add(ticks_ms(), -age)
+
+
+class Deadband:
+    """
+    Report on change: a reading is published when its value moved more than
+    the deadband from the last published value, and at least every
+    `heartbeat` intervals so a silent sensor can be told from a steady one
+
+    The deadband is a number of mm or a measurement like {"value": 2,
+    "unit": "%"}. It applies to the value of the reading with that unit, the
+    level in mm, cm or m, the level in % or the volume in liter. Config
+    values may be strings, like in `LevelSensor.convert`.
+
+    NOTE: a "%" deadband is absolute, in points of the level in % output,
+    not a change relative to the last published value.
+    """
+
+    # Intervals between readings published while the value holds steady
+    HEARTBEAT = 4
+
+    def __init__(self, deadband, heartbeat=HEARTBEAT):
+        if type(deadband) != dict:
+            deadband = {"value": deadband, "unit": "mm"}
+        unit = deadband["unit"]
+        mult = {"mm": 1, "cm": 10, "m": 1000}.get(unit)
+        if mult:
+            self.unit = "mm"
+            self.deadband = mult * float(deadband["value"])
+        elif unit in ("%", "liter"):
+            self.unit = unit
+            self.deadband = float(deadband["value"])
+        else:
+            raise AttributeError("Unsupported deadband unit")
+        self.heartbeat = int(heartbeat or 0)
+        # Value of the last published reading
+        self.last = None
+        # Readings suppressed since the last published reading, and in total
+        self.skipped = 0
+        self.suppressed = 0
+        # Readings only published because of the heartbeat
+        self.heartbeats = 0
+
+    def changed(self, measurement) -> bool:
+        """
+        Whether the reading should be published, a suppressed reading is
+        counted
+        """
+        value = None
+        for m in measurement:
+            if m["unit"] == self.unit:
+                value = m["value"]
+                break
+        heartbeat = self.heartbeat and self.skipped + 1 >= self.heartbeat
+        changed = (
+            value is None or self.last is None or abs(value - self.last) > self.deadband
+        )
+        if changed or heartbeat:
+            if not changed:
+                self.heartbeats += 1
+            self.last = value
+            self.skipped = 0
+            return True
+        self.skipped += 1
+        self.suppressed += 1
+        return False
+
+    def save(self) -> list:
+        return [self.last, self.skipped, self.suppressed, self.heartbeats]
+
+    def restore(self, state):
+        (self.last, self.skipped, self.suppressed, self.heartbeats) = state
 
 
 class DataLogger:
-    def __init__(self, device_id, loc, tx, interval: int, topic: str, sensor: Sensor):
-        self.timer = None
+    """
+    Publishes the readings of a sensor at an interval
+
+    With a batch, {"size": 8, "max_age": "1h"} in the peripheral config,
+    readings are collected and published as one message when the batch is
+    full, before its oldest reading would be older than max_age, and when
+    the logger is stopped.
+
+    fmt is the payload format, see payload.FORMATS. A reading that isn't
+    batched is sent as a batch of one in the binary formats.
+
+    With publish, {"deadband": 10, "heartbeat": 4} in the peripheral config,
+    only readings that changed by more than the deadband are published, see
+    Deadband.
+    """
+
+    # Milliseconds between polls of a nonblocking sensor
+    POLL_MS = 5
+
+    def __init__(
+        self,
+        device_id,
+        loc,
+        tx,
+        interval: int,
+        topic: str,
+        sensor: Sensor,
+        batch=None,
+        fmt=payload.JSON,
+        publish=None,
+    ):
+        if fmt not in payload.FORMATS:
+            raise AttributeError("Unsupported payload format")
+        self.scheduler = None
+        self.task = None
+        # Polls a nonblocking sensor while a measurement is in flight
+        self.poller = None
         self.topic = topic
-        self.interval = 1  # defualt interval is 1000ms
-        if interval.rstrip().endswith("m"):
-            self.interval = int(interval[:-1]) * 60
-        elif interval.rstrip().endswith("h"):
-            self.interval = int(interval[:-1]) * 3600
-        elif interval.rstrip().endswith("s"):
-            self.interval = int(interval[:-1])
-        self.interval *= 1000
+        self.interval = self.parse_interval(interval)
         self.is_running = False
         self.sender = tx
         self.sensor = sensor
         self.device_id = device_id
         self.loc = loc
+        self.fmt = fmt
+        self.batch = None
+        if batch and int(batch.get("size", 1)) > 1:
+            max_age = batch.get("max_age")
+            self.batch = Batch(
+                int(batch["size"]),
+                self.parse_interval(max_age) if max_age else 0x7FFFFFFF,
+            )
+        self.deadband = None
+        if publish and publish.get("deadband") is not None:
+            self.deadband = Deadband(
+                publish["deadband"], publish.get("heartbeat", Deadband.HEARTBEAT)
+            )
+        # Readings taken and readings published
+        self.readings = 0
+        self.published = 0
+
+    @staticmethod
+    def parse_interval(interval: str) -> int:
+        """
+        Milliseconds in an interval like "30s", "15m" or "1h"
+        """
+        ms = 1  # defualt interval is 1000ms
+        if interval.rstrip().endswith("m"):
+            ms = int(interval[:-1]) * 60
+        elif interval.rstrip().endswith("h"):
+            ms = int(interval[:-1]) * 3600
+        elif interval.rstrip().endswith("s"):
+            ms = int(interval[:-1])
+        return ms * 1000
 
     def run(self):
-        self.sender(self.topic, self.sensor._create_payload(self.device_id, self.loc))
-        log.info("Transmitting data...")
+        self.report(self.sensor.stat())
 
-    def start(self):
+    def report(self, measurement):
+        """
+        Publish or batch a measurement of the sensor
+        """
+        self.readings += 1
+        batch = self.batch
+        if self.deadband and not self.deadband.changed(measurement):
+            log.info("Reading within deadband, not sent")
+        elif batch is None:
+            if self.fmt == payload.JSON:
+                message = self.sensor._create_payload(
+                    self.device_id, self.loc, measurement
+                )
+            else:
+                message = self._encode(measurement)
+            self.published += 1
+            self.sender(self.topic, message)
+            log.info("Transmitting data...")
+            return
+        else:
+            if not batch.accepts(measurement):
+                self.flush()
+            batch.add(time.time(), measurement)
+            self.published += 1
+
+        # Sent now if the next reading would be too late for the oldest
+        if batch and batch.count:
+            if batch.full() or batch.age() + self.interval > batch.max_age:
+                self.flush()
+
+    def save(self) -> list:
+        """
+        State that has to survive a deep sleep: the counters, the deadband,
+        the filter of the sensor and the batched readings
+        """
+        f = getattr(self.sensor, "filter", None)
+        return [
+            self.readings,
+            self.published,
+            self.deadband.save() if self.deadband else None,
+            f.save() if f else None,
+            self.batch.save() if self.batch else None,
+        ]
+
+    def restore(self, state):
+        (self.readings, self.published, deadband, f, batch) = state
+        if self.deadband and deadband:
+            self.deadband.restore(deadband)
+        if f and getattr(self.sensor, "filter", None):
+            self.sensor.filter.restore(f)
+        if self.batch:
+            self.batch.restore(batch, time.time())
+
+    def counters(self) -> dict:
+        """
+        Readings taken, published, suppressed by the deadband and published
+        only for its heartbeat
+        """
+        deadband = self.deadband
+        return {
+            "readings": self.readings,
+            "published": self.published,
+            "suppressed": deadband.suppressed if deadband else 0,
+            "heartbeats": deadband.heartbeats if deadband else 0,
+        }
+
+    def flush(self):
+        """
+        Publish the batched readings
+        """
+        batch = self.batch
+        if not batch or not batch.count:
+            return
+        message = batch.payload(
+            self.sensor._shared_fields(self.device_id, self.loc), self.fmt
+        )
+        log.info("Transmitting {} readings...".format(batch.count))
+        # Cleared first, a reading that fails to send is not sent again
+        batch.clear()
+        self.sender(self.topic, message)
+
+    def _encode(self, measurement):
+        """
+        One reading in a binary format
+        """
+        fields = [{"type": m["type"], "unit": m["unit"]} for m in measurement]
+        reading = [time.time()] + [m["value"] for m in measurement]
+        shared = self.sensor._shared_fields(self.device_id, self.loc)
+        return payload.encode(self.fmt, shared, fields, [reading])
+
+    def start(self, scheduler: Scheduler):
+        """
+        Take a reading every interval from a task of the scheduler
+
+        A nonblocking sensor is only told to start measuring, another task
+        polls it every POLL_MS until the measurement is in, so the other
+        tasks keep running while it measures.
+        """
         if not self.is_running:
-            self.timer = Timer(-1)
-            cb = lambda _: self.run()
-            self.timer.init(period=self.interval, mode=Timer.PERIODIC, callback=cb)
+            self.scheduler = scheduler
+            run = self._measure if self.sensor.nonblocking else self.run
+            self.task = scheduler.every(self.interval, run, self.sensor.id)
             self.is_running = True
             log.info(
                 "Started Data Logger for {} at an interval of {} ms, sending data to {}".format(
@@ -180,9 +658,29 @@ class DataLogger:
                 )
             )
 
+    def _measure(self):
+        if self.poller:
+            log.warn("Measurement still in flight, skipped")
+            return
+        self.sensor.measure()
+        self.poller = self.scheduler.every(self.POLL_MS, self._poll, "poll")
+
+    def _poll(self):
+        measurement = self.sensor.poll()
+        if measurement is not None:
+            self.scheduler.cancel(self.poller)
+            self.poller = None
+            self.report(measurement)
+
     def stop(self):
-        self.timer.deinit()
+        if self.task:
+            self.scheduler.cancel(self.task)
+            self.task = None
+        if self.poller:
+            self.scheduler.cancel(self.poller)
+            self.poller = None
         self.is_running = False
+        self.flush()
 
     @staticmethod
     def validate_topic(_type):
@@ -197,8 +695,20 @@ class DataLoggerFactory:
 
     @staticmethod
     def create(
-        id, device_id, loc, sender, topic, interval, trigger=None, *args
+        id,
+        device_id,
+        loc,
+        sender,
+        topic,
+        interval,
+        trigger=None,
+        *args,
+        batch=None,
+        fmt=payload.JSON,
+        publish=None
     ) -> DataLogger:
         sensor = DataLoggerFactory.peripherals[id](id, *args)
-        logger = DataLogger(device_id, loc, sender, interval, topic, sensor)
+        logger = DataLogger(
+            device_id, loc, sender, interval, topic, sensor, batch, fmt, publish
+        )
         return logger
@@ -0,0 +1,264 @@
+##
+#
+# Streaming filters for sensor readings that keep their state between
+# measurements
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+from array import array
+
+
+class Window:
+    """
+    The last `size` values in a ring buffer and the same values kept sorted,
+    both array("H") so values are unsigned 16 bit, e.g. distances in mm
+
+    Pushing a value is O(size) and never allocates.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ring = array("H", [0] * size)
+        self.sorted = array("H", [0] * size)
+        self.head = 0
+        self.count = 0
+
+    def push(self, value):
+        s = self.sorted
+        if self.count < self.size:
+            # The new value starts in the free slot at the end
+            i = self.count
+            self.count += 1
+        else:
+            # The new value takes the slot of the oldest value
+            old = self.ring[self.head]
+            i = 0
+            while s[i] != old:
+                i += 1
+        self.ring[self.head] = value
+        self.head = (self.head + 1) % self.size
+
+        # Move the slot to where the value belongs
+        n = self.count
+        while i > 0 and s[i - 1] > value:
+            s[i] = s[i - 1]
+            i -= 1
+        while i < n - 1 and s[i + 1] < value:
+            s[i] = s[i + 1]
+            i += 1
+        s[i] = value
+
+    def median(self) -> int:
+        s = self.sorted
+        m = self.count // 2
+        if self.count % 2:
+            return s[m]
+        return (s[m - 1] + s[m]) // 2
+
+    def mad(self, median) -> int:
+        """
+        Median absolute deviation from median, O(size): the deviations of
+        the sorted values below and above the median are two sorted runs
+        that are merged up to the middle
+        """
+        s = self.sorted
+        n = self.count
+        j = 0
+        while j < n and s[j] < median:
+            j += 1
+        i = j - 1
+
+        prev = cur = 0
+        for k in range(n // 2 + 1):
+            prev = cur
+            if j >= n or (i >= 0 and median - s[i] <= s[j] - median):
+                cur = median - s[i]
+                i -= 1
+            else:
+                cur = s[j] - median
+                j += 1
+        if n % 2:
+            return cur
+        return (prev + cur) // 2
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+
+    def save(self) -> list:
+        """
+        The values and position of the window, for restore after a deep
+        sleep
+        """
+        return [self.head, self.count, list(self.ring)]
+
+    def restore(self, state):
+        (self.head, self.count, values) = state
+        for i in range(self.size):
+            self.ring[i] = values[i]
+        # The ring holds the values from slot 0 until it is full
+        n = self.count
+        start = 0 if n < self.size else self.head
+        values = sorted(self.ring[(start + i) % self.size] for i in range(n))
+        for i in range(n):
+            self.sorted[i] = values[i]
+
+
+class MedianFilter:
+    """
+    Running median of the last `window` values
+    """
+
+    WINDOW = 5
+
+    def __init__(self, window=WINDOW):
+        self.window = Window(window)
+
+    def update(self, value) -> int:
+        self.window.push(value)
+        return self.window.median()
+
+    def reset(self):
+        self.window.reset()
+
+    def save(self):
+        return self.window.save()
+
+    def restore(self, state):
+        self.window.restore(state)
+
+
+class EmaFilter:
+    """
+    Exponential moving average in fixed point, so updates never allocate a
+    float. alpha is the weight of the newest value.
+    """
+
+    ALPHA = 0.3
+
+    # Fraction bits of the fixed point state
+    SHIFT = 8
+
+    def __init__(self, alpha=ALPHA):
+        one = 1 << self.SHIFT
+        self.alpha = min(max(int(alpha * one + 0.5), 1), one)
+        self.state = None
+
+    def update(self, value) -> int:
+        value <<= self.SHIFT
+        if self.state is None:
+            self.state = value
+        else:
+            self.state += ((value - self.state) * self.alpha) >> self.SHIFT
+        return (self.state + (1 << (self.SHIFT - 1))) >> self.SHIFT
+
+    def reset(self):
+        self.state = None
+
+    def save(self):
+        return self.state
+
+    def restore(self, state):
+        self.state = state
+
+
+class HampelFilter:
+    """
+    Hampel outlier rejection: a value further than k scaled median absolute
+    deviations from the median of the last `window` values is replaced by
+    that median. Every value enters the window, so a real step change is
+    followed once it makes up most of the window.
+    """
+
+    WINDOW = 7
+    K = 3
+
+    # Values needed in the window before any is rejected
+    MIN_COUNT = 3
+
+    def __init__(self, window=WINDOW, k=K):
+        self.window = Window(window)
+        # k times 1.4826, the MAD of normally distributed values in standard
+        # deviations, scaled by 1000 to compare in integers
+        self.threshold = int(k * 1482.6)
+
+    def update(self, value) -> int:
+        window = self.window
+        out = value
+        if window.count >= self.MIN_COUNT:
+            median = window.median()
+            deviation = value - median if value > median else median - value
+            if deviation * 1000 > self.threshold * window.mad(median):
+                out = median
+        window.push(value)
+        return out
+
+    def reset(self):
+        self.window.reset()
+
+    def save(self):
+        return self.window.save()
+
+    def restore(self, state):
+        self.window.restore(state)
+
+
+class FilterChain:
+    """
+    Filters applied in order, `value` is the last output
+    """
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.value = None
+
+    def update(self, value) -> int:
+        for f in self.filters:
+            value = f.update(value)
+        self.value = value
+        return value
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+        self.value = None
+
+    def save(self) -> list:
+        return [self.value, [f.save() for f in self.filters]]
+
+    def restore(self, state):
+        (self.value, states) = state
+        for i in range(len(self.filters)):
+            self.filters[i].restore(states[i])
+
+
+FILTERS = {
+    "median": (MedianFilter, ("window",)),
+    "ema": (EmaFilter, ("alpha",)),
+    "hampel": (HampelFilter, ("window", "k")),
+}
+
+
+def create(spec):
+    """
+    Filter chain from the "filter" parameter of a peripheral, None without
+    one. The spec is a filter name, e.g. "median", a filter with settings,
+    e.g. {"type": "hampel", "window": 7, "k": 3}, or a list of either.
+    """
+    if not spec:
+        return None
+    if type(spec) != list:
+        spec = [spec]
+
+    filters = []
+    for f in spec:
+        if type(f) != dict:
+            f = {"type": f}
+        if f.get("type") not in FILTERS:
+            raise AttributeError("Unsupported filter")
+        (cls, names) = FILTERS[f["type"]]
+        filters.append(cls(**dict((k, f[k]) for k in names if k in f)))
+    return FilterChain(filters)
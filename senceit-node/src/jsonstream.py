@@ -0,0 +1,253 @@
+##
+#
+# Incremental JSON encoding and decoding
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import json
+
+
+def iterencode(obj):
+    """
+    Yields the compact JSON encoding of obj piece by piece, so the document
+    never has to be held in memory as a whole
+
+    dicts are encoded as objects, lists, tuples and iterators, e.g. a
+    generator of records, as arrays. Any other type raises TypeError, like
+    with json.dumps.
+    """
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        yield json.dumps(obj)
+        return
+
+    if isinstance(obj, dict):
+        yield "{"
+        first = True
+        for (k, v) in obj.items():
+            if first:
+                first = False
+            else:
+                yield ","
+            yield json.dumps(k if isinstance(k, str) else str(k))
+            yield ":"
+            yield from iterencode(v)
+        yield "}"
+        return
+
+    if isinstance(obj, (list, tuple)):
+        items = obj
+    else:
+        try:
+            items = iter(obj)
+        except TypeError:
+            items = None
+        # Iterables that aren't iterators, like bytes or a set, aren't JSON
+        if items is not obj:
+            raise TypeError(
+                "Object of type {} is not JSON serializable".format(type(obj))
+            )
+
+    yield "["
+    first = True
+    for item in items:
+        if first:
+            first = False
+        else:
+            yield ","
+        yield from iterencode(item)
+    yield "]"
+
+
+class JsonDecoder:
+    """
+    Incremental JSON decoder that reads exactly `length` bytes from a stream
+    and builds the decoded value as it goes, so the raw text and the decoded
+    value are never in memory at the same time
+
+    The bytes between start and end of buf have already been received. Once
+    they are used up buf is refilled from the stream with readinto, `refills`
+    counts how often that happened. When done, `pos` is the position in buf
+    after the document.
+
+    Raises ValueError for invalid documents and documents nested deeper than
+    max_depth.
+    """
+
+    MAX_DEPTH = 10
+
+    ESCAPES = {
+        34: 34,  # "
+        92: 92,  # \
+        47: 47,  # /
+        98: 8,  # b
+        102: 12,  # f
+        110: 10,  # n
+        114: 13,  # r
+        116: 9,  # t
+    }
+    LITERALS = {116: (b"true", True), 102: (b"false", False), 110: (b"null", None)}
+    NUMBER = b"+-0123456789.eE"
+    WHITESPACE = b" \t\r\n"
+
+    def __init__(self, stream, length, buf, start=0, end=0, max_depth=MAX_DEPTH):
+        self.stream = stream
+        self.buf = buf
+        self.mv = memoryview(buf)
+        self.pos = start
+        self.end = start + min(end - start, length)
+        self.remaining = length - (self.end - start)
+        self.max_depth = max_depth
+        self.refills = 0
+
+    def decode(self):
+        value = self._value(0)
+        self._skip_whitespace()
+        if self._peek() != -1:
+            raise ValueError("Extra data after JSON document")
+        return value
+
+    def _fill(self):
+        if not self.remaining:
+            return
+        n = self.stream.readinto(self.mv[: min(len(self.buf), self.remaining)])
+        if not n:
+            raise OSError("Connection closed by client")
+        self.refills += 1
+        self.remaining -= n
+        self.pos = 0
+        self.end = n
+
+    def _peek(self):
+        if self.pos == self.end:
+            self._fill()
+            if self.pos == self.end:
+                return -1
+        return self.buf[self.pos]
+
+    def _next(self):
+        c = self._peek()
+        if c == -1:
+            raise ValueError("Unexpected end of JSON document")
+        self.pos += 1
+        return c
+
+    def _expect(self, c):
+        if self._next() != c:
+            raise ValueError("Expected '{}'".format(chr(c)))
+
+    def _skip_whitespace(self):
+        c = self._peek()
+        while c != -1 and c in self.WHITESPACE:
+            self.pos += 1
+            c = self._peek()
+
+    def _value(self, depth):
+        self._skip_whitespace()
+        c = self._peek()
+        if c == 123 or c == 91:  # { or [
+            if depth >= self.max_depth:
+                raise ValueError("JSON document nested too deep")
+            return self._object(depth + 1) if c == 123 else self._array(depth + 1)
+        if c == 34:  # "
+            return self._string()
+        if c in self.LITERALS:
+            return self._literal(c)
+        if c != -1 and c in self.NUMBER:
+            return self._number()
+        raise ValueError("Unexpected character in JSON document")
+
+    def _object(self, depth):
+        self._next()
+        obj = {}
+        self._skip_whitespace()
+        if self._peek() == 125:  # }
+            self._next()
+            return obj
+
+        while True:
+            self._skip_whitespace()
+            if self._peek() != 34:
+                raise ValueError("Expected object key")
+            key = self._string()
+            self._skip_whitespace()
+            self._expect(58)  # :
+            obj[key] = self._value(depth)
+            self._skip_whitespace()
+            c = self._next()
+            if c == 125:
+                return obj
+            if c != 44:  # ,
+                raise ValueError("Expected ',' or '}'")
+
+    def _array(self, depth):
+        self._next()
+        arr = []
+        self._skip_whitespace()
+        if self._peek() == 93:  # ]
+            self._next()
+            return arr
+
+        while True:
+            arr.append(self._value(depth))
+            self._skip_whitespace()
+            c = self._next()
+            if c == 93:
+                return arr
+            if c != 44:
+                raise ValueError("Expected ',' or ']'")
+
+    def _string(self):
+        self._next()
+        out = bytearray()
+        while True:
+            c = self._next()
+            if c == 34:
+                return str(out, "utf-8")
+            if c == 92:  # \
+                c = self._next()
+                if c == 117:  # u
+                    out.extend(chr(self._unicode_escape()).encode("utf-8"))
+                elif c in self.ESCAPES:
+                    out.append(self.ESCAPES[c])
+                else:
+                    raise ValueError("Invalid escape in JSON string")
+            elif c < 32:
+                raise ValueError("Invalid control character in JSON string")
+            else:
+                out.append(c)
+
+    def _unicode_escape(self):
+        code = self._hex4()
+        if 0xD800 <= code < 0xDC00:
+            # Surrogate pair
+            self._expect(92)
+            self._expect(117)
+            low = self._hex4()
+            code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+        return code
+
+    def _hex4(self):
+        return int(bytes([self._next() for i in range(4)]), 16)
+
+    def _literal(self, c):
+        (text, value) = self.LITERALS[c]
+        for expected in text:
+            if self._next() != expected:
+                raise ValueError("Invalid JSON literal")
+        return value
+
+    def _number(self):
+        out = bytearray()
+        c = self._peek()
+        while c != -1 and c in self.NUMBER:
+            out.append(c)
+            self.pos += 1
+            c = self._peek()
+
+        text = str(out, "ascii")
+        if "." in text or "e" in text or "E" in text:
+            return float(text)
+        return int(text)
@@ -19,8 +19,18 @@ if CONFIG_MODE:
     log.info("Running app in config mode")
 
 else:
-    import app_run as app
+    import machine
 
-    log.info("Running app in run mode")
+    if machine.reset_cause() == machine.DEEPSLEEP_RESET:
+        # Fast path, only the deep sleep run mode sleeps. The radio goes off
+        # before anything else is loaded, see app_sleep.radio_off
+        import network
+
+        network.WLAN(network.STA_IF).active(False)
+        import app_sleep as app
+    else:
+        import app_run as app
+
+        log.info("Running app in run mode")
 
 app.main()
@@ -0,0 +1,223 @@
+##
+#
+# Per-route request metrics of the HTTP server
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+from array import array
+
+from util import mem_free
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket bounds, the counts are kept in an array so
+    observing a value never allocates
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bound plus one for values above the last bound
+        self.counts = array("L", [0] * (len(bounds) + 1))
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative(self):
+        """
+        Yields (bound, count of values <= bound), the last bound is None
+        """
+        total = 0
+        for i in range(len(self.counts)):
+            total += self.counts[i]
+            yield (self.bounds[i] if i < len(self.bounds) else None, total)
+
+
+class RouteMetrics:
+    """
+    Metrics of the requests served by one route
+    """
+
+    def __init__(self):
+        self.latency = Histogram(Metrics.LATENCY_BUCKETS)
+        self.alloc = Histogram(Metrics.ALLOC_BUCKETS)
+        # Responses by status class, 1xx to 5xx
+        self.status = array("L", [0] * 5)
+        self.bytes = 0
+
+
+class Metrics:
+    """
+    Request metrics collected by the web servers and exported at /metrics
+
+    Each request is recorded under the label of the route that handled it.
+    Routes are limited to max_routes, later routes are recorded as "other",
+    so the memory used is bounded no matter what clients send.
+    """
+
+    # Request wall time in microseconds
+    LATENCY_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 250000, 1000000)
+
+    # Drop in free heap in bytes while serving a request
+    ALLOC_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384)
+
+    MAX_ROUTES = 12
+
+    # Labels of requests that no route handled
+    OTHER = "other"
+    UNMATCHED = "unmatched"
+    INVALID = "invalid"
+
+    PREFIX = "senceit_"
+
+    def __init__(self, max_routes=MAX_ROUTES):
+        self.max_routes = max_routes
+        self.routes = {}
+        # Requests refused by admission control
+        self.shed = 0
+        self.memory_errors = 0
+        # Lowest free heap seen after a request
+        self.min_free = None
+
+    def record(self, label, status, elapsed_us, free_before, size):
+        """
+        Record a served request, free_before is the free heap in bytes before
+        the request was read or None if the port can't tell
+        """
+        route = self.routes.get(label)
+        if route is None:
+            if len(self.routes) >= self.max_routes:
+                label = self.OTHER
+                route = self.routes.get(label)
+            if route is None:
+                route = RouteMetrics()
+                self.routes[label] = route
+
+        route.latency.observe(elapsed_us)
+        route.status[min(max(status // 100, 1), 5) - 1] += 1
+        route.bytes += size
+
+        free = mem_free()
+        if free is not None and free_before is not None:
+            # The heap grows when a collection ran during the request
+            route.alloc.observe(max(free_before - free, 0))
+            if self.min_free is None or free < self.min_free:
+                self.min_free = free
+
+    def prometheus(self):
+        """
+        Yields the metrics in the Prometheus text exposition format
+        """
+        p = self.PREFIX
+        yield "# TYPE {}http_requests_total counter\n".format(p)
+        for (label, route) in self.routes.items():
+            for i in range(5):
+                if route.status[i]:
+                    yield '{}http_requests_total{{route="{}",code="{}xx"}} {}\n'.format(
+                        p, label, i + 1, route.status[i]
+                    )
+
+        yield "# TYPE {}http_response_bytes_total counter\n".format(p)
+        for (label, route) in self.routes.items():
+            yield '{}http_response_bytes_total{{route="{}"}} {}\n'.format(
+                p, label, route.bytes
+            )
+
+        name = p + "http_request_duration_seconds"
+        yield "# TYPE {} histogram\n".format(name)
+        for (label, route) in self.routes.items():
+            for line in self._histogram(name, label, route.latency, 1000000):
+                yield line
+
+        name = p + "http_request_alloc_bytes"
+        yield "# TYPE {} histogram\n".format(name)
+        for (label, route) in self.routes.items():
+            if route.alloc.count():
+                for line in self._histogram(name, label, route.alloc, 1):
+                    yield line
+
+        yield "# TYPE {}http_shed_total counter\n".format(p)
+        yield "{}http_shed_total {}\n".format(p, self.shed)
+        yield "# TYPE {}memory_errors_total counter\n".format(p)
+        yield "{}memory_errors_total {}\n".format(p, self.memory_errors)
+
+        free = mem_free()
+        if free is not None:
+            yield "# TYPE {}heap_free_bytes gauge\n".format(p)
+            yield "{}heap_free_bytes {}\n".format(p, free)
+        if self.min_free is not None:
+            yield "# TYPE {}heap_free_min_bytes gauge\n".format(p)
+            yield "{}heap_free_min_bytes {}\n".format(p, self.min_free)
+
+    def _histogram(self, name, label, histogram, scale):
+        for (bound, count) in histogram.cumulative():
+            le = "+Inf" if bound is None else str(bound / scale if scale > 1 else bound)
+            yield '{}_bucket{{route="{}",le="{}"}} {}\n'.format(name, label, le, count)
+        total = histogram.sum / scale if scale > 1 else histogram.sum
+        yield '{}_sum{{route="{}"}} {}\n'.format(name, label, total)
+        yield '{}_count{{route="{}"}} {}\n'.format(name, label, histogram.count())
+
+    def json(self) -> dict:
+        routes = {}
+        for (label, route) in self.routes.items():
+            routes[label] = {
+                "requests": route.latency.count(),
+                "status": dict(
+                    ("{}xx".format(i + 1), route.status[i])
+                    for i in range(5)
+                    if route.status[i]
+                ),
+                "bytes": route.bytes,
+                "latency_us": {
+                    "buckets": list(route.latency.bounds),
+                    "counts": list(route.latency.counts),
+                    "sum": route.latency.sum,
+                },
+                "alloc_bytes": {
+                    "buckets": list(route.alloc.bounds),
+                    "counts": list(route.alloc.counts),
+                    "sum": route.alloc.sum,
+                },
+            }
+        return {
+            "routes": routes,
+            "shed": self.shed,
+            "memory_errors": self.memory_errors,
+            "heap_free": mem_free(),
+            "heap_free_min": self.min_free,
+        }
+
+
+class CountingWriter:
+    """
+    Passes writes on to a socket and counts the bytes written, reused for
+    every response
+    """
+
+    def __init__(self):
+        self.dest = None
+        self.count = 0
+
+    def wrap(self, dest):
+        self.dest = dest
+        self.count = 0
+        return self
+
+    def write(self, buf):
+        n = self.dest.write(buf)
+        if n:
+            self.count += n
+        return n
@@ -0,0 +1,332 @@
+##
+#
+# Store and forward of MQTT messages that could not be published
+#
+# Messages are kept in a ring log on flash, one file of fixed size slots
+# behind a small binary header, and replayed in rate limited bursts once the
+# broker is back.
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import struct
+
+from util import Logger, ticks_ms, ticks_diff
+
+log = Logger.getLogger()
+
+
+class RingLog:
+    """
+    Append-only ring of fixed size records in a preallocated file
+
+    The header holds the read (head) and write (tail) sequence numbers,
+    record i lives in slot i % capacity and starts with its sequence number.
+    When the ring is full the oldest record is overwritten.
+
+    Flash wear is bounded: the file never grows or moves, every slot is
+    rewritten once per `capacity` appends, and the header is only rewritten
+    every `sync` appends and once per replayed burst. The records written
+    since the last header sync are found again on open by their sequence
+    numbers, so a reset loses none of them. A reset before a burst is
+    committed replays it again, a message is sent at least once.
+    """
+
+    MAGIC = b"SNQ1"
+    # magic, record size, capacity, head, tail
+    HEADER = "<4sHHLL"
+    HEADER_SIZE = struct.calcsize(HEADER)
+    # sequence number, topic length, message length
+    RECORD = "<LBH"
+    RECORD_SIZE = 512
+    CAPACITY = 128
+    # Appends between header writes
+    SYNC = 8
+
+    def __init__(self, path, record_size=RECORD_SIZE, capacity=CAPACITY, sync=SYNC):
+        self.path = path
+        self.record_size = record_size
+        self.capacity = capacity
+        self.sync = sync
+        self.buf = bytearray(record_size)
+        self.head = 0
+        self.tail = 0
+        # Tail at the last header write
+        self.synced = 0
+        # Records overwritten before they were replayed
+        self.dropped = 0
+        self.header_writes = 0
+        self.record_writes = 0
+        self.file = None
+
+    def open(self):
+        try:
+            self.file = open(self.path, "r+b")
+            header = self.file.read(self.HEADER_SIZE)
+        except OSError:
+            header = b""
+        if len(header) == self.HEADER_SIZE:
+            (magic, size, capacity, head, tail) = struct.unpack(self.HEADER, header)
+            if (magic, size, capacity) == (self.MAGIC, self.record_size, self.capacity):
+                self.head = head
+                self.tail = tail
+                self.synced = tail
+                self._recover()
+                return self
+        self._create()
+        return self
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, topic: str, message):
+        """
+        Store a message, raises ValueError if it doesn't fit in a record
+        """
+        topic = topic.encode()
+        if isinstance(message, str):
+            message = message.encode()
+        start = struct.calcsize(self.RECORD)
+        end = start + len(topic) + len(message)
+        if end > self.record_size or len(topic) > 255:
+            raise ValueError("Message too large for the log")
+
+        buf = self.buf
+        struct.pack_into(self.RECORD, buf, 0, self.tail, len(topic), len(message))
+        buf[start : start + len(topic)] = topic
+        buf[start + len(topic) : end] = message
+        self._seek(self.tail)
+        self.file.write(memoryview(buf)[:end])
+        self.record_writes += 1
+
+        self.tail += 1
+        if self.tail - self.head > self.capacity:
+            self.head = self.tail - self.capacity
+            self.dropped += 1
+        if self.tail - self.synced >= self.sync:
+            self._write_header()
+        self.file.flush()
+
+    def peek(self, n):
+        """
+        Yields (sequence number, topic, message) of up to n records from the
+        head, records that can't be read are skipped
+        """
+        seq = self.head
+        end = min(self.tail, self.head + n)
+        while seq < end:
+            record = self._read(seq)
+            if record:
+                yield (seq, record[0], record[1])
+            seq += 1
+
+    def commit(self, n):
+        """
+        Drop n records from the head, after they were sent
+        """
+        self.head = min(self.head + n, self.tail)
+        self._write_header()
+        self.file.flush()
+
+    def flush(self):
+        if self.synced != self.tail:
+            self._write_header()
+        self.file.flush()
+
+    def _create(self):
+        if self.file:
+            self.file.close()
+        self.file = open(self.path, "wb")
+        self.head = self.tail = 0
+        self._write_header()
+        # Preallocated so appends never grow the file, filled like erased
+        # flash so no slot holds a valid sequence number
+        erased = b"\xff" * self.record_size
+        for i in range(self.capacity):
+            self.file.write(erased)
+        self.file.close()
+        self.file = open(self.path, "r+b")
+
+    def _recover(self):
+        """
+        Find the records appended after the last header write
+        """
+        head = struct.calcsize(self.RECORD)
+        while True:
+            self._seek(self.tail)
+            data = self.file.read(head)
+            if len(data) < head or struct.unpack(self.RECORD, data)[0] != self.tail:
+                break
+            self.tail += 1
+        if self.tail - self.head > self.capacity:
+            self.dropped += self.tail - self.head - self.capacity
+            self.head = self.tail - self.capacity
+
+    def _read(self, seq):
+        self._seek(seq)
+        n = self.file.readinto(self.buf)
+        start = struct.calcsize(self.RECORD)
+        if n < start:
+            return None
+        (s, topic, message) = struct.unpack_from(self.RECORD, self.buf)
+        # A slot that doesn't hold the record was overwritten or never written
+        if s != seq or start + topic + message > n:
+            return None
+        buf = self.buf
+        return (
+            bytes(buf[start : start + topic]).decode(),
+            bytes(buf[start + topic : start + topic + message]),
+        )
+
+    def _seek(self, seq):
+        slot = seq % self.capacity
+        self.file.seek(self.HEADER_SIZE + slot * self.record_size)
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(
+            struct.pack(
+                self.HEADER,
+                self.MAGIC,
+                self.record_size,
+                self.capacity,
+                self.head,
+                self.tail,
+            )
+        )
+        self.synced = self.tail
+        self.header_writes += 1
+
+
+class Outbox:
+    """
+    Publishes messages, or stores them in the ring log while the broker
+    can't be reached
+
+    Messages are queued behind stored ones, so the broker gets them in
+    order. replay() reconnects at most every `retry_ms` and then sends up to
+    `burst` stored messages every `interval_ms`, so the backlog doesn't
+    flood the broker or keep the radio busy on reconnect.
+    """
+
+    BURST = 8
+    INTERVAL_MS = 2000
+    RETRY_MS = 30000
+
+    def __init__(
+        self,
+        publish,
+        connect,
+        ring: RingLog,
+        burst=BURST,
+        interval_ms=INTERVAL_MS,
+        retry_ms=RETRY_MS,
+    ):
+        self.publish = publish
+        self.connect = connect
+        self.ring = ring
+        self.burst = burst
+        self.interval_ms = interval_ms
+        self.retry_ms = retry_ms
+        self.online = True
+        # ticks_ms of the last burst or reconnect attempt
+        self.last = ticks_ms()
+        self.sent = 0
+        self.stored = 0
+        self.replayed = 0
+
+    def send(self, topic, message):
+        """
+        The sender of the data loggers
+        """
+        if self.online and not len(self.ring):
+            try:
+                self.publish(topic, message)
+                self.sent += 1
+                return
+            except OSError as err:
+                log.severe("Could not publish, storing message: " + str(err))
+                self.offline()
+        try:
+            self.ring.append(topic, message)
+            self.stored += 1
+        except ValueError as err:
+            log.severe("Could not store message: " + str(err))
+
+    def offline(self):
+        if self.online:
+            self.online = False
+            self.last = ticks_ms()
+
+    def replay(self) -> int:
+        """
+        Reconnect or send the next burst of stored messages when due,
+        returns the number of messages sent
+        """
+        now = ticks_ms()
+        if not self.online:
+            if ticks_diff(now, self.last) < self.retry_ms:
+                return 0
+            self.last = now
+            try:
+                self.connect()
+            except OSError as err:
+                log.severe("Could not reconnect: " + str(err))
+                return 0
+            log.info("Reconnected, {} stored messages".format(len(self.ring)))
+            self.online = True
+        elif ticks_diff(now, self.last) < self.interval_ms:
+            return 0
+
+        ring = self.ring
+        if not len(ring):
+            return 0
+        self.last = now
+        # Records up to the last one sent are dropped from the log
+        done = 0
+        n = 0
+        try:
+            for (seq, topic, message) in ring.peek(self.burst):
+                done = seq - ring.head
+                self.publish(topic, message)
+                n += 1
+            done = min(self.burst, len(ring))
+        except OSError as err:
+            log.severe("Could not replay: " + str(err))
+            self.offline()
+        if done:
+            ring.commit(done)
+        self.replayed += n
+        return n
+
+    def counters(self) -> dict:
+        return {
+            "sent": self.sent,
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "queued": len(self.ring),
+            "dropped": self.ring.dropped,
+        }
+
+
+def open_outbox(settings: dict, publish, connect, **kwargs) -> Outbox:
+    """
+    Outbox with the ring log of the "outbox" config
+    """
+    ring = RingLog(
+        settings.get("path", "outbox.log"),
+        settings.get("record_size", RingLog.RECORD_SIZE),
+        settings.get("capacity", RingLog.CAPACITY),
+    ).open()
+    log.info("{} stored messages to replay".format(len(ring)))
+    return Outbox(
+        publish, connect, ring, settings.get("burst", Outbox.BURST), **kwargs
+    )
@@ -0,0 +1,369 @@
+##
+#
+# Telemetry payload formats: JSON, minimal CBOR and a fixed struct layout
+#
+# Every format carries the same document: the fields shared by all readings
+# of a sensor, the type and unit of each value and a list of measurements
+# [timestamp, value, ...]. The binary formats start with a schema byte, the
+# format in the high and the schema version in the low nibble, so `decode`
+# can tell them apart from JSON, which starts with "{".
+#
+# The decoder is pure Python and runs on the node and on the ctrl side.
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+import json
+import struct
+
+JSON = "json"
+CBOR = "cbor"
+STRUCT = "struct"
+FORMATS = (JSON, CBOR, STRUCT)
+
+VERSION = 1
+STRUCT_SCHEMA = 0x10 | VERSION
+CBOR_SCHEMA = 0x20 | VERSION
+
+# Type and unit of the values by code, values of any other type or unit are
+# sent with their names in CBOR and can't be sent in the struct layout
+FIELDS = (
+    ("Level", "mm"),
+    ("Level", "%"),
+    ("Level", "liter"),
+    ("Samples", "count"),
+    ("Spread", "mm"),
+)
+
+# schema, device_id, peripheral_id, type, lon, lat, field count, measurement
+# count, followed by a code per field and per measurement a timestamp and
+# the values
+STRUCT_HEADER = "<B8s8s12sffBB"
+# Integer values only, None is sent as the smallest int32
+STRUCT_NONE = -0x80000000
+
+
+def encode(fmt, shared: dict, fields, measurements):
+    """
+    Encode measurements [timestamp, value, ...] with the shared fields of
+    the sensor and the type and unit of each value
+    """
+    if fmt == JSON:
+        doc = dict(shared)
+        doc["fields"] = fields
+        doc["measurements"] = measurements
+        return json.dumps(doc)
+    if fmt == CBOR:
+        return encode_cbor(shared, fields, measurements)
+    if fmt == STRUCT:
+        return encode_struct(shared, fields, measurements)
+    raise ValueError("Unsupported payload format")
+
+
+def decode(data) -> dict:
+    """
+    The document of a payload in any of the formats, as the JSON format
+    """
+    if isinstance(data, str):
+        return json.loads(data)
+    if not data:
+        raise ValueError("Empty payload")
+    if data[0] == STRUCT_SCHEMA:
+        return decode_struct(data)
+    if data[0] == CBOR_SCHEMA:
+        return decode_cbor(data)
+    if data[0] == 0x7B:  # {
+        return json.loads(data)
+    raise ValueError("Unsupported payload schema {}".format(data[0]))
+
+
+def readings(doc: dict) -> list:
+    """
+    The readings of a decoded document one by one, each with a timestamp
+    and a list of {"type", "unit", "value"}
+    """
+    out = []
+    fields = doc["fields"]
+    for m in doc["measurements"]:
+        values = []
+        for i in range(len(fields)):
+            value = {"type": fields[i]["type"], "unit": fields[i]["unit"]}
+            value["value"] = m[i + 1]
+            values.append(value)
+        out.append({"timestamp": m[0], "measurement": values})
+    return out
+
+
+def _field_code(field):
+    key = (field["type"], field["unit"])
+    for i in range(len(FIELDS)):
+        if FIELDS[i] == key:
+            return i
+    return None
+
+
+def _field(code):
+    (_type, unit) = FIELDS[code]
+    return {"type": _type, "unit": unit}
+
+
+# CBOR, RFC 8949: unsigned and negative integers, text strings, arrays,
+# maps, float32, false, true and null
+
+
+def encode_cbor(shared: dict, fields, measurements) -> bytes:
+    """
+    [device_id, peripheral_id, type, lon, lat, fields, measurements] after
+    the schema byte, known fields as their code
+    """
+    out = bytearray([CBOR_SCHEMA])
+    loc = shared["location"]
+    _cbor_head(out, 4, 7)
+    _cbor(out, shared["device_id"])
+    _cbor(out, shared["peripheral_id"])
+    _cbor(out, shared["type"])
+    _cbor(out, loc["lon"])
+    _cbor(out, loc["lat"])
+
+    _cbor_head(out, 4, len(fields))
+    for field in fields:
+        code = _field_code(field)
+        if code is None:
+            _cbor(out, [field["type"], field["unit"]])
+        else:
+            _cbor_head(out, 0, code)
+
+    _cbor_head(out, 4, len(measurements))
+    for m in measurements:
+        _cbor_head(out, 4, len(m))
+        _cbor_head(out, 0, int(m[0]))
+        for i in range(1, len(m)):
+            _cbor(out, m[i])
+    return bytes(out)
+
+
+def _cbor_head(out, major, n):
+    major <<= 5
+    if n < 24:
+        out.append(major | n)
+    elif n < 0x100:
+        out.append(major | 24)
+        out.append(n)
+    elif n < 0x10000:
+        out.append(major | 25)
+        out.extend(struct.pack(">H", n))
+    elif n < 0x100000000:
+        out.append(major | 26)
+        out.extend(struct.pack(">I", n))
+    else:
+        out.append(major | 27)
+        out.extend(struct.pack(">Q", n))
+
+
+def _cbor(out, value):
+    if value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            _cbor_head(out, 0, value)
+        else:
+            _cbor_head(out, 1, -1 - value)
+    elif isinstance(value, float):
+        out.append(0xFA)
+        out.extend(struct.pack(">f", value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        _cbor_head(out, 3, len(data))
+        out.extend(data)
+    elif isinstance(value, dict):
+        _cbor_head(out, 5, len(value))
+        for (k, v) in value.items():
+            _cbor(out, k)
+            _cbor(out, v)
+    elif isinstance(value, (list, tuple)):
+        _cbor_head(out, 4, len(value))
+        for item in value:
+            _cbor(out, item)
+    else:
+        raise TypeError("Can't encode {} as CBOR".format(type(value)))
+
+
+def decode_cbor(data) -> dict:
+    (doc, pos) = cbor_loads(data, 1)
+    if pos != len(data) or type(doc) != list or len(doc) != 7:
+        raise ValueError("Invalid CBOR payload")
+    (device_id, peripheral_id, _type, lon, lat, codes, measurements) = doc
+    fields = []
+    for code in codes:
+        if type(code) == list:
+            fields.append({"type": code[0], "unit": code[1]})
+        else:
+            fields.append(_field(code))
+    return {
+        "device_id": device_id,
+        "peripheral_id": peripheral_id,
+        "type": _type,
+        "location": {"lon": lon, "lat": lat},
+        "fields": fields,
+        "measurements": measurements,
+    }
+
+
+def cbor_dumps(value, out=None) -> bytearray:
+    """
+    Appends the CBOR encoding of value to out, a new bytearray by default
+    """
+    if out is None:
+        out = bytearray()
+    _cbor(out, value)
+    return out
+
+
+def cbor_loads(data, pos=0):
+    """
+    Decodes the CBOR item at pos, returns (value, position after it)
+    """
+    if pos >= len(data):
+        raise ValueError("Truncated CBOR payload")
+    initial = data[pos]
+    pos += 1
+    major = initial >> 5
+    info = initial & 0x1F
+
+    if major == 7:
+        if info == 20:
+            return (False, pos)
+        if info == 21:
+            return (True, pos)
+        if info == 22:
+            return (None, pos)
+        if info == 26:
+            return (struct.unpack(">f", data[pos : pos + 4])[0], pos + 4)
+        if info == 27:
+            return (struct.unpack(">d", data[pos : pos + 8])[0], pos + 8)
+        raise ValueError("Unsupported CBOR simple value")
+
+    if info < 24:
+        n = info
+    elif info < 28:
+        size = 1 << (info - 24)
+        if pos + size > len(data):
+            raise ValueError("Truncated CBOR payload")
+        n = int.from_bytes(data[pos : pos + size], "big")
+        pos += size
+    else:
+        raise ValueError("Unsupported CBOR length")
+
+    if major == 0:
+        return (n, pos)
+    if major == 1:
+        return (-1 - n, pos)
+    if major == 2 or major == 3:
+        if pos + n > len(data):
+            raise ValueError("Truncated CBOR payload")
+        value = bytes(data[pos : pos + n])
+        return (value if major == 2 else value.decode("utf-8"), pos + n)
+    if major == 4:
+        items = []
+        for i in range(n):
+            (item, pos) = cbor_loads(data, pos)
+            items.append(item)
+        return (items, pos)
+    if major == 5:
+        obj = {}
+        for i in range(n):
+            (k, pos) = cbor_loads(data, pos)
+            (obj[k], pos) = cbor_loads(data, pos)
+        return (obj, pos)
+    raise ValueError("Unsupported CBOR type")
+
+
+# Fixed struct layout
+
+
+def encode_struct(shared: dict, fields, measurements) -> bytes:
+    codes = []
+    for field in fields:
+        code = _field_code(field)
+        if code is None:
+            raise ValueError("Field not in the struct schema")
+        codes.append(code)
+    if len(codes) > 255 or len(measurements) > 255:
+        raise ValueError("Too many fields or measurements")
+
+    header = struct.calcsize(STRUCT_HEADER)
+    row = "<I" + "i" * len(codes)
+    buf = bytearray(header + len(codes) + len(measurements) * struct.calcsize(row))
+    loc = shared["location"]
+    struct.pack_into(
+        STRUCT_HEADER,
+        buf,
+        0,
+        STRUCT_SCHEMA,
+        shared["device_id"].encode(),
+        shared["peripheral_id"].encode(),
+        shared["type"].encode(),
+        # The web UI saves the location as strings
+        float(loc["lon"]),
+        float(loc["lat"]),
+        len(codes),
+        len(measurements),
+    )
+    pos = header
+    for code in codes:
+        buf[pos] = code
+        pos += 1
+    for m in measurements:
+        struct.pack_into("<I", buf, pos, int(m[0]))
+        pos += 4
+        for i in range(1, len(m)):
+            value = m[i]
+            if value is None:
+                value = STRUCT_NONE
+            elif not isinstance(value, int):
+                raise ValueError("The struct layout holds integer values only")
+            struct.pack_into("<i", buf, pos, value)
+            pos += 4
+    return bytes(buf)
+
+
+def decode_struct(data) -> dict:
+    header = struct.calcsize(STRUCT_HEADER)
+    if len(data) < header:
+        raise ValueError("Truncated struct payload")
+    (_, device_id, peripheral_id, _type, lon, lat, nfields, count) = struct.unpack(
+        STRUCT_HEADER, data[:header]
+    )
+    row = "<I" + "i" * nfields
+    size = struct.calcsize(row)
+    if len(data) != header + nfields + count * size:
+        raise ValueError("Invalid struct payload length")
+
+    fields = [_field(code) for code in data[header : header + nfields]]
+    measurements = []
+    pos = header + nfields
+    for i in range(count):
+        m = list(struct.unpack(row, data[pos : pos + size]))
+        for j in range(1, len(m)):
+            if m[j] == STRUCT_NONE:
+                m[j] = None
+        measurements.append(m)
+        pos += size
+    return {
+        "device_id": _text(device_id),
+        "peripheral_id": _text(peripheral_id),
+        "type": _text(_type),
+        "location": {"lon": lon, "lat": lat},
+        "fields": fields,
+        "measurements": measurements,
+    }
+
+
+def _text(data) -> str:
+    return data.rstrip(b"\0").decode("utf-8")
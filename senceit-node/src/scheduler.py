@@ -0,0 +1,219 @@
+##
+#
+# Cooperative scheduler for the periodic work of the node, run from the
+# main loop instead of timer callbacks
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+##
+
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+
+from util import Logger, ticks_ms, ticks_diff
+
+log = Logger.getLogger()
+
+# Task priorities, due tasks run highest priority first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+
+class Task:
+    """
+    A callback run every `period` milliseconds, or once if period is 0
+    """
+
+    def __init__(self, name, callback, period, priority, budget):
+        self.name = name
+        self.callback = callback
+        self.period = period
+        self.priority = priority
+        # Milliseconds a run may take before it counts as an overrun
+        self.budget = budget
+        # Scheduler time of the next run
+        self.deadline = 0
+        self.cancelled = False
+        self.runs = 0
+        # Runs that took longer than budget and periods that were skipped
+        self.overruns = 0
+        self.skipped = 0
+        # Largest delay in ms of a run after its deadline
+        self.max_late = 0
+
+    def json(self) -> dict:
+        return {
+            "period": self.period,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "max_late": self.max_late,
+        }
+
+
+class Scheduler:
+    """
+    Runs tasks at their deadlines from a min-heap ordered by deadline
+
+    Deadlines are kept in milliseconds since the scheduler started,
+    advanced with ticks_diff so they are safe across the ticks_ms wrap
+    around. A periodic task's next deadline is its last deadline plus the
+    period, not the end of its run, so the delay of one run never shifts
+    the later ones. A task that falls more than a period behind skips the
+    missed runs rather than running them back to back.
+
+    Due tasks run highest priority first, then by deadline. A task that
+    runs longer than its budget, or misses a period, counts an overrun.
+    """
+
+    # Longest sleep in run_forever, so the loop notices new tasks
+    MAX_SLEEP = 1000
+
+    # Default budget of a task, of one-shot tasks in particular
+    BUDGET = 1000
+
+    # Scheduler time is rebased before it leaves the small int range
+    REBASE = 1 << 28
+
+    def __init__(self, clock=ticks_ms):
+        self.clock = clock
+        self.heap = []
+        self.tasks = []
+        self.last = clock()
+        self.time = 0
+        self.seq = 0
+
+    def every(
+        self, period, callback, name=None, priority=NORMAL, delay=None, budget=None
+    ) -> Task:
+        """
+        Run callback every period milliseconds, the first time after delay,
+        one period by default
+        """
+        task = Task(name, callback, period, priority, budget or period)
+        self._add(task, period if delay is None else delay)
+        return task
+
+    def after(self, delay, callback, name=None, priority=NORMAL) -> Task:
+        """
+        Run callback once after delay milliseconds
+        """
+        task = Task(name, callback, 0, priority, self.BUDGET)
+        self._add(task, delay)
+        return task
+
+    def cancel(self, task: Task):
+        # Left in the heap, it is dropped when it comes due
+        task.cancelled = True
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def now(self) -> int:
+        """
+        Milliseconds since the scheduler started
+        """
+        t = self.clock()
+        self.time += ticks_diff(t, self.last)
+        self.last = t
+        return self.time
+
+    def next_delay(self):
+        """
+        Milliseconds until the next task is due, None without tasks
+        """
+        heap = self.heap
+        while heap and heap[0][3].cancelled:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(heap[0][0] - self.now(), 0)
+
+    def run_pending(self) -> int:
+        """
+        Run the due tasks, returns the number of tasks run
+        """
+        now = self.now()
+        if now >= self.REBASE:
+            self._rebase()
+            now = 0
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if not entry[3].cancelled:
+                due.append(entry)
+        if not due:
+            return 0
+        # (priority, deadline, seq) orders the due tasks
+        due.sort(key=lambda e: (e[1], e[0], e[2]))
+        n = 0
+        for entry in due:
+            # An earlier task may have cancelled it
+            if not entry[3].cancelled:
+                self._run(entry[3])
+                n += 1
+        return n
+
+    def run_forever(self, sleep_ms):
+        """
+        Run tasks as they come due, sleeping with sleep_ms in between
+        """
+        while True:
+            self.run_pending()
+            delay = self.next_delay()
+            sleep_ms(self.MAX_SLEEP if delay is None else min(delay, self.MAX_SLEEP))
+
+    def json(self) -> dict:
+        return dict((t.name, t.json()) for t in self.tasks if t.name)
+
+    def _add(self, task: Task, delay):
+        task.deadline = self.now() + delay
+        self.tasks.append(task)
+        self._push(task)
+
+    def _push(self, task: Task):
+        self.seq += 1
+        heapq.heappush(self.heap, (task.deadline, task.priority, self.seq, task))
+
+    def _run(self, task: Task):
+        start = self.now()
+        late = start - task.deadline
+        if late > task.max_late:
+            task.max_late = late
+        try:
+            task.callback()
+        except Exception as err:
+            log.severe("Task {} failed: {}".format(task.name, err))
+        task.runs += 1
+        took = self.now() - start
+        if took > task.budget:
+            task.overruns += 1
+            log.warn("Task {} overran: {} ms".format(task.name, took))
+
+        if task.cancelled:
+            return
+        if not task.period:
+            self.cancel(task)
+            return
+        task.deadline += task.period
+        behind = self.now() - task.deadline
+        if behind >= task.period:
+            # Missed whole periods, the next run stays on the period grid
+            missed = behind // task.period
+            task.deadline += missed * task.period
+            task.skipped += missed
+            task.overruns += 1
+            log.warn("Task {} skipped {} runs".format(task.name, missed))
+        self._push(task)
+
+    def _rebase(self):
+        base = self.time
+        self.time = 0
+        for task in self.tasks:
+            task.deadline -= base
+        self.heap = [(e[0] - base, e[1], e[2], e[3]) for e in self.heap]
+        heapq.heapify(self.heap)
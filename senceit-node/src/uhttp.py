@@ -8,22 +8,324 @@
 import os
 import json
 import gc
+import errno
 
-from util import StringBuilder, Logger
+from jsonstream import iterencode, JsonDecoder
+from metrics import Metrics
+from util import StringBuilder, Logger, mem_free
 
 log = Logger.getLogger()
 
 
+def write_all(dest, buf):
+    """
+    Write the whole buffer, a socket may accept only part of it per write
+    """
+    mv = memoryview(buf)
+    n = dest.write(mv)
+    sent = n if n else 0
+    while sent < len(mv):
+        n = dest.write(mv[sent:])
+        # A non-blocking socket returns None when it would block
+        if n:
+            sent += n
+
+
 class Stream:
-    def __init__(self, src):
+    """
+    File body of a response, copied to the socket through one buffer that is
+    shared by all streams and allocated on first use
+
+    Only `length` bytes from `start` are sent if given, the rest of the file
+    is never read.
+    """
+
+    # The chunk size is picked from the free heap when the buffer is allocated
+    MIN_CHUNK = 256
+    MAX_CHUNK = 2048
+    HEAP_FRACTION = 16
+
+    _buffer = None
+
+    def __init__(self, src, start=0, length=None):
         self.src = src
+        self.start = start
+        self.length = length
+
+    @classmethod
+    def buffer(cls) -> bytearray:
+        if cls._buffer is None:
+            free = mem_free()
+            size = cls.MAX_CHUNK
+            if free is not None:
+                size = max(cls.MIN_CHUNK, min(cls.MAX_CHUNK, free // cls.HEAP_FRACTION))
+            cls._buffer = bytearray(size)
+        return cls._buffer
+
+    def pipe(self, dest, head=None):
+        """
+        Copy the file to dest. If given, head (the response headers) is
+        written together with the first chunk of the file.
+        """
+        buf = Stream.buffer()
+        offset = 0
+        if head:
+            if len(head) < len(buf):
+                memoryview(buf)[: len(head)] = head
+                offset = len(head)
+            else:
+                write_all(dest, head)
+
+        self.pipe_buffered(dest, offset)
+
+    def pipe_buffered(self, dest, offset=0):
+        """
+        Copy the file to dest after the first offset bytes of the shared
+        buffer, which are already waiting to be sent
+        """
+        mv = memoryview(Stream.buffer())
+        remaining = self.length
+        with self.open() as reader:
+            while True:
+                end = len(mv)
+                if remaining is not None:
+                    end = min(end, offset + remaining)
+                n = reader.readinto(mv[offset:end]) or 0
+                if remaining is not None:
+                    remaining -= n
+                n += offset
+                if not n:
+                    break
+                write_all(dest, mv[:n])
+                offset = 0
+
+    def open(self):
+        """
+        Opens the file at the first byte to send
+        """
+        reader = open(self.src, "rb")
+        if self.start:
+            reader.seek(self.start)
+        return reader
+
+
+class ResponseWriter:
+    """
+    Collects the small writes of a response in the shared Stream buffer and
+    passes them on to dest once the buffer is full or flushed
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.buf = Stream.buffer()
+        self.pending = 0
+
+    def write(self, data):
+        size = len(data)
+        if self.pending + size > len(self.buf):
+            self.flush()
+            if size > len(self.buf):
+                write_all(self.dest, data)
+                return size
+
+        self.buf[self.pending : self.pending + size] = data
+        self.pending += size
+        return size
+
+    def flush(self):
+        if self.pending:
+            write_all(self.dest, memoryview(self.buf)[: self.pending])
+            self.pending = 0
+
+
+class ChunkedWriter:
+    """
+    Writes a body with chunked transfer encoding through the shared Stream
+    buffer. Each chunk goes out in one write together with its size line,
+    and the first chunk together with the response headers that are already
+    in the buffer.
+    """
+
+    # The chunk size is sent as four hex digits to reserve its space up front
+    SIZE_LINE = 6
+    LAST_CHUNK = b"0\r\n\r\n"
+
+    def __init__(self, dest, offset=0):
+        self.dest = dest
+        self.buf = Stream.buffer()
+        self.start = offset
+        self.pending = offset + self.SIZE_LINE
+
+    def write(self, data):
+        mv = memoryview(data)
+        while len(mv):
+            room = len(self.buf) - len(self.LAST_CHUNK) - 2 - self.pending
+            if room <= 0:
+                self.flush()
+                continue
+            n = min(room, len(mv))
+            self.buf[self.pending : self.pending + n] = mv[:n]
+            self.pending += n
+            mv = mv[n:]
+        return len(data)
+
+    def flush(self, last=False):
+        end = self.pending
+        size = end - self.start - self.SIZE_LINE
+        if size:
+            self.buf[self.start : self.start + self.SIZE_LINE] = "{:04x}\r\n".format(
+                size
+            ).encode()
+            self.buf[end : end + 2] = b"\r\n"
+            end += 2
+        else:
+            # Only the response headers are waiting
+            end = self.start
+        if last and end + len(self.LAST_CHUNK) <= len(self.buf):
+            self.buf[end : end + len(self.LAST_CHUNK)] = self.LAST_CHUNK
+            end += len(self.LAST_CHUNK)
+            last = False
+
+        write_all(self.dest, memoryview(self.buf)[:end])
+        if last:
+            write_all(self.dest, self.LAST_CHUNK)
+        self.start = 0
+        self.pending = self.SIZE_LINE
 
-    def pipe(self, dest):
-        with open(self.src, "rb") as reader:
-            buf = reader.read(100)
-            while buf != b"":
-                dest.write(buf)
-                buf = reader.read(100)
+    def close(self):
+        self.flush(True)
+
+
+class JsonStream:
+    """
+    Response body that is encoded to JSON while it is sent, with chunked
+    transfer encoding. obj may be a dict, list or an iterator of records,
+    which is sent as a JSON array. It can only be sent once.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def pieces(self):
+        return iterencode(self.obj)
+
+    def write(self, dest, offset=0):
+        out = ChunkedWriter(dest, offset)
+        for piece in self.pieces():
+            out.write(piece.encode("utf-8"))
+        out.close()
+
+
+class TextStream(JsonStream):
+    """
+    Response body of text that is sent while it is produced, obj is an
+    iterable of strings, e.g. a generator. It can only be sent once.
+    """
+
+    def pieces(self):
+        return self.obj
+
+
+class EventStream:
+    """
+    Server-Sent Events channel, used as the body of the response that
+    subscribes a client
+
+    The web server keeps a subscribed connection open, non-blocking, and
+    calls `flush` for it from its loop. Each published event is encoded once
+    and queued for every subscriber, a subscriber that reads too slowly to
+    keep up loses its oldest queued events. At most max_subscribers clients
+    are subscribed at a time, others get a 503.
+
+    NOTE: `publish` and `flush` must be called from the same context, not
+    from an interrupt or timer callback.
+    """
+
+    MAX_SUBSCRIBERS = 2
+
+    # Events queued per subscriber, at least 2
+    QUEUE_SIZE = 4
+
+    # Milliseconds a browser waits before it reconnects
+    RETRY = 3000
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS, queue_size=QUEUE_SIZE):
+        self.max_subscribers = max_subscribers
+        self.queue_size = max(queue_size, 2)
+        # Queued events and bytes of the first one already sent, by connection
+        self.subscribers = {}
+        # Events dropped for slow readers
+        self.dropped = 0
+        self.retry_line = "retry: {}\n\n".format(self.RETRY).encode()
+
+    def handle(self, request):
+        """
+        Route handler that subscribes the client
+        """
+        if len(self.subscribers) >= self.max_subscribers:
+            resp = HttpResponse.err(503, "Too many subscribers")
+            resp.headers["Retry-After"] = self.RETRY // 1000
+            return resp
+        return HttpResponse.ok(
+            200,
+            Http.MIME_TYPE["EVENTS"],
+            body=self,
+            headers={"Cache-Control": Http.CACHE_REVALIDATE},
+        )
+
+    def subscribe(self, conn):
+        self.subscribers[conn] = [[], 0]
+
+    def unsubscribe(self, conn):
+        self.subscribers.pop(conn, None)
+
+    def publish(self, data: str, event=None):
+        """
+        Queue an event for every subscriber
+        """
+        if not self.subscribers:
+            return
+        msg = self.encode(data, event)
+        for state in self.subscribers.values():
+            queue = state[0]
+            if len(queue) >= self.queue_size:
+                # Drop the oldest event the subscriber hasn't started reading
+                queue.pop(1 if state[1] else 0)
+                self.dropped += 1
+            queue.append(msg)
+
+    @staticmethod
+    def encode(data: str, event=None) -> bytes:
+        out = StringBuilder()
+        if event:
+            out.add("event: ").add(event).add("\n")
+        for line in data.split("\n"):
+            out.add("data: ").add(line).add("\n")
+        out.add("\n")
+        return out.build().encode("utf-8")
+
+    def flush(self, conn):
+        """
+        Send the queued events of a subscriber until its socket is full.
+        Raises OSError if the subscriber has gone.
+        """
+        state = self.subscribers[conn]
+        queue = state[0]
+        while queue:
+            msg = queue[0]
+            try:
+                n = conn.write(memoryview(msg)[state[1] :])
+            except OSError as err:
+                if err.args[0] == errno.EAGAIN:
+                    return
+                raise
+            if not n:
+                return
+            state[1] += n
+            if state[1] < len(msg):
+                return
+            queue.pop(0)
+            state[1] = 0
 
 
 class File:
@@ -36,28 +338,30 @@ class File:
         self.root = root
 
     def resolve_type(self, path: str) -> str:
-        if path.lower().endswith("css"):
+        path = path.lower()
+
+        if path.endswith("css"):
             return Http.MIME_TYPE["CSS"]
 
-        if path.lower().endswith("html"):
+        if path.endswith("html"):
             return Http.MIME_TYPE["HTML"]
 
-        if path.lower().endswith("png"):
+        if path.endswith("png"):
             return Http.MIME_TYPE["PNG"]
 
-        if path.lower().endswith("jpg"):
+        if path.endswith("jpg"):
             return Http.MIME_TYPE["JPG"]
 
-        if path.lower().endswith("svg"):
+        if path.endswith("svg"):
             return Http.MIME_TYPE["SVG"]
 
-        if path.lower().endswith("js"):
+        if path.endswith("js"):
             return Http.MIME_TYPE["JS"]
 
-        if path.lower().endswith("json"):
+        if path.endswith("json"):
             return Http.MIME_TYPE["JSON"]
 
-        if path.lower().endswith(("txt")):
+        if path.endswith(("txt")):
             return Http.MIME_TYPE["TEXT"]
         else:
             return Http.MIME_TYPE["BINARY"]
@@ -74,12 +378,46 @@ class File:
         return (mime_type, fstat[6], p)
 
 
+class Manifest:
+    """
+    Metadata of the static files, generated at build time by
+    tools/build_manifest.py and loaded once from the www root
+
+    Each entry is keyed by URL path:
+    [size, mime type, content encoding, etag, immutable, gzip]
+
+    gzip is [size, etag] of the pre-compressed `.gz` variant or None
+    """
+
+    FILE = "manifest.json"
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries else {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    @staticmethod
+    def load(root):
+        try:
+            with open(root + "/" + Manifest.FILE) as fp:
+                return Manifest(json.load(fp))
+        except (OSError, ValueError) as ex:
+            log.warn("No static manifest: " + str(ex))
+            return Manifest()
+
+
 class HTTP_METHOD:
     GET = 1
     PUT = 2
     POST = 3
     DELETE = 4
 
+    NAMES = {GET: "GET", PUT: "PUT", POST: "POST", DELETE: "DELETE"}
+
 
 class Route:
     def __init__(self, method: HTTP_METHOD, path: str):
@@ -107,9 +445,129 @@ class Route:
         return s + ": " + self.path
 
 
+class RouteNode:
+    """
+    Node in the segment trie of a `Router`
+    """
+
+    def __init__(self):
+        self.children = {}
+        # Name and node of a `{param}` segment
+        self.param = None
+        self.param_node = None
+        # Handlers of the path ending at this node, keyed by HTTP method
+        self.handlers = {}
+        # Handler for GET requests of every path below this node
+        self.mount = None
+
+
+class Router:
+    """
+    Compiled route table
+
+    Routes without parameters are kept in a dict keyed by `Route`, so
+    dispatch is a single lookup no matter how many routes are registered.
+
+    Routes with parameters, e.g. `/peripherals/{id}`, and mounts are kept in
+    a trie of path segments. A literal segment takes precedence over a
+    parameter at the same position and a parameter matches exactly one
+    non-empty segment. A mount handles GET requests for its path and every
+    path below it, the deepest mount wins.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.root = RouteNode()
+
+    def add(self, method: HTTP_METHOD, path: str, handler):
+        if "{" not in path:
+            self.routes[Route(method, path)] = handler
+            return
+
+        self._insert(path).handlers[method] = handler
+
+    def mount(self, path: str, handler, prefix=True):
+        """
+        Register a GET handler for `path`, and every path below it if
+        `prefix` is True
+        """
+        node = self._insert(path)
+        if prefix:
+            node.mount = handler
+        else:
+            node.handlers[HTTP_METHOD.GET] = handler
+
+    def match(self, route: Route):
+        """
+        Returns the handler and the captured path parameters of the route,
+        or (None, None) if no route matches
+        """
+        handler = self.routes.get(route)
+        if handler is not None:
+            return (handler, None)
+
+        node = self.root
+        params = None
+        mount = None
+        for segment in route.path.split("/")[1:]:
+            if node.mount is not None:
+                mount = node.mount
+
+            child = node.children.get(segment)
+            if child is None:
+                if node.param_node is None or segment == "":
+                    node = None
+                    break
+                if params is None:
+                    params = {}
+                params[node.param] = segment
+                child = node.param_node
+            node = child
+
+        if node is not None:
+            handler = node.handlers.get(route.method)
+            if handler is not None:
+                return (handler, params)
+            if node.mount is not None:
+                mount = node.mount
+
+        if mount is not None and route.method == HTTP_METHOD.GET:
+            return (mount, None)
+
+        return (None, None)
+
+    def _insert(self, path: str) -> RouteNode:
+        node = self.root
+        for segment in path.split("/")[1:]:
+            if segment.startswith("{") and segment.endswith("}"):
+                name = segment[1:-1]
+                if node.param_node is None:
+                    node.param = name
+                    node.param_node = RouteNode()
+                elif node.param != name:
+                    raise ValueError("Conflicting path parameter: " + segment)
+                node = node.param_node
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = RouteNode()
+                    node.children[segment] = child
+                node = child
+
+        return node
+
+
 class HttpRequest:
     def __init__(
-        self, route: Route, headers, query=None, body=None, protocol="http", domain=None
+        self,
+        route: Route,
+        headers,
+        query=None,
+        body=None,
+        protocol="http",
+        domain=None,
+        params=None,
+        version=None,
     ):
         self.route = route
         self.header = headers
@@ -117,6 +575,21 @@ class HttpRequest:
         self.body = body
         self.protocol = protocol
         self.domain = domain
+        # Path parameters captured by the router
+        self.params = params if params else {}
+        self.version = version if version else Http.VERSION
+
+    def keep_alive(self) -> bool:
+        """
+        HTTP/1.1 connections are persistent unless the client asks to close,
+        HTTP/1.0 connections only when the client asks for keep-alive
+        """
+        connection = ""
+        if self.header:
+            connection = self.header.get("Connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
 
 
 class HttpResponse:
@@ -129,19 +602,39 @@ class HttpResponse:
         self.body = body
         self.status = status
         self.mime_type = mime
-        self._response = StringBuilder()
 
-        self._add_protocol_header()
+        self._content = self._encode_body()
         self._add_headers()
-        self._add_body()
 
     def __str__(self):
-        return self._response.build()
+        response = self._head()
+        if self.is_chunked():
+            body = "".join(self.body.pieces())
+            length = len(body.encode("utf-8"))
+            response.add("{:x}".format(length)).newline().add(body).newline()
+            response.add("0").newline().newline()
+        elif self.is_event_stream():
+            response.add(str(self.body.retry_line, "utf-8"))
+        else:
+            response.add(str(self._content, "utf-8"))
+        return response.build()
 
-    def _add_protocol_header(self):
-        self._response.add(Http.VERSION).space().add(
-            Http.STATUS_CODE[self.status]
-        ).newline()
+    def head(self) -> str:
+        """
+        The status line and headers, without the body
+        """
+        return self._head().build()
+
+    def _head(self) -> StringBuilder:
+        response = StringBuilder()
+        self._add_protocol_header(response)
+        for k, v in self.headers.items():
+            response.add(k).add(":").space().add(v).newline()
+        response.newline()
+        return response
+
+    def _add_protocol_header(self, response):
+        response.add(Http.VERSION).space().add(Http.STATUS_CODE[self.status]).newline()
 
     def _add_headers(self):
         if not self.headers:
@@ -150,28 +643,71 @@ class HttpResponse:
             self.headers["Server"] = Http.SERVER
         if "Content-Type" not in self.headers:
             self.headers["Content-Type"] = self.mime_type
-
-        for k, v in self.headers.items():
-            self._response.add(k).add(":").space().add(v).newline()
-
-    def _add_body(self):
+        if self.is_chunked():
+            self.headers["Transfer-Encoding"] = "chunked"
+        elif (
+            "Content-Length" not in self.headers
+            and not self.has_stream()
+            and not self.is_event_stream()
+            and self.status != 304
+        ):
+            self.headers["Content-Length"] = len(self._content)
+
+    def _encode_body(self):
         """
         Mapping
         ----
         dict - json
         """
-        self._response.newline()
-
-        if type(self.body) == Stream:
-            return
+        if self.body is None or isinstance(
+            self.body, (Stream, JsonStream, EventStream)
+        ):
+            return b""
         if type(self.body) != dict:
-            self._response.add(self.body).newline()
+            return str(self.body).encode("utf-8")
         else:
-            self._response.add(json.dumps(self.body)).newline()
+            return json.dumps(self.body).encode("utf-8")
 
     def has_stream(self):
         return type(self.body) == Stream
 
+    def is_chunked(self):
+        return isinstance(self.body, JsonStream)
+
+    def is_event_stream(self):
+        return type(self.body) == EventStream
+
+    def write(self, dest):
+        """
+        Serialise the response straight to a socket, without building it in
+        memory first. The status line and common headers are prebuilt bytes.
+        """
+        out = ResponseWriter(dest)
+        out.write(STATUS_LINES[self.status])
+        for k, v in self.headers.items():
+            line = HEADER_LINES.get(k)
+            line = line.get(v) if line else None
+            if line:
+                out.write(line)
+            else:
+                out.write(k.encode())
+                out.write(b": ")
+                out.write(str(v).encode())
+                out.write(b"\r\n")
+        out.write(b"\r\n")
+
+        if self.has_stream():
+            self.body.pipe_buffered(dest, out.pending)
+        elif self.is_chunked():
+            self.body.write(dest, out.pending)
+        elif self.is_event_stream():
+            out.write(self.body.retry_line)
+            out.flush()
+        else:
+            if self._content:
+                out.write(self._content)
+            out.flush()
+
     @staticmethod
     def err(code, message=None):
         """
@@ -195,9 +731,21 @@ class RequestStreamParser:
         "User-Agent",
         "Content-Length",
         "Content-Type",
+        "If-None-Match",
+        "Range",
+        "If-Range",
     ]
 
-    def __init__(self, newline="\r\n"):
+    # Largest request body accepted, larger bodies are refused with a 413
+    # before any of it is read
+    MAX_BODY = 2048
+
+    def __init__(self, newline="\r\n", max_body=MAX_BODY):
+        self._newline = newline
+        self.max_body = max_body
+        self._reset()
+
+    def _reset(self):
         self._line = None
         self._lines = 0
         self._path = None
@@ -210,7 +758,6 @@ class RequestStreamParser:
         self._break = False
         self._content_length = None
         self._body = None
-        self._newline = newline
 
     def update(self, line) -> bool:
         if line == self._newline:
@@ -222,25 +769,7 @@ class RequestStreamParser:
 
         if self._lines == 1:
             # first line
-            self.validate()
-            req = raw.split(" ", 2)
-            self._parse_method(req[0])
-            _path = req[1]
-            self._version = req[2]
-            self.validate()
-
-            if "http" in _path:
-                (self._protocol, _path) = _path.split("://", 1)
-            if not _path.startswith("/"):
-                (self._domain, _path) = _path.split("/", 1)
-                _path = "/" + _path
-            if "?" in _path:  # Check if there's query string?
-                (path, query) = _path.split("?", 1)
-                self._queries = self._parse_query(query)
-            else:
-                (path, query) = (_path, "")
-
-            self._path = path
+            self._parse_request_line(raw)
             return True
 
         if self._lines > 1 and not self._break:
@@ -252,6 +781,37 @@ class RequestStreamParser:
 
         return False
 
+    def _parse_request_line(self, raw):
+        self.validate()
+        req = raw.split(" ", 2)
+        self._parse_method(req[0])
+        _path = req[1]
+        self._version = req[2]
+        self.validate()
+
+        if "http" in _path:
+            (self._protocol, _path) = _path.split("://", 1)
+        if not _path.startswith("/"):
+            (self._domain, _path) = _path.split("/", 1)
+            _path = "/" + _path
+        if "?" in _path:  # Check if there's query string?
+            (path, query) = _path.split("?", 1)
+            self._queries = self._parse_query(query)
+        else:
+            (path, query) = (_path, "")
+
+        self._path = path
+
+    def remaining(self):
+        """
+        Returns the number of body bytes still expected once all headers have
+        been received, otherwise None
+        """
+        if not (self._break and self._content_length):
+            return None
+        received = len(self._body.encode("utf-8")) if self._body else 0
+        return self._content_length - received
+
     def _parse_body(self, line):
         """
         Parses the body line by line
@@ -289,7 +849,18 @@ class RequestStreamParser:
             (_, value) = line.split(": ", 2)
             self._header[h] = value.strip()
             if h == "Content-Length":
-                self._content_length = int(self._header[h])
+                self._set_content_length(self._header[h])
+
+    def _set_content_length(self, value):
+        try:
+            length = int(value)
+        except ValueError:
+            raise HttpError("Bad Request", 400)
+        if length < 0:
+            raise HttpError("Bad Request", 400)
+        if length > self.max_body:
+            raise HttpError("Payload Too Large", 413)
+        self._content_length = length
 
     def _parse_method(self, method) -> HTTP_METHOD:
         if method == "GET":
@@ -327,16 +898,239 @@ class RequestStreamParser:
             ):
                 raise HttpError("HTTP Version Not Supported", 505)
 
+    def _decode_body(self):
+        if not self._body:
+            return None
+        try:
+            return json.loads(self._body)
+        except ValueError:
+            raise HttpError("Bad Request", 400)
+
     def get_request(self) -> HttpRequest:
         route = Route(self._method, self._path)
         return HttpRequest(
             route,
             self._header,
             self._queries,
-            json.loads(self._body) if self._body else None,
+            self._decode_body(),
             self._protocol,
             self._domain,
+            version=self._version,
+        )
+
+
+class RequestBufferParser(RequestStreamParser):
+    """
+    Bytes level request parser
+
+    Reads the request from a socket (or any stream with `readinto`) into one
+    preallocated buffer and scans it in place. Only the request line and the
+    values of supported headers are decoded. The JSON body is decoded by
+    `JsonDecoder` straight from the buffer, which is refilled from the stream
+    until exactly Content-Length bytes are read. Bodies larger than max_body
+    are refused before they are read and bodies nested deeper than max_depth
+    are rejected.
+
+    Bytes following the request stay in the buffer, so a pipelined request
+    is parsed by the next call to `parse`. Call `clear` before reusing the
+    parser for a new connection.
+
+    A caller that can't block on reads, like the asyncio server, reads into
+    `space` itself until `head_buffered` and calls `parse_head`. It then
+    buffers the `body_missing` bytes, or if there's no `room` for them
+    passes them to `parse_body` as the stream.
+    """
+
+    BUFFER_SIZE = 1024
+
+    # Supported headers keyed by their lower case name
+    HEADERS = dict(
+        (h.lower().encode(), h) for h in RequestStreamParser.SUPPORTED_HEADERS
+    )
+
+    # Parser states
+    REQUEST_LINE = 0
+    HEADER = 1
+    BODY = 2
+    DONE = 3
+
+    def __init__(
+        self,
+        size=BUFFER_SIZE,
+        max_body=RequestStreamParser.MAX_BODY,
+        max_depth=JsonDecoder.MAX_DEPTH,
+    ):
+        super().__init__(max_body=max_body)
+        self.max_depth = max_depth
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def clear(self):
+        """
+        Discard any buffered bytes
+        """
+        self._start = 0
+        self._end = 0
+
+    def buffered(self) -> int:
+        """
+        Returns the number of received bytes not yet parsed
+        """
+        return self._end - self._start
+
+    def parse(self, stream) -> HttpRequest:
+        if self.parse_head(stream):
+            self.parse_body(stream)
+        return self.get_request()
+
+    def parse_head(self, stream) -> bool:
+        """
+        Parse the request line and headers, returns True if a body follows
+        """
+        self._reset()
+        state = self.REQUEST_LINE
+
+        while state == self.REQUEST_LINE or state == self.HEADER:
+            (start, end) = self._next_line(stream)
+            if state == self.REQUEST_LINE:
+                self._lines = 1
+                self._line = str(self._mv[start:end], "utf-8")
+                self._parse_request_line(self._line)
+                state = self.HEADER
+            elif start == end:
+                # An empty line ends the headers
+                self._break = True
+                state = self.BODY if self._content_length else self.DONE
+            else:
+                self._lines += 1
+                self._parse_header_bytes(start, end)
+
+        return state == self.BODY
+
+    def head_buffered(self) -> bool:
+        """
+        Whether the buffer holds the empty line that ends the headers, so
+        `parse_head` won't read from the stream
+        """
+        return (
+            self._buf.find(b"\n\r\n", self._start, self._end) >= 0
+            or self._buf.find(b"\n\n", self._start, self._end) >= 0
+        )
+
+    def body_missing(self) -> int:
+        """
+        Returns the number of body bytes not yet buffered, once the headers
+        are parsed
+        """
+        return max((self._content_length or 0) - self.buffered(), 0)
+
+    def room(self) -> int:
+        """
+        Returns the number of bytes that can still be buffered
+        """
+        return len(self._buf) - self.buffered()
+
+    def space(self) -> memoryview:
+        """
+        The free end of the buffer to read into, the unparsed bytes are moved
+        to the front first. Raises a 431 if the buffer is full.
+        """
+        n = self._end - self._start
+        if n == 0:
+            self.clear()
+        elif self._start > 0:
+            # Move the partial line to the front of the buffer
+            self._mv[:n] = self._mv[self._start : self._end]
+            self._start = 0
+            self._end = n
+
+        if self._end == len(self._buf):
+            raise HttpError("Request Header Fields Too Large", 431)
+        return self._mv[self._end :]
+
+    def filled(self, n):
+        """
+        Add n bytes read into `space` to the buffered bytes
+        """
+        self._end += n
+
+    def _next_line(self, stream):
+        """
+        Returns the start and end of the next line in the buffer, without the
+        line ending
+        """
+        while True:
+            nl = self._buf.find(b"\n", self._start, self._end)
+            if nl >= 0:
+                start = self._start
+                self._start = nl + 1
+                if nl > start and self._buf[nl - 1] == 13:  # \r
+                    nl -= 1
+                return (start, nl)
+            self._fill(stream)
+
+    def _fill(self, stream):
+        read = stream.readinto(self.space())
+        if not read:
+            raise ConnectionClosed("Connection closed by client")
+        self.filled(read)
+
+    def _parse_header_bytes(self, start, end):
+        colon = self._buf.find(b":", start, end)
+        if colon < 0:
+            return
+
+        name = self.HEADERS.get(bytes(self._mv[start:colon]).lower())
+        if name is None:
+            return
+
+        start = colon + 1
+        while start < end and self._buf[start] == 32:
+            start += 1
+        while end > start and self._buf[end - 1] == 32:
+            end -= 1
+
+        self._header[name] = str(self._mv[start:end], "utf-8")
+        if name == "Content-Length":
+            self._set_content_length(self._header[name])
+
+    def parse_body(self, stream):
+        """
+        Decode the JSON body, the buffer is refilled from the stream until
+        Content-Length bytes are read
+        """
+        decoder = JsonDecoder(
+            stream,
+            self._content_length,
+            self._buf,
+            self._start,
+            self._end,
+            self.max_depth,
         )
+        try:
+            self._body = decoder.decode()
+        except ValueError as err:
+            # The rest of the body is unread, the connection can't be reused
+            raise HttpError("Bad Request: {}".format(err), 400)
+        except OSError:
+            raise ConnectionClosed("Connection closed by client")
+
+        if decoder.refills:
+            # The whole buffer was body
+            self.clear()
+        else:
+            self._start = decoder.pos
+
+    def _decode_body(self):
+        return self._body
+
+
+class ConnectionClosed(OSError):
+    """
+    The client closed the connection before a complete request was received
+    """
 
 
 class HttpError(Exception):
@@ -364,15 +1158,25 @@ class Http:
         "CSS": "text/css; " + CHARSET,
         "JS": "text/javascript; " + CHARSET,
         "JSON": "application/json; " + CHARSET,
+        "EVENTS": "text/event-stream",
         "PNG": "image/png",
         "SVG": "image/svg+xml",
         "JPG": "image/jpeg",
         "BINARY": "application/octet-stream",
     }
 
+    # Prometheus text exposition format
+    METRICS_TYPE = "text/plain; version=0.0.4; " + CHARSET
+
+    # Cache policy of static files, fingerprinted files never change
+    CACHE_REVALIDATE = "no-cache"
+    CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+
     STATUS_CODE = {
         200: "200 OK",
         201: "201 Created",
+        206: "206 Partial Content",
+        304: "304 Not Modified",
         301: "301 Moved Permanently",
         302: "302 Moved Remporarily",
         400: "400 Bad Request",
@@ -380,102 +1184,317 @@ class Http:
         403: "403 Forbidden",
         404: "404 Not Found",
         405: "405 Method not Allowed",
+        408: "408 Request Timeout",
+        413: "413 Payload Too Large",
+        416: "416 Range Not Satisfiable",
+        431: "431 Request Header Fields Too Large",
         500: "500 Internal Server Error",
         501: "501 Not Implemented",
+        503: "503 Service Unavailable",
         505: "505 HTTP Version Not Supported",
     }
 
+    # Static content is served from www_root for these files and for every
+    # path below these directories
+    STATIC_FILES = ("/", "/index.html", "/favicon.ico")
+    STATIC_DIRS = ("/css", "/js", "/img")
+
     def __init__(self):
         self.response = None
 
         # The path to the web documents on MicroPython filesystem
         self.www_root = "/www"
 
-        # Dict for registed handlers of all paths
-        self.handlers = {}
+        # Static file metadata, loaded on first use
+        self.manifest = None
+
+        self.router = Router()
+
+        # Dict for registed handlers of all paths without parameters
+        self.handlers = self.router.routes
+
+        # Request metrics are recorded by the web server under the label of
+        # the route that handled the request, labels are keyed by handler id
+        self.metrics = Metrics()
+        self.labels = {}
+        self.label = None
+
+        # All mounts share one bound method, so it has a single id
+        self._static_handler = self._static
+        self.labels[id(self._static_handler)] = "static"
+
+        for path in self.STATIC_FILES:
+            self.mount(path, prefix=False)
+        for path in self.STATIC_DIRS:
+            self.mount(path)
 
     def set_www_root(self, path):
         """
         Set the path to documents' directory
         """
         self.www_root = path
+        self.manifest = None
+
+    def load_manifest(self) -> Manifest:
+        """
+        Load the static file manifest of the www_root
+        """
+        self.manifest = Manifest.load(self.www_root)
+        return self.manifest
 
     def handle(self, request: HttpRequest):
         # Handle all registered paths first, if none found, try serve static content
-        match = self._match_route(request)
+        (handler, params) = self.router.match(request.route)
         print(str(request.route))
-        if type(match) is bool and not match:
-            if request.route.method == HTTP_METHOD.GET and self._match_static_route(
-                request
-            ):
-                self.response = self._static(request)
+        self.label = self.labels.get(id(handler), Metrics.UNMATCHED)
+        if handler is None:
+            self.response = HttpResponse.err(400)
+            return
 
-            else:
-                self.response = HttpResponse.err(400)
-        else:
-            try:
-                self.response = self.handlers[match](request)
-            except Exception as ex:
-                self.response = HttpResponse.err(500, str(ex))
-            except HttpError as err:
-                self.response = HttpResponse.err(err.code, str(err))
+        if params:
+            request.params = params
+        try:
+            self.response = handler(request)
+        except HttpError as err:
+            self.response = HttpResponse.err(err.code, err.message)
+        except Exception as ex:
+            self.response = HttpResponse.err(500, str(ex))
 
     def register_handler(self, method: HTTP_METHOD, path, handler):
         """
         Register handler for processing request for specified path
+
+        Segments of the form `{name}` match any single path segment, the value
+        is passed to the handler in `request.params[name]`
+        """
+        self.router.add(method, path, handler)
+        if id(handler) not in self.labels:
+            self.labels[id(handler)] = "{} {}".format(HTTP_METHOD.NAMES[method], path)
+
+    def serve_metrics(self, path="/metrics"):
+        """
+        Export the request metrics at path in the Prometheus text format, or
+        as JSON with `?format=json` or `Accept: application/json`
+        """
+        self.register_handler(HTTP_METHOD.GET, path, self._metrics)
+
+    def serve_events(self, path, stream: EventStream):
         """
-        route = Route(method, path)
-        self.handlers[route] = handler
+        Subscribe clients of path to the Server-Sent Events of stream
+        """
+        self.register_handler(HTTP_METHOD.GET, path, stream.handle)
+
+    def mount(self, path, prefix=True):
+        """
+        Serve static content from www_root for path, and every path below it
+        if prefix is True
+        """
+        self.router.mount(path, self._static_handler, prefix)
 
     def get_response(self) -> HttpResponse:
         return self.response
 
+    def _metrics(self, request: HttpRequest):
+        accept = request.header.get("Accept", "") if request.header else ""
+        if request.query.get("format") == "json" or "application/json" in accept:
+            return HttpResponse.ok(
+                200, Http.MIME_TYPE["JSON"], JsonStream(self.metrics.json())
+            )
+        return HttpResponse.ok(
+            200, Http.METRICS_TYPE, TextStream(self.metrics.prometheus())
+        )
+
     def _static(self, request: HttpRequest):
         """
-        Automatically assumes HTML and JS files are gzip compressed
+        Serves static files as described by the manifest, or straight from
+        the file system without one
+
+        The `.gz` variant of a file is served to clients that accept gzip,
+        everyone else gets the original.
+        """
+        if self.manifest is None:
+            self.load_manifest()
+        if len(self.manifest) == 0:
+            return self._static_fs(request)
+
+        path = request.route.path
+        if path == "/":
+            path = "/index.html"
+
+        entry = self.manifest.get(path)
+        if entry is None:
+            return HttpResponse.err(404, "File not found")
+
+        (size, mime_type, encoding, etag, immutable) = entry[:5]
+        variant = entry[5] if len(entry) > 5 else None
+        headers = {}
+        if variant:
+            headers["Vary"] = "Accept-Encoding"
+            if self.accepts_gzip(request):
+                (size, etag) = variant
+                encoding = "gzip"
+                path += ".gz"
+
+        headers["ETag"] = etag
+        if immutable:
+            headers["Cache-Control"] = Http.CACHE_IMMUTABLE
+        else:
+            headers["Cache-Control"] = Http.CACHE_REVALIDATE
+
+        # The browser's cached copy is still valid, no need to touch the file
+        match = request.header.get("If-None-Match") if request.header else None
+        if match and (match == "*" or etag in match):
+            return HttpResponse(304, mime_type, headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return self._file(request, mime_type, self.www_root + path, size, headers, etag)
+
+    def _static_fs(self, request: HttpRequest):
+        """
+        Serves the `.gz` variant of a file if there is one and the client
+        accepts gzip, otherwise the file itself
         """
 
         # Check for path to any document
         fs = File(self.www_root)
         try:
-            headers = {}
+            headers = {"Vary": "Accept-Encoding"}
             if request.route.path == "/":
                 request.route.path = "/index.html"
-                headers["Content-Encoding"] = "gzip"
-            if request.route.path.endswith(".js"):
-                headers["Content-Encoding"] = "gzip"
-            if request.route.path.endswith(".css"):
-                headers["Content-Encoding"] = "gzip"
             file = request.route.path
             mime_type, size, filepath = fs.get_file_stat(file)
+            if self.accepts_gzip(request):
+                try:
+                    size = os.stat(filepath + ".gz")[6]
+                    filepath += ".gz"
+                    headers["Content-Encoding"] = "gzip"
+                except OSError:
+                    pass
             gc.collect()
             # Respond with the file content
-            headers["Content-Length"] = size
-            return HttpResponse.ok(
-                200, mime_type, body=Stream(filepath), headers=headers,
-            )
+            return self._file(request, mime_type, filepath, size, headers)
         except Exception as ex:
             # Can't find the file specified in path
             log.severe(str(ex))
             return HttpResponse.err(404, str(ex))
 
-    def _match_route(self, request: HttpRequest):
+    def _file(self, request, mime_type, filepath, size, headers, etag=None):
         """
-        Returns the first matched route or False if no route is matched
+        Response with the whole file, or with the part of it that a Range
+        header asks for
         """
-        matched = [route for route in self.handlers.keys() if route == request.route]
+        headers["Accept-Ranges"] = "bytes"
+        try:
+            byte_range = self.byte_range(request, size, etag)
+        except ValueError as err:
+            resp = HttpResponse.err(416, str(err))
+            resp.headers["Content-Range"] = "bytes */{}".format(size)
+            return resp
 
-        if len(matched) > 0:
-            return matched[0]
-        else:
+        if byte_range is None:
+            headers["Content-Length"] = size
+            body = Stream(filepath)
+            return HttpResponse.ok(200, mime_type, body=body, headers=headers)
+
+        (first, last) = byte_range
+        headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+        headers["Content-Length"] = last - first + 1
+        body = Stream(filepath, first, last - first + 1)
+        return HttpResponse.ok(206, mime_type, body=body, headers=headers)
+
+    @staticmethod
+    def byte_range(request: HttpRequest, size, etag=None):
+        """
+        The (first, last) byte positions of a file of `size` bytes that the
+        Range header of the request asks for, or None to send the whole file
+
+        Ranges that can't be parsed are ignored, as is a Range with an
+        If-Range that doesn't match the ETag: the client's partial copy is of
+        another version. Raises ValueError for ranges beyond the end of the
+        file and for requests of more than one range.
+        """
+        header = request.header.get("Range") if request.header else None
+        if not header or not header.startswith("bytes="):
+            return None
+
+        if_range = request.header.get("If-Range")
+        # Dates never match, only the manifest knows the ETag of a file
+        if if_range is not None and (etag is None or if_range.strip() != etag):
+            return None
+
+        spec = header[6:]
+        if "," in spec:
+            raise ValueError("Multiple ranges not supported")
+        (first, dash, last) = spec.partition("-")
+        try:
+            first = int(first) if first.strip() else None
+            last = int(last) if last.strip() else None
+        except ValueError:
+            return None
+        if not dash or (first is None and last is None) or (last or 0) < 0:
+            return None
+
+        if first is None:
+            # The last bytes of the file
+            if last == 0:
+                raise ValueError("Range not satisfiable")
+            (first, last) = (max(size - last, 0), size - 1)
+        elif last is None or last >= size:
+            last = size - 1
+        if first >= size:
+            raise ValueError("Range not satisfiable")
+        if last < first:
+            return None
+        return (first, last)
+
+    @staticmethod
+    def accepts_gzip(request: HttpRequest) -> bool:
+        """
+        True if the Accept-Encoding header of the request allows gzip
+        """
+        accept = request.header.get("Accept-Encoding") if request.header else None
+        if not accept:
             return False
 
-    def _match_static_route(self, request: HttpRequest):
-        return request.route.method == HTTP_METHOD.GET and (
-            request.route.path == "/"
-            or request.route.path == "/index.html"
-            or request.route.path.startswith("/css")
-            or request.route.path.startswith("/js")
-            or request.route.path.startswith("/favicon")
-            or request.route.path.startswith("/img")
-        )
+        # An explicit gzip takes precedence over the * wildcard
+        wildcard = False
+        for coding in accept.split(","):
+            (name, _, params) = coding.partition(";")
+            name = name.strip().lower()
+            if name != "gzip" and name != "*":
+                continue
+            accepted = True
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    accepted = float(params[2:]) > 0
+                except ValueError:
+                    accepted = False
+            if name == "gzip":
+                return accepted
+            wildcard = accepted
+        return wildcard
+
+
+def _header_lines(name, values):
+    return dict((v, "{}: {}\r\n".format(name, v).encode()) for v in values)
+
+
+# Prebuilt status lines and common header lines used by HttpResponse.write
+STATUS_LINES = dict(
+    (code, "{} {}\r\n".format(Http.VERSION, status).encode())
+    for (code, status) in Http.STATUS_CODE.items()
+)
+HEADER_LINES = {
+    "Server": _header_lines("Server", [Http.SERVER]),
+    "Content-Type": _header_lines("Content-Type", Http.MIME_TYPE.values()),
+    "Connection": _header_lines("Connection", ["keep-alive", "close"]),
+    "Cache-Control": _header_lines(
+        "Cache-Control", [Http.CACHE_REVALIDATE, Http.CACHE_IMMUTABLE]
+    ),
+    "Content-Encoding": _header_lines("Content-Encoding", ["gzip"]),
+    "Vary": _header_lines("Vary", ["Accept-Encoding"]),
+    "Accept-Ranges": _header_lines("Accept-Ranges", ["bytes"]),
+    "Transfer-Encoding": _header_lines("Transfer-Encoding", ["chunked"]),
+}
@@ -10,6 +10,14 @@
 
 import machine, time
 from machine import Pin
+from array import array
+
+from util import ticks_us, ticks_diff
+
+try:
+    import micropython
+except ImportError:
+    micropython = None
 
 __version__ = "0.2.1"
 __author__ = "Roberto Sánchez, Niel Swart"
@@ -85,3 +93,137 @@ class HCSR04:
         # 0.034320 cm/us that is 1cm each 29.1us
         cms = (pulse_time / 2) / 29.1
         return cms
+
+
+class HCSR04Irq:
+    """
+    HC-SR04 driver that doesn't busy-wait for the echo.
+    `start` sends the trigger pulse and returns. A pin interrupt timestamps
+    the rising and falling edge of the echo with ticks_us into a
+    preallocated buffer, so the CPU is free while the sound is in flight.
+
+    A completed measurement is handed to `callback(distance_mm)` through
+    micropython.schedule, outside the interrupt. A measurement without an
+    echo is reported as None by `poll`, which the main loop calls to catch
+    timeouts and results the scheduler queue had no room for.
+
+    esp_io.LevelSensor drives `start` and `poll` from a scheduler task, so
+    nothing waits for the echo. `distance_mm` is a drop-in for
+    HCSR04.distance_mm that does wait for it, in machine.idle().
+    """
+
+    # Measurement states
+    IDLE = 0
+    WAITING = 1
+    ECHO = 2
+    DONE = 3
+
+    # Microseconds from the trigger pulse to the start of the echo
+    ECHO_DELAY_US = 500
+
+    def __init__(
+        self, trigger_pin, echo_pin, callback=None, echo_timeout_us=500 * 2 * 30
+    ):
+        """
+        trigger_pin: Output pin to send pulses
+        echo_pin: Input pin of the echo, interrupts on both edges
+        callback: Called with the distance in mm, or None without an echo
+        echo_timeout_us: Longest echo pulse, by default the 4m sensor range
+        """
+        self.echo_timeout_us = echo_timeout_us
+        self.callback = callback
+        self.trigger = Pin(trigger_pin, mode=Pin.OUT, pull=None)
+        self.trigger.value(0)
+        self.echo = Pin(echo_pin, mode=Pin.IN, pull=None)
+
+        # Rising and falling edge of the echo
+        self.edges = array("L", [0, 0])
+        self.state = self.IDLE
+        self.started = 0
+        # Bound once, creating a bound method in the interrupt allocates
+        self._done_ref = self._done
+        self.echo.irq(
+            handler=self._edge, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True
+        )
+
+    def start(self) -> bool:
+        """
+        Send a trigger pulse, returns False if a measurement is in flight
+        """
+        if self.busy():
+            return False
+        self.state = self.WAITING
+        self.trigger.value(0)
+        time.sleep_us(5)
+        self.started = ticks_us()
+        self.trigger.value(1)
+        time.sleep_us(10)
+        self.trigger.value(0)
+        return True
+
+    def _edge(self, pin):
+        # Interrupt handler, must not allocate
+        t = ticks_us()
+        if pin.value():
+            if self.state == self.WAITING:
+                self.edges[0] = t
+                self.state = self.ECHO
+        elif self.state == self.ECHO:
+            self.edges[1] = t
+            self.state = self.DONE
+            if self.callback and micropython:
+                try:
+                    micropython.schedule(self._done_ref, 0)
+                except RuntimeError:
+                    # The queue is full, poll delivers the result
+                    pass
+
+    def _done(self, arg):
+        if self.state == self.DONE:
+            self.state = self.IDLE
+            if self.callback:
+                self.callback(self.result())
+
+    def result(self):
+        """
+        Distance in mm of the completed measurement
+        """
+        pulse_time = ticks_diff(self.edges[1], self.edges[0])
+        return pulse_time * 100 // 582
+
+    def busy(self) -> bool:
+        return self.state == self.WAITING or self.state == self.ECHO
+
+    def timed_out(self) -> bool:
+        limit = self.ECHO_DELAY_US + self.echo_timeout_us
+        return self.busy() and ticks_diff(ticks_us(), self.started) > limit
+
+    def poll(self):
+        """
+        Deliver a result that wasn't scheduled, or None after a timeout
+        """
+        if self.state == self.DONE:
+            self._done(0)
+        elif self.timed_out():
+            self.state = self.IDLE
+            if self.callback:
+                self.callback(None)
+
+    def distance_mm(self):
+        """
+        Measure and wait for the result, raises OSError('Out of range')
+        without an echo
+        """
+        callback = self.callback
+        self.callback = None
+        try:
+            self.start()
+            while self.busy():
+                if self.timed_out():
+                    self.state = self.IDLE
+                    raise OSError("Out of range")
+                machine.idle()
+            self.state = self.IDLE
+            return self.result()
+        finally:
+            self.callback = callback
@@ -5,8 +5,31 @@
 #
 ##
 
+import gc
 import math
 
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:
+    # CPython, used by the tests and benchmarks. Ticks wrap around like
+    # they do on MicroPython, so they always fit in 30 bits.
+    import time
+
+    TICKS_PERIOD = 1 << 30
+
+    def ticks_ms():
+        return (time.monotonic_ns() // 1000000) & (TICKS_PERIOD - 1)
+
+    def ticks_us():
+        return (time.monotonic_ns() // 1000) & (TICKS_PERIOD - 1)
+
+    def ticks_diff(ticks1, ticks2):
+        diff = (ticks1 - ticks2) & (TICKS_PERIOD - 1)
+        return diff - TICKS_PERIOD if diff >= TICKS_PERIOD // 2 else diff
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) & (TICKS_PERIOD - 1)
+
 
 class StringBuilder:
     def __init__(self):
@@ -72,3 +95,13 @@ def signal_filter(samples):
     else:
         ave = 0
     return math.trunc(ave)
+
+
+def mem_free():
+    """
+    Returns the free heap in bytes or None if the port can't tell
+    """
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return None
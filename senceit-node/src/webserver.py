@@ -11,11 +11,24 @@ import socket
 import select
 import gc
 
-from uhttp import Http, RequestStreamParser, HttpRequest, HttpError, HttpResponse
-from util import Logger
+from uhttp import (
+    Http,
+    RequestBufferParser,
+    HttpRequest,
+    HttpError,
+    HttpResponse,
+    ConnectionClosed,
+    Stream,
+    write_all,
+)
+from metrics import Metrics, CountingWriter
+from util import Logger, ticks_ms, ticks_us, ticks_diff, mem_free
 
 log = Logger.getLogger()
 
+# Not every port exposes it
+TCP_NODELAY = getattr(socket, "TCP_NODELAY", None)
+
 
 class Webserver:
     """
@@ -27,12 +40,64 @@ class Webserver:
 
     If no route is matched it will look for static files with the same route in the www_root directory of the file system
 
-    It does not support Transfer-Encoding: Chunked and many other HTTP features
+    Responses with a streamed JSON body are sent with Transfer-Encoding: chunked,
+    but chunked request bodies are not accepted
     It requires a Content-Length header to be present
     If no Content-Length is given, the server responds with 400 Bad request
+
+    Connections are kept alive as per HTTP/1.1 and pipelined requests are
+    served in order. An idle connection is closed after `keep_alive_timeout`
+    ms and every connection is closed after `max_requests` requests.
+
+    Admission control: a new connection beyond `max_clients` open connections,
+    or any request while the free heap is below `min_free` bytes, is shed
+    with a prebuilt 503 and Retry-After instead of being parsed and handled.
+    `shed` counts the shed requests.
+
+    The wall time, heap drop, response size and status of every request are
+    recorded in the metrics of the http handler.
+
+    A request answered with an `EventStream` subscribes the connection to
+    it. The connection is then only written to, the queued events are sent
+    at the end of every `handle_client` without blocking on slow readers.
     """
 
-    def __init__(self, http_handler: Http):
+    # Milliseconds to block in poll() while waiting for a client
+    POLL_TIMEOUT = 1000
+
+    # Seconds a read from a client may block
+    READ_TIMEOUT = 5
+
+    # Milliseconds an idle keep-alive connection stays open
+    KEEP_ALIVE_TIMEOUT = 5000
+
+    # Requests served on a connection before it is closed
+    MAX_REQUESTS = 20
+
+    # Open client connections, lwIP on the ESP8266 has 5 TCP PCBs and one is
+    # left for the MQTT client
+    MAX_CLIENTS = 4
+
+    # Connections the network stack queues until they are accepted
+    BACKLOG = 3
+
+    # Free heap in bytes below which new work is refused
+    MIN_FREE = 8192
+
+    # Seconds a shed client is asked to wait before retrying
+    RETRY_AFTER = 1
+
+    def __init__(
+        self,
+        http_handler: Http,
+        keep_alive=True,
+        keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+        max_requests=MAX_REQUESTS,
+        max_clients=MAX_CLIENTS,
+        min_free=MIN_FREE,
+        retry_after=RETRY_AFTER,
+        backlog=BACKLOG,
+    ):
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -43,65 +108,266 @@ class Webserver:
         self.connection = None
         self.http_handler = http_handler
 
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_requests = max_requests
+
+        # Open keep-alive connections: [requests served, last active ticks]
+        self.clients = {}
+
+        # Connections subscribed to Server-Sent Events, by their EventStream
+        self.streams = {}
+
+        # Reused for every request to avoid allocating a buffer per request
+        self.parser = RequestBufferParser()
+
+        self.max_clients = max_clients
+        self.min_free = min_free
+        self.backlog = backlog
+        # Built once, so shedding allocates nothing when memory is short
+        self.shed_response = shed_response(retry_after)
+        self.metrics = http_handler.metrics
+        # Counts the bytes of each response
+        self.writer = CountingWriter()
+
+    @property
+    def shed(self):
+        """
+        Number of requests answered with a 503
+        """
+        return self.metrics.shed
+
     # Function to start http server
-    def start(self, port):
-        self.intro()
-        self.server.bind(("0.0.0.0", port))
-        self.server.listen(3)
+    def start(self, port, host="0.0.0.0"):
+        intro(port)
+        self.server.bind((host, port))
+        self.server.listen(self.backlog)
         # Register for checking new client connection
         self.poller.register(self.server, select.POLLIN)
 
     def close(self):
+        for conn in list(self.clients):
+            self._close(conn)
+        for conn in list(self.streams):
+            self._unsubscribe(conn)
         self.poller.unregister(self.server)
         self.server.close()
 
-    # Check for new client connection and process the request
-    def handle_client(self):
+    # Check for new client connections and requests on open connections
+    def handle_client(self, timeout=1):
         # Note: don't call poll() with 0, that would randomly cause
         # reset with "Fatal exception 28(LoadProhibitedCause)" message
-        if self.poller.poll(1):
-            # There's a new client connection
-            (conn, sockaddr) = self.server.accept()
-            try:
-                self.connection = conn
+        for event in self.poller.poll(timeout):
+            sock = event[0]
+            if sock is self.server:
+                # There's a new client connection
+                (conn, sockaddr) = self.server.accept()
+                if len(self.clients) + len(self.streams) >= self.max_clients:
+                    self._shed(conn, "too many connections")
+                    continue
+                if self._low_memory():
+                    self._shed(conn, "low memory")
+                    continue
+                conn.settimeout(self.READ_TIMEOUT)
+                if TCP_NODELAY:
+                    # Don't hold back the body behind the headers on a
+                    # kept alive connection waiting for a delayed ACK
+                    conn.setsockopt(socket.IPPROTO_TCP, TCP_NODELAY, 1)
+                self.clients[conn] = [0, ticks_ms()]
+                self.serve(conn)
+            elif sock in self.clients:
+                if event[1] & (select.POLLHUP | select.POLLERR):
+                    self._close(sock)
+                elif self._low_memory():
+                    self._shed(sock, "low memory")
+                else:
+                    self.serve(sock)
+            elif sock in self.streams:
+                # A subscriber never sends anything, it has disconnected
+                self._unsubscribe(sock)
+
+        if self.streams:
+            self._flush_streams()
+        self._close_idle()
+
+    def serve(self, conn):
+        """
+        Serve the requests received on a connection, including any pipelined
+        requests that are already buffered
+        """
+        self.connection = conn
+        self.parser.clear()
+        client = self.clients[conn]
+        keep_alive = False
+        stream = None
+        start = ticks_us()
+        free = mem_free()
+        try:
+            while True:
                 request = self.get_request()
                 self.http_handler.handle(request)
                 resp = self.http_handler.get_response()
-                if resp.has_stream():
-                    self.connection.write(str(resp))
-                    resp.body.pipe(self.connection)
-                else:
-                    self.connection.write(str(resp))
+                client[0] += 1
+
+                keep_alive = (
+                    self.keep_alive
+                    and request.keep_alive()
+                    and client[0] < self.max_requests
+                )
+                if resp.is_event_stream():
+                    stream = resp.body
+                    keep_alive = True
+                resp.headers["Connection"] = "keep-alive" if keep_alive else "close"
+                self.send(resp)
+                self._record(self.http_handler.label, resp.status, start, free)
+
+                if stream or not keep_alive or not self.parser.buffered():
+                    break
+                start = ticks_us()
+                free = mem_free()
+        except ConnectionClosed:
+            keep_alive = False
+        except OSError as oserr:
+            keep_alive = False
+            log.severe(str(oserr))
+        except MemoryError as memerr:
+            keep_alive = False
+            self.metrics.memory_errors += 1
+            gc.collect()
+            log.severe(str(memerr))
+        except HttpError as err:
+            keep_alive = False
+            log.severe(err.message)
+            resp = HttpResponse.err(err.code, err.message)
+            resp.headers["Connection"] = "close"
+            try:
+                self.send(resp)
             except OSError as oserr:
+                # The client may be gone already, that mustn't stop the server
                 log.severe(str(oserr))
-            except MemoryError as memerr:
-                gc.collect()
-                log.severe(str(memerr))
-            except HttpError as err:
-                log.severe(err.message)
-                self.connection.write(str(HttpResponse.err(err.code, err.message)))
-            finally:
-                self.connection.close()
+            self._record(Metrics.INVALID, err.code, start, free)
+        except Exception as err:
+            # E.g. a streamed body that failed while it was sent, the status
+            # line may be out already so the connection is only closed
+            keep_alive = False
+            log.severe("Response failed: " + str(err))
+            self._record(self.http_handler.label, 500, start, free)
+        finally:
+            if stream and keep_alive:
+                self._subscribe(conn, stream)
+            elif keep_alive:
+                client[1] = ticks_ms()
+                self.poller.register(conn, select.POLLIN)
+            else:
+                self._close(conn)
+
+    def send(self, resp: HttpResponse):
+        resp.write(self.writer.wrap(self.connection))
+
+    def _record(self, label, status, start, free):
+        self.metrics.record(
+            label, status, ticks_diff(ticks_us(), start), free, self.writer.count
+        )
 
     def get_request(self) -> HttpRequest:
-        parser = RequestStreamParser()
-        line = self.read()
-        status = parser.update(line)
-
-        while status:
-            line = self.read()
-            status = parser.update(line)
-
-        return parser.get_request()
-
-    def read(self):
-        return str(self.connection.readline(), "utf-8")
-
-    def intro(self):
-        print("   ____                 ______ ")
-        print("  / __/__ ___  _______ /  _/ /_")
-        print(" _\ \/ -_) _ \/ __/ -_)/ // __/")
-        print("/___/\__/_//_/\__/\__/___/\__/ ")
-        print("")
-        print("-------------------------------")
-        print("Starting web server - listening on port 80")
+        return self.parser.parse(self.connection)
+
+    def _low_memory(self):
+        return low_memory(self.min_free)
+
+    def _shed(self, conn, reason):
+        """
+        Answer with a 503 without parsing the request and close the connection
+        """
+        self.metrics.shed += 1
+        log.warn("Shedding request: " + reason)
+        try:
+            # Read what the client already sent, closing a socket with unread
+            # data resets the connection and the client may lose the 503
+            conn.settimeout(0)
+            try:
+                conn.readinto(Stream.buffer())
+            except OSError:
+                pass
+            conn.settimeout(self.READ_TIMEOUT)
+            write_all(conn, self.shed_response)
+        except OSError as oserr:
+            log.severe(str(oserr))
+        finally:
+            self._close(conn)
+
+    def _subscribe(self, conn, stream):
+        self.clients.pop(conn, None)
+        # A slow reader must not hold up the server
+        conn.settimeout(0)
+        stream.subscribe(conn)
+        self.streams[conn] = stream
+        self.poller.register(conn, select.POLLIN)
+
+    def _unsubscribe(self, conn):
+        stream = self.streams.pop(conn, None)
+        if stream is None:
+            return
+        stream.unsubscribe(conn)
+        try:
+            self.poller.unregister(conn)
+        except (OSError, KeyError):
+            pass
+        conn.close()
+
+    def _flush_streams(self):
+        for (conn, stream) in list(self.streams.items()):
+            try:
+                stream.flush(conn)
+            except OSError as oserr:
+                log.warn("Event subscriber gone: " + str(oserr))
+                self._unsubscribe(conn)
+
+    def _close_idle(self):
+        now = ticks_ms()
+        for conn, client in list(self.clients.items()):
+            if ticks_diff(now, client[1]) > self.keep_alive_timeout:
+                self._close(conn)
+
+    def _close(self, conn):
+        if self.clients.pop(conn, None) is not None:
+            try:
+                self.poller.unregister(conn)
+            except (OSError, KeyError):
+                pass
+        conn.close()
+
+
+def shed_response(retry_after) -> bytes:
+    """
+    The 503 sent to shed a request
+    """
+    return (
+        "{} {}\r\nServer: {}\r\nRetry-After: {}\r\n"
+        "Connection: close\r\nContent-Length: 0\r\n\r\n".format(
+            Http.VERSION, Http.STATUS_CODE[503], Http.SERVER, retry_after
+        )
+    ).encode("utf-8")
+
+
+def low_memory(min_free) -> bool:
+    """
+    True if the free heap is below min_free bytes even after a collection
+    """
+    if not min_free:
+        return False
+    free = mem_free()
+    if free is None or free >= min_free:
+        return False
+    gc.collect()
+    return mem_free() < min_free
+
+
+def intro(port=80):
+    print("   ____                 ______ ")
+    print("  / __/__ ___  _______ /  _/ /_")
+    print(" _\\ \\/ -_) _ \\/ __/ -_)/ // __/")
+    print("/___/\\__/_//_/\\__/\\__/___/\\__/ ")
+    print("")
+    print("-------------------------------")
+    print("Starting web server - listening on port {}".format(port))
@@ -0,0 +1,78 @@
+##
+#
+# Emulates the MicroPython socket and select.poll APIs on top of CPython
+# sockets, so the Webserver can be run on a loopback interface in tests
+#
+##
+
+import select
+import socket
+
+
+class MicroSocket:
+    """
+    CPython socket with the MicroPython stream methods used by the server
+    """
+
+    def __init__(self, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def accept(self):
+        (conn, addr) = self.sock.accept()
+        return (MicroSocket(conn), addr)
+
+    def readinto(self, buf, nbytes=None):
+        return self.sock.recv_into(buf, nbytes or len(buf))
+
+    def readline(self):
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            c = self.sock.recv(1)
+            if not c:
+                break
+            line += c
+        return bytes(line)
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8")
+        self.sock.sendall(buf)
+        return len(buf)
+
+
+class MicroPoll:
+    """
+    select.poll that returns the registered objects instead of their file
+    descriptors, like MicroPython does
+    """
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.objects = {}
+
+    def register(self, obj, mask=select.POLLIN | select.POLLOUT):
+        self.objects[obj.fileno()] = obj
+        self.poller.register(obj.fileno(), mask)
+
+    def unregister(self, obj):
+        self.objects.pop(obj.fileno(), None)
+        self.poller.unregister(obj.fileno())
+
+    def poll(self, timeout=-1):
+        return [(self.objects[fd], ev) for (fd, ev) in self.poller.poll(timeout)]
+
+
+def micro_webserver(web):
+    """
+    Swap the sockets of a Webserver for their MicroPython counterparts
+    """
+    web.server.close()
+    web.server = MicroSocket()
+    web.poller = MicroPoll()
+    return web
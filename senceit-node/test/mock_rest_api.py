@@ -30,5 +30,10 @@ def get_config():
         return "", 204
 
 
+@app.route("/networks", methods=["GET"])
+def get_networks():
+    return jsonify({"networks": ["Swart", "Swart-LTE"], "age": 0})
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=4000)
@@ -0,0 +1,136 @@
+##
+#
+# Emulates machine.Pin and an HC-SR04 on a simulated microsecond clock, so
+# the ultrasonic drivers can be run on Linux
+#
+##
+
+
+class SimClock:
+    """
+    Microsecond clock with events that fire as it is advanced
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+        self.events = []
+
+    def ticks_us(self):
+        return self.now & ((1 << 30) - 1)
+
+    def at(self, t, action):
+        self.events.append((t, action))
+        self.events.sort(key=lambda e: e[0])
+
+    def advance(self, us):
+        end = self.now + us
+        while self.events and self.events[0][0] <= end:
+            (t, action) = self.events.pop(0)
+            self.now = t
+            action()
+        self.now = end
+
+    def sleep_us(self, us):
+        self.advance(us)
+
+    def sleep_ms(self, ms):
+        self.advance(ms * 1000)
+
+
+class SimPin:
+    """
+    machine.Pin with an interrupt handler that runs when the level changes
+    """
+
+    IN = 0
+    OUT = 1
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode=IN, pull=None):
+        self.id = id
+        self.mode = mode
+        self.level = 0
+        self.handler = None
+        self.trigger = 0
+        self.listeners = []
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        if level == self.level:
+            return
+        self.level = level
+        edge = self.IRQ_RISING if level else self.IRQ_FALLING
+        if self.handler and self.trigger & edge:
+            self.handler(self)
+        for listener in self.listeners:
+            listener(level)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self.handler = handler
+        self.trigger = trigger
+
+
+class SimHCSR04:
+    """
+    Answers each trigger pulse on the trigger pin with an echo pulse on the
+    echo pin whose length is the round trip time to `distance` mm. A distance
+    of None never echoes.
+    """
+
+    def __init__(self, clock, trigger, echo, distance=1000, delay=450):
+        self.clock = clock
+        self.echo = echo
+        self.distance = distance
+        self.delay = delay
+        self.pulses = 0
+        trigger.listeners.append(self._trigger)
+
+    def _trigger(self, level):
+        # The burst is sent on the falling edge of the trigger pulse
+        if level or self.distance is None:
+            return
+        self.pulses += 1
+        start = self.clock.now + self.delay
+        self.clock.at(start, lambda: self.echo.value(1))
+        self.clock.at(start + self.distance * 582 // 100, lambda: self.echo.value(0))
+
+
+class SimMachine:
+    """
+    The parts of the machine module used by the drivers, idle() lets the
+    simulated time pass
+    """
+
+    Pin = SimPin
+
+    def __init__(self, clock, step=50):
+        self.clock = clock
+        self.step = step
+        self.idles = 0
+
+    def idle(self):
+        self.idles += 1
+        self.clock.advance(self.step)
+
+
+class SimScheduler:
+    """
+    micropython.schedule that queues the callbacks until run() is called, like
+    the main loop does on a device
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self.queue = []
+
+    def schedule(self, func, arg):
+        if len(self.queue) >= self.size:
+            raise RuntimeError("schedule queue full")
+        self.queue.append((func, arg))
+
+    def run(self):
+        while self.queue:
+            (func, arg) = self.queue.pop(0)
+            func(arg)
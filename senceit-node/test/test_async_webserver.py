@@ -0,0 +1,303 @@
+import asyncio
+import json
+import os
+
+from test.test_jsonstream import dechunk
+from uhttp import (
+    Http,
+    HTTP_METHOD,
+    HttpResponse,
+    JsonStream,
+    EventStream,
+    RequestBufferParser,
+    Stream,
+)
+import webserver
+from async_webserver import AsyncWebserver
+
+
+def create_http():
+    http = Http()
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/config",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body={"id": "1"}),
+    )
+    http.register_handler(
+        HTTP_METHOD.POST,
+        "/config",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.body),
+    )
+    return http
+
+
+async def fetch(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    await writer.drain()
+    resp = await reader.read()
+    writer.close()
+    return resp.decode("utf-8")
+
+
+async def run_clients(web, requests):
+    server = await web.start(0, "127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+
+    # A slow client that never finishes its request
+    slow_reader, slow_writer = await asyncio.open_connection("127.0.0.1", port)
+    slow_writer.write(b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\n")
+    await slow_writer.drain()
+
+    try:
+        start = asyncio.get_event_loop().time()
+        responses = await asyncio.gather(*[fetch(port, r) for r in requests])
+        elapsed = asyncio.get_event_loop().time() - start
+
+        slow_resp = (await slow_reader.read()).decode("utf-8")
+    finally:
+        slow_writer.close()
+        web.close()
+
+    return responses, elapsed, slow_resp
+
+
+def test_concurrent_clients():
+    web = AsyncWebserver(create_http(), read_timeout=1, max_clients=8)
+    get = b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n\r\n"
+    body = b'{"wifi": {"ssid": "Swart"}}'
+    post = (
+        b"POST /config HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n"
+        b"Content-Type: application/json\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+    )
+
+    responses, elapsed, slow_resp = asyncio.run(
+        run_clients(web, [get, post, get, post, get, post])
+    )
+
+    assert len(responses) == 6
+    for resp in responses:
+        assert resp.startswith("HTTP/1.1 200 OK\r\n")
+
+    assert json.loads(responses[0].split("\r\n\r\n", 1)[1]) == {"id": "1"}
+    assert json.loads(responses[1].split("\r\n\r\n", 1)[1]) == {
+        "wifi": {"ssid": "Swart"}
+    }
+
+    # The stalled client must not hold up the others
+    assert elapsed < web.read_timeout
+    assert slow_resp.startswith("HTTP/1.1 408 Request Timeout")
+
+
+async def run_keep_alive(web):
+    server = await web.start(0, "127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+    get = b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n"
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        # Two pipelined requests on the same connection
+        writer.write(get + get)
+        await writer.drain()
+        resp = (await reader.read()).decode("utf-8")
+        writer.close()
+    finally:
+        web.close()
+    return resp
+
+
+def test_keep_alive():
+    web = AsyncWebserver(create_http(), keep_alive_timeout=0.2)
+    resp = asyncio.run(run_keep_alive(web))
+
+    assert resp.count("HTTP/1.1 200 OK\r\n") == 2
+    assert resp.count("Connection: keep-alive\r\n") == 2
+
+
+async def run_range(web, request):
+    server = await web.start(0, "127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request)
+        await writer.drain()
+        resp = await reader.read()
+        writer.close()
+    finally:
+        web.close()
+    return resp
+
+
+def test_range():
+    http = Http()
+    http.set_www_root(os.path.join(os.getcwd(), "www"))
+    web = AsyncWebserver(http)
+    request = (
+        b"GET /js/scripts.js HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+        b"Range: bytes=3000-\r\nConnection: close\r\n\r\n"
+    )
+    resp = asyncio.run(run_range(web, request))
+
+    with open(os.path.join(os.getcwd(), "www", "js", "scripts.js"), "rb") as f:
+        content = f.read()
+    (head, body) = resp.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert body == content[3000:]
+
+    # Larger than the shared buffer, copied through it in several chunks
+    request = b"GET /js/scripts.js HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n"
+    web = AsyncWebserver(http, keep_alive=False)
+    resp = asyncio.run(run_range(web, request))
+    assert len(content) > len(Stream.buffer())
+    assert resp.split(b"\r\n\r\n", 1)[1] == content
+
+
+def test_header_too_large():
+    web = AsyncWebserver(create_http())
+    request = (
+        b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+        b"Cookie: " + b"x" * RequestBufferParser.BUFFER_SIZE + b"\r\n\r\n"
+    )
+    resp = asyncio.run(run_range(web, request))
+    assert resp.startswith(b"HTTP/1.1 431 Request Header Fields Too Large\r\n")
+
+
+def test_request_body():
+    web = AsyncWebserver(create_http())
+    post = (
+        b"POST /config HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n"
+        b"Content-Type: application/json\r\nContent-Length: {}\r\n\r\n"
+    )
+    small = {"wifi": {"ssid": "Swart"}}
+    # Larger than the buffer of the connection
+    large = {"names": ["sensor {}".format(i) for i in range(150)]}
+    for body in (small, large):
+        data = json.dumps(body).encode()
+        request = post.replace(b"{}", str(len(data)).encode()) + data
+        resp = asyncio.run(run_range(web, request))
+        assert resp.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert json.loads(resp.split(b"\r\n\r\n", 1)[1]) == body
+
+    resp = asyncio.run(run_range(web, post.replace(b"{}", b"7") + b'{"id": '))
+    assert resp.startswith(b"HTTP/1.1 400 Bad Request")
+
+
+def records(n, fail=False):
+    for i in range(n):
+        yield {"timestamp": 1590000000 + i, "value": i}
+    if fail:
+        raise ValueError("Sensor log corrupt")
+
+
+def test_json_stream():
+    http = create_http()
+    for (path, fail) in [("/history", False), ("/broken", True)]:
+        http.register_handler(
+            HTTP_METHOD.GET,
+            path,
+            lambda req, fail=fail: HttpResponse.ok(
+                200, Http.MIME_TYPE["JSON"], body=JsonStream(records(100, fail))
+            ),
+        )
+    get = b"GET {} HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n\r\n"
+
+    web = AsyncWebserver(http)
+    resp = asyncio.run(run_range(web, get.replace(b"{}", b"/history")))
+    (head, body) = resp.split(b"\r\n\r\n", 1)
+    assert b"Transfer-Encoding: chunked" in head
+    (body, sizes) = dechunk(body)
+    assert json.loads(body) == list(records(100))
+    # Sent while it is encoded
+    assert len(sizes) > 1 and max(sizes) < 2 * web.CHUNK_SIZE
+
+    # A failing stream only cuts off its own response
+    web = AsyncWebserver(http)
+    resp = asyncio.run(run_range(web, get.replace(b"{}", b"/broken")))
+    assert resp.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert not resp.endswith(b"0\r\n\r\n")
+    assert http.metrics.routes["GET /broken"].status[4] == 1
+
+
+async def run_events(web, events):
+    server = await web.start(0, "127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n")
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        retry = await reader.readuntil(b"\n\n")
+        assert len(events.subscribers) == 1
+
+        # A subscriber alone doesn't keep the server busy
+        assert web.idle()
+        events.publish('{"level": 42}', "1")
+        event = await asyncio.wait_for(reader.readuntil(b"\n\n"), 2)
+
+        # Other clients are still served
+        config = await fetch(
+            port,
+            b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n\r\n",
+        )
+
+        writer.close()
+        for i in range(20):
+            if not events.subscribers:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        web.close()
+    return (head, retry, event, config)
+
+
+def test_event_stream():
+    http = create_http()
+    events = EventStream()
+    http.serve_events("/events", events)
+    web = AsyncWebserver(http)
+    web.EVENT_POLL = 0.05
+    (head, retry, event, config) = asyncio.run(run_events(web, events))
+
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Content-Type: text/event-stream" in head
+    assert retry == b"retry: 3000\n\n"
+    assert event == b'event: 1\ndata: {"level": 42}\n\n'
+    assert config.startswith("HTTP/1.1 200 OK\r\n")
+    # Unsubscribed once the client disconnected
+    assert not events.subscribers
+
+
+async def run_shedding(web, monkeypatch):
+    server = await web.start(0, "127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+    get = b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\nConnection: close\r\n\r\n"
+    try:
+        # Holds the only client slot
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /config HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n")
+        await reader.readuntil(b"\r\n\r\n")
+        assert not web.idle()
+        busy = await fetch(port, get)
+
+        writer.close()
+        await asyncio.sleep(0.1)
+        served = await fetch(port, get)
+
+        # Below the heap watermark
+        monkeypatch.setattr(webserver, "mem_free", lambda: web.min_free - 1)
+        low = await fetch(port, get)
+    finally:
+        web.close()
+    return (busy, served, low)
+
+
+def test_load_shedding(monkeypatch):
+    web = AsyncWebserver(create_http(), max_clients=1)
+    (busy, served, low) = asyncio.run(run_shedding(web, monkeypatch))
+
+    assert busy.startswith("HTTP/1.1 503 Service Unavailable\r\n")
+    assert "Retry-After: 1\r\n" in busy
+    assert served.startswith("HTTP/1.1 200 OK\r\n")
+    assert low.startswith("HTTP/1.1 503 Service Unavailable\r\n")
+    assert web.shed == 2
+    assert web.clients == 0
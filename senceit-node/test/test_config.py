@@ -6,8 +6,9 @@ sys.modules["network"] = Mock()
 sys.modules["esp"] = Mock()
 sys.modules["machine"] = Mock()
 
-from esp8266 import ESP8266
+from esp8266 import ESP8266, NetworkCache
 from esp_io import DataLoggerFactory, DataLogger
+from scheduler import Scheduler
 
 
 def test_id():
@@ -69,6 +70,11 @@ def test_get_config_match():
         interval = device._get_interval(k)
         assert interval == "15m"
 
+        assert device._get_format(k) == "json"
+        device.config["payload"] = {topic: "cbor"}
+        assert device._get_format(k) == "cbor"
+        assert device._get_publish(k) is None
+
         loc = device._get_location()
         assert loc is not None
 
@@ -78,3 +84,46 @@ def test_get_config_match():
             p_id, device.id, loc, tx, topic, interval, None, pin_mapping, parms,
         )
         assert isinstance(logger, DataLogger)
+
+
+def test_network_cache():
+    scans = []
+
+    def scan():
+        scans.append(1)
+        if len(scans) == 3:
+            raise OSError("scan failed")
+        return ["net{}".format(len(scans))]
+
+    cache = NetworkCache(scan, ttl=1000)
+    assert cache.json() == {"networks": [], "age": None}
+
+    now = [0]
+    scheduler = Scheduler(lambda: now[0])
+    cache.start(scheduler)
+    assert cache.networks == ["net1"]
+    assert cache.age() >= 0
+    # Not due until the task runs
+    now[0] = 999
+    scheduler.run_pending()
+    assert not cache.update()
+    assert len(scans) == 1
+
+    now[0] = 1000
+    scheduler.run_pending()
+    assert cache.update()
+    assert cache.networks == ["net2"]
+    assert not cache.update()
+
+    # A failed scan keeps the last networks
+    cache.refresh()
+    assert cache.networks == ["net2"]
+    cache.stop()
+    assert cache.task is None
+    assert scheduler.next_delay() is None
+
+
+def test_wifi_networks_cached():
+    device = ESP8266(os.path.join(os.getcwd(), "test"))
+    device.networks.networks = ["Swart"]
+    assert device.wifi_networks == ["Swart"]
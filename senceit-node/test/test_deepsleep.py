@@ -0,0 +1,223 @@
+import sys
+from unittest.mock import Mock
+
+sys.modules["machine"] = Mock()
+
+import esp_io
+from esp_io import DataLogger, LevelSensor
+from deepsleep import DutyCycle, RtcState
+import payload
+
+
+class SimRtc:
+    """
+    RTC memory of the ESP8266, kept across deep sleep
+    """
+
+    def __init__(self):
+        self.data = b""
+
+    def memory(self, data=None):
+        if data is None:
+            return self.data
+        if len(data) > RtcState.SIZE:
+            raise ValueError("buffer too long")
+        self.data = bytes(data)
+
+
+class SimMachine:
+    """
+    Reset cause shim, deepsleep() only records the time asked for
+    """
+
+    PWRON_RESET = 0
+    DEEPSLEEP_RESET = 5
+
+    def __init__(self):
+        self.cause = self.PWRON_RESET
+        self.sleeps = []
+
+    def reset_cause(self):
+        return self.cause
+
+    def deepsleep(self, ms):
+        self.sleeps.append(ms)
+        self.cause = self.DEEPSLEEP_RESET
+
+
+class SimTime:
+    def __init__(self):
+        self.now = 1000000
+
+    def time(self):
+        return self.now
+
+    def sleep_ms(self, ms):
+        pass
+
+
+class Echo:
+    def __init__(self, distance):
+        self.distance = distance
+
+    def distance_mm(self):
+        return self.distance
+
+
+class Node:
+    """
+    A node that boots from scratch on every wake, like after a deep sleep
+    """
+
+    def __init__(self, monkeypatch, batch=None, interval="15m", publish=None):
+        self.rtc = SimRtc()
+        self.machine = SimMachine()
+        self.time = SimTime()
+        monkeypatch.setattr(esp_io, "time", self.time)
+        self.sent = []
+        self.batch = batch
+        self.interval = interval
+        self.publish = publish
+        self.cycle = None
+
+    def boot(self, distance=900):
+        parameters = {
+            "dam_height": {"value": 1500, "unit": "mm"},
+            "sensor_height": {"value": 1700, "unit": "mm"},
+            "sampling": {"mode": "fixed", "samples": 1},
+            "filter": {"type": "median", "window": 3},
+        }
+        sensor = LevelSensor("USLS01", {"trigger_pin": 4, "echo_pin": 5}, parameters)
+        sensor.sensor = Echo(distance)
+        sender = lambda topic, message: self.sent.append(payload.decode(message))
+        logger = DataLogger(
+            "FB20GY",
+            (25.5, -23.5),
+            sender,
+            self.interval,
+            "dam/level",
+            sensor,
+            self.batch,
+            "cbor",
+            self.publish,
+        )
+        self.cycle = DutyCycle({"0": logger}, self.rtc, self.machine, self.time.time)
+        return self.cycle.restore()
+
+    def wake(self, distance=900):
+        """
+        Boot, take the due readings and sleep, returns whether the state was
+        restored and the number of readings
+        """
+        restored = self.boot(distance)
+        n = self.cycle.run()
+        self.cycle.sleep()
+        self.time.now += self.machine.sleeps[-1] // 1000
+        return (restored, n)
+
+    @property
+    def logger(self):
+        return self.cycle.loggers["0"]
+
+
+def sent_levels(node):
+    return [m[1] for p in node.sent for m in p["measurements"]]
+
+
+def continuous(monkeypatch, distances, **kwargs):
+    """
+    The same loggers run without sleeping, the levels and counters to expect
+    """
+    node = Node(monkeypatch, **kwargs)
+    node.boot()
+    for d in distances:
+        node.logger.sensor.sensor.distance = d
+        node.logger.run()
+        node.time.now += 900
+    return (sent_levels(node), node.logger.counters())
+
+
+def test_duty_cycle(monkeypatch):
+    distances = [900, 910, 2000, 905, 300, 903, 904]
+    expected = continuous(monkeypatch, distances, batch={"size": 3})
+    node = Node(monkeypatch, batch={"size": 3})
+    results = [node.wake(d) for d in distances]
+
+    # Only the first boot is from power on
+    assert results == [(False, 1)] + [(True, 1)] * 6
+    assert node.machine.sleeps == [900000] * 7
+    assert node.cycle.wakes == 7
+
+    # The batch is kept in RTC memory until it is full, the median filter
+    # carries on as if the node never slept
+    assert [len(p["measurements"]) for p in node.sent] == [3, 3]
+    assert (sent_levels(node), node.logger.counters()) == expected
+    assert [m[0] for m in node.sent[1]["measurements"]] == [
+        1000000 + 900 * i for i in range(3, 6)
+    ]
+
+    node.boot()
+    assert node.logger.batch.count == 1
+    assert node.logger.batch.readings[0][0] == 1000000 + 900 * 6
+
+
+def test_reset_cause(monkeypatch):
+    node = Node(monkeypatch, batch={"size": 4})
+    node.wake()
+    node.wake()
+    assert node.boot()
+    assert node.logger.batch.count == 2
+
+    # After a power cycle or the reset button the state is not trusted
+    node.machine.cause = SimMachine.PWRON_RESET
+    assert not node.boot()
+    assert node.logger.batch.count == 0
+
+    # Neither is RTC memory that doesn't hold a state
+    node.machine.cause = SimMachine.DEEPSLEEP_RESET
+    for data in (b"", b"\x00\x01", b"\x31\x85", b"\x31\x82\x01\x80\x00"):
+        node.rtc.data = data
+        assert not node.boot()
+
+
+def test_schedule(monkeypatch):
+    node = Node(monkeypatch, interval="2h")
+    # Longer intervals are slept in parts
+    assert node.wake() == (False, 1)
+    assert node.wake() == (True, 0)
+    assert node.wake() == (True, 1)
+    assert node.machine.sleeps == [3600000] * 3
+
+    # A late wake keeps the readings on the interval grid
+    node.time.now += 300
+    assert node.wake() == (True, 0)
+    assert node.machine.sleeps[-1] == 3300000
+    assert node.wake() == (True, 1)
+    assert len(node.sent) == 3
+
+    # Readings missed while the node was off are skipped
+    node.time.now += 5 * 3600
+    assert node.wake() == (True, 1)
+    assert node.machine.sleeps[-1] == 3600000
+
+
+def test_deadband_state(monkeypatch):
+    distances = [900, 901, 902, 903, 950, 950, 950, 950]
+    publish = {"deadband": 5, "heartbeat": 3}
+    expected = continuous(monkeypatch, distances, publish=publish)
+    node = Node(monkeypatch, publish=publish)
+    for d in distances:
+        node.wake(d)
+    assert (sent_levels(node), node.logger.counters()) == expected
+    assert 0 < expected[1]["suppressed"] < len(distances)
+
+
+def test_state_too_large(monkeypatch):
+    node = Node(monkeypatch, batch={"size": 100})
+    for i in range(40):
+        node.wake()
+    # The batch outgrew RTC memory and was sent rather than lost
+    assert len(node.sent) == 1
+    assert 0 < len(node.rtc.data) <= RtcState.SIZE
+    assert node.boot()
+    assert node.logger.batch.count + len(node.sent[0]["measurements"]) == 40
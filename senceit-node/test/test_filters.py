@@ -0,0 +1,81 @@
+import random
+import statistics
+
+import pytest
+
+import filters
+from filters import Window, MedianFilter, EmaFilter, HampelFilter, FilterChain
+
+
+def test_window():
+    rand = random.Random(1)
+    window = Window(7)
+    values = []
+    for i in range(200):
+        value = rand.randrange(0, 2000) if i % 20 else 65535
+        window.push(value)
+        values = (values + [value])[-7:]
+        assert list(window.sorted[: window.count]) == sorted(values)
+
+        median = statistics.median(values)
+        assert window.median() == int(median)
+        mad = statistics.median([abs(v - window.median()) for v in values])
+        assert window.mad(window.median()) == int(mad)
+
+    window.reset()
+    window.push(5)
+    assert window.median() == 5 and window.mad(5) == 0
+
+
+def test_median_filter():
+    f = MedianFilter(3)
+    assert [f.update(v) for v in [10, 30, 20, 900, 22, 21]] == [10, 20, 20, 30, 22, 22]
+
+
+def test_ema_filter():
+    f = EmaFilter(0.5)
+    assert f.update(100) == 100
+    assert f.update(200) == 150
+    assert f.update(200) == 175
+
+    # Converges on a constant value
+    f = EmaFilter(0.1)
+    f.update(0)
+    for i in range(200):
+        value = f.update(800)
+    assert value == 800
+
+    f.reset()
+    assert f.update(300) == 300
+
+
+def test_hampel_filter():
+    f = HampelFilter(5)
+    readings = [800, 802, 801, 799, 1500, 800, 40, 801]
+    out = [f.update(v) for v in readings]
+    assert out == [800, 802, 801, 799, 800, 800, 801, 801]
+
+    # A real step change is followed once it fills most of the window
+    f = HampelFilter(5)
+    out = [f.update(v) for v in [800, 801, 800, 799, 800] + [600] * 4]
+    assert out[5:] == [800, 800, 799, 600]
+
+
+def test_create():
+    assert filters.create(None) is None
+    assert filters.create([]) is None
+
+    chain = filters.create("median")
+    assert isinstance(chain, FilterChain)
+    assert chain.filters[0].window.size == MedianFilter.WINDOW
+
+    chain = filters.create(
+        [{"type": "hampel", "window": 9, "k": 2}, {"type": "ema", "alpha": 0.5}]
+    )
+    assert isinstance(chain.filters[0], HampelFilter)
+    assert chain.filters[0].window.size == 9
+    assert isinstance(chain.filters[1], EmaFilter)
+    assert chain.update(500) == 500 and chain.value == 500
+
+    with pytest.raises(AttributeError):
+        filters.create({"type": "kalman"})
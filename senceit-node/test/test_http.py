@@ -3,16 +3,25 @@ from util import StringBuilder
 from uhttp import (
     Http,
     RequestStreamParser,
+    RequestBufferParser,
+    HttpError,
     Route,
     HttpRequest,
     HTTP_METHOD,
     HttpResponse,
     File,
+    Stream,
+    EventStream,
+    write_all,
 )
 
+import errno
+import io
 import os
 import json
 
+import pytest
+
 
 def test_route():
     rt1 = Route(HTTP_METHOD.GET, "/root")
@@ -104,6 +113,7 @@ def test_full_request_parsing_2():
         == "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9"
     )
     assert req.header["Accept-Encoding"] == "gzip, deflate, br"
+    assert req.header["If-None-Match"] == 'W/"c659578de226ec44881aae46b54cc34b"'
 
 
 def test_full_request_parsing_3():
@@ -157,3 +167,259 @@ def test_full_request_parsing_4():
     assert req.body == json.loads(
         '{"wifi":{"ssid":"Swart","password":"870622eta"},"mqtt":{"ip":"10.0.0.114"},"location":["25","-23"],"peripherals":{"0":{"type":"sensor","name":"LevelSensor","id":"USLS01","config":{"interval":"1m","trigger":null,"topic":"dam/level/1","parameters":{"dam_height":{"value":"1500","unit":"mm"},"sensor_height":{"value":"1700","unit":"mm"},"dam_diameter":{"value":"5","unit":"m"}}}}}}'
     )
+
+
+class ChunkedStream:
+    """
+    Stream that returns at most `size` bytes per readinto, like a socket
+    """
+
+    def __init__(self, data, size):
+        self.data = data
+        self.pos = 0
+        self.size = size
+
+    def readinto(self, buf):
+        n = min(len(buf), self.size, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+def parse_lines(path):
+    parser = RequestStreamParser("\n")
+    with open(path, "rb") as f:
+        status = parser.update(str(f.readline(), "utf-8"))
+        while status:
+            status = parser.update(str(f.readline(), "utf-8"))
+    return parser.get_request()
+
+
+def assert_same_request(req1, req2):
+    assert req1.route == req2.route
+    assert req1.header == req2.header
+    assert req1.query == req2.query
+    assert req1.body == req2.body
+    assert req1.protocol == req2.protocol
+    assert req1.domain == req2.domain
+
+
+def test_buffer_parser_matches_stream_parser():
+    for name in ["request1.txt", "request2.txt", "request4.txt"]:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        expected = parse_lines(path)
+        assert_same_request(RequestBufferParser().parse(io.BytesIO(data)), expected)
+        # Tiny reads force the buffer to be compacted mid-line
+        assert_same_request(
+            RequestBufferParser().parse(ChunkedStream(data, 7)), expected
+        )
+
+
+def test_buffer_parser_crlf_and_pipelining():
+    body = b'{"wifi": {"ssid": "Swart"}}'
+    data = (
+        b"POST /config HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+        b"content-length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+    ) + b"GET /js/scripts.min.js?v=2 HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n"
+
+    parser = RequestBufferParser()
+    stream = io.BytesIO(data)
+
+    req = parser.parse(stream)
+    assert req.route == Route(HTTP_METHOD.POST, "/config")
+    assert req.header["Content-Length"] == str(len(body))
+    assert req.body == {"wifi": {"ssid": "Swart"}}
+
+    req = parser.parse(stream)
+    assert req.route == Route(HTTP_METHOD.GET, "/js/scripts.min.js")
+    assert req.query == {"v": "2"}
+    assert req.body is None
+    assert parser.buffered() == 0
+
+
+def test_buffer_parser_errors():
+    parser = RequestBufferParser(64)
+    with pytest.raises(HttpError) as err:
+        parser.parse(io.BytesIO(b"GET /" + b"a" * 100 + b" HTTP/1.1\r\n\r\n"))
+    assert err.value.code == 431
+
+    parser = RequestBufferParser()
+    with pytest.raises(HttpError) as err:
+        parser.parse(io.BytesIO(b"GET / HTTP/2.0\r\n\r\n"))
+    assert err.value.code == 505
+
+    parser.clear()
+    with pytest.raises(OSError):
+        parser.parse(io.BytesIO(b"GET / HTTP/1.1\r\nHost: x"))
+
+
+def post(body, length=None):
+    length = len(body) if length is None else length
+    return (
+        b"POST /config HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+        b"Content-Length: " + str(length).encode() + b"\r\n\r\n" + body
+    )
+
+
+def test_buffer_parser_body_limits():
+    # Refused from the headers alone, the body is never read
+    stream = io.BytesIO(post(b"", 4096))
+    with pytest.raises(HttpError) as err:
+        RequestBufferParser(max_body=1024).parse(stream)
+    assert err.value.code == 413
+
+    with pytest.raises(HttpError) as err:
+        parser = RequestStreamParser(max_body=1024)
+        parser.update("POST /config HTTP/1.1\r\n")
+        parser.update("Content-Length: 4096\r\n")
+    assert err.value.code == 413
+
+    for body in [b'{"a": [[[[1]]]]}', b'{"a": 1', b"not json"]:
+        with pytest.raises(HttpError) as err:
+            RequestBufferParser(max_depth=4).parse(io.BytesIO(post(body)))
+        assert err.value.code == 400
+
+    # A body larger than the parser buffer
+    body = json.dumps({"values": list(range(300))}).encode()
+    parser = RequestBufferParser(128)
+    stream = ChunkedStream(post(body) + b"GET / HTTP/1.1\r\n\r\n", 50)
+    assert parser.parse(stream).body == {"values": list(range(300))}
+    assert parser.parse(stream).route == Route(HTTP_METHOD.GET, "/")
+
+
+class ShortWriteSocket:
+    """
+    Socket that accepts at most `size` bytes per write and sometimes
+    none at all
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+        self.writes = 0
+
+    def write(self, buf):
+        self.writes += 1
+        if self.writes % 3 == 0:
+            return None
+        n = min(self.size, len(buf))
+        self.data += buf[:n]
+        return n
+
+
+def test_stream_pipe_short_writes():
+    path = os.path.join(os.getcwd(), "www", "js", "scripts.js")
+    with open(path, "rb") as f:
+        content = f.read()
+
+    dest = ShortWriteSocket(536)
+    Stream(path).pipe(dest)
+    assert dest.data == content
+
+    # Headers are sent with the first chunk
+    head = b"HTTP/1.1 200 OK\r\n\r\n"
+    dest = ShortWriteSocket(len(Stream.buffer()))
+    Stream(path).pipe(dest, head)
+    assert dest.data == head + content
+    assert dest.writes <= len(content) // len(Stream.buffer()) + 3
+
+    # Headers larger than the buffer are written on their own
+    head = b"X" * (len(Stream.buffer()) + 1)
+    dest = ShortWriteSocket(10000)
+    Stream(path).pipe(dest, head)
+    assert dest.data == head + content
+
+
+def test_write_all():
+    dest = ShortWriteSocket(3)
+    write_all(dest, b"HTTP/1.1 200 OK\r\n")
+    assert dest.data == b"HTTP/1.1 200 OK\r\n"
+
+
+def test_response_write():
+    body = {"networks": ["Swart", "Swart-LTE"], "id": "FB20GY"}
+    resp = HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=body)
+    resp.headers["Connection"] = "keep-alive"
+    resp.headers["X-Custom"] = "1"
+    dest = ShortWriteSocket(100)
+    resp.write(dest)
+    assert bytes(dest.data) == str(resp).encode("utf-8")
+
+    resp = HttpResponse(304, Http.MIME_TYPE["HTML"], {"ETag": '"abc"'})
+    dest = ShortWriteSocket(100)
+    resp.write(dest)
+    assert bytes(dest.data) == str(resp).encode("utf-8")
+
+    # A body larger than the buffer
+    resp = HttpResponse.ok(200, Http.MIME_TYPE["TEXT"], body="x" * 5000)
+    dest = ShortWriteSocket(1000)
+    resp.write(dest)
+    assert bytes(dest.data) == str(resp).encode("utf-8")
+
+
+def test_response_write_stream():
+    http = Http()
+    http.set_www_root(os.path.join(os.getcwd(), "www"))
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/img/silogo42x136.png"), {}))
+    resp = http.get_response()
+
+    dest = ShortWriteSocket(100000)
+    resp.write(dest)
+    with open(os.path.join(os.getcwd(), "www", "img", "silogo42x136.png"), "rb") as f:
+        content = f.read()
+    assert bytes(dest.data) == str(resp).encode("utf-8") + content
+    # The headers share the first write with the file: three chunks plus
+    # one write that would have blocked
+    assert len(Stream.buffer()) == Stream.MAX_CHUNK
+    assert dest.writes == 4
+
+
+class FullSocket:
+    def write(self, buf):
+        raise OSError(errno.EAGAIN)
+
+
+def test_event_stream():
+    msg = EventStream.encode('{"level": 1}', "2")
+    assert msg == b'event: 2\ndata: {"level": 1}\n\n'
+    assert EventStream.encode("a\nb") == b"data: a\ndata: b\n\n"
+
+    events = EventStream(max_subscribers=1, queue_size=3)
+    req = HttpRequest(Route(HTTP_METHOD.GET, "/events"), {})
+    resp = events.handle(req)
+    assert resp.status == 200
+    assert resp.is_event_stream()
+    assert str(resp).endswith("retry: 3000\n\n")
+    assert "Content-Length" not in str(resp)
+
+    # Nothing is queued without subscribers
+    events.publish("0")
+    dest = ShortWriteSocket(4)
+    events.subscribe(dest)
+    assert events.handle(req).status == 503
+
+    # A slow reader loses its oldest events, never the one partly sent
+    for n in range(1, 5):
+        events.publish(str(n))
+    assert events.dropped == 1
+    events.flush(dest)
+    assert bytes(dest.data) == b"data"
+    events.publish("5")
+    assert events.dropped == 2
+    while events.subscribers[dest][0]:
+        events.flush(dest)
+    assert bytes(dest.data) == b"data: 2\n\ndata: 4\n\ndata: 5\n\n"
+
+    # A full socket keeps the queue
+    events.subscribe(FullSocket())
+    events.unsubscribe(dest)
+    events.publish("6")
+    conn = list(events.subscribers)[0]
+    events.flush(conn)
+    assert len(events.subscribers[conn][0]) == 1
+
+    events.unsubscribe(conn)
+    assert events.handle(req).status == 200
@@ -0,0 +1,202 @@
+import io
+import json
+
+import pytest
+
+from jsonstream import iterencode, JsonDecoder
+from uhttp import (
+    Http,
+    HttpRequest,
+    HttpResponse,
+    HTTP_METHOD,
+    JsonStream,
+    Route,
+    Stream,
+)
+
+
+class MockSocket:
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+
+    def write(self, buf):
+        self.writes += 1
+        self.data += buf
+        return len(buf)
+
+
+def records(n):
+    for i in range(n):
+        yield {"timestamp": 1590000000 + i, "value": i, "unit": "mm"}
+
+
+def dechunk(data):
+    """
+    Returns the decoded body and the sizes of the chunks
+    """
+    body = bytearray()
+    sizes = []
+    while True:
+        (size, data) = data.split(b"\r\n", 1)
+        size = int(size, 16)
+        if size == 0:
+            assert data == b"\r\n"
+            return (bytes(body), sizes)
+        sizes.append(size)
+        body += data[:size]
+        assert data[size : size + 2] == b"\r\n"
+        data = data[size + 2 :]
+
+
+def test_iterencode():
+    from config import config
+
+    doc = {
+        "config": config,
+        "networks": (n for n in ["Swart", "Swart-LTE"]),
+        "empty": {},
+        "none": [],
+        "values": [1, 2.5, True, False, None, '"quoted" é'],
+        1: "int key",
+    }
+
+    assert json.loads("".join(iterencode(doc))) == {
+        "config": json.loads(json.dumps(config)),
+        "networks": ["Swart", "Swart-LTE"],
+        "empty": {},
+        "none": [],
+        "values": [1, 2.5, True, False, None, '"quoted" é'],
+        "1": "int key",
+    }
+    assert "".join(iterencode(records(0))) == "[]"
+
+    # Like json.dumps, only iterators are taken for arrays
+    for value in [b"raw", bytearray(2), {1, 2}, object()]:
+        with pytest.raises(TypeError):
+            "".join(iterencode({"value": value}))
+
+
+def test_chunked_response():
+    resp = HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=JsonStream(records(500)))
+    assert resp.is_chunked()
+    assert resp.headers["Transfer-Encoding"] == "chunked"
+    assert "Content-Length" not in resp.headers
+
+    dest = MockSocket()
+    resp.write(dest)
+    (head, body) = bytes(dest.data).split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Transfer-Encoding: chunked" in head
+
+    (body, sizes) = dechunk(body)
+    assert json.loads(body) == list(records(500))
+
+    # Chunks are bounded by the buffer and each goes out in a single write
+    assert max(sizes) < len(Stream.buffer())
+    assert dest.writes == len(sizes)
+
+
+def test_chunked_str():
+    resp = HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=JsonStream(records(3)))
+    (head, body) = str(resp).encode("utf-8").split(b"\r\n\r\n", 1)
+    assert json.loads(dechunk(body)[0]) == list(records(3))
+
+
+def test_handler_returns_records():
+    http = Http()
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/history",
+        lambda req: HttpResponse.ok(
+            200, Http.MIME_TYPE["JSON"], body=JsonStream(records(10))
+        ),
+    )
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/history"), {}))
+
+    dest = MockSocket()
+    http.get_response().write(dest)
+    body = bytes(dest.data).split(b"\r\n\r\n", 1)[1]
+    assert json.loads(dechunk(body)[0]) == list(records(10))
+
+
+def test_chunked_response_large_headers():
+    for pad in [2000, 2030, 2040]:
+        resp = HttpResponse.ok(
+            200,
+            Http.MIME_TYPE["JSON"],
+            body=JsonStream([]),
+            headers={"X-Pad": "x" * (len(Stream.buffer()) - pad)},
+        )
+        dest = MockSocket()
+        resp.write(dest)
+        body = bytes(dest.data).split(b"\r\n\r\n", 1)[1]
+        assert dechunk(body)[0] == b"[]"
+
+
+def decode(data, size=16, **kwargs):
+    return JsonDecoder(io.BytesIO(data), len(data), bytearray(size), **kwargs).decode()
+
+
+def test_json_decoder():
+    docs = [
+        {"wifi": {"ssid": "Swart", "password": "870622eta"}, "id": "FB20GY"},
+        {"location": [-25.7479, 28.2293], "trigger": None, "on": True, "off": False},
+        [1, -2, 3.5, 1e3, "", [], {}, [[]]],
+        {
+            "text": 'quote " backslash \\ slash / tab \t newline \n',
+            "unicode": "Dam \u00e9\U0001f4a7",
+        },
+        "plain",
+        42,
+    ]
+    for doc in docs:
+        data = json.dumps(doc, indent=2).encode("utf-8")
+        # A 4 byte buffer forces refills mid token
+        assert decode(data, 4) == doc
+        assert decode(data, 1024) == doc
+        # Non-ASCII characters escaped as \uXXXX, including surrogate pairs
+        assert decode(json.dumps(doc, ensure_ascii=True).encode()) == doc
+
+
+def test_json_decoder_prebuffered():
+    data = b'{"mqtt": {"ip": "10.0.0.114"}}'
+    buf = bytearray(64)
+    buf[:12] = b"GARBAGE" + data[:5]
+    stream = io.BytesIO(data[5:] + b"GET / HTTP/1.1")
+    decoder = JsonDecoder(stream, len(data), buf, 7, 12)
+    assert decoder.decode() == {"mqtt": {"ip": "10.0.0.114"}}
+    # Never reads past the end of the document
+    assert stream.read() == b"GET / HTTP/1.1"
+
+    # A document already completely in the buffer
+    buf[: len(data) + 3] = data + b"GET"
+    decoder = JsonDecoder(None, len(data), buf, 0, len(data) + 3)
+    assert decoder.decode() == {"mqtt": {"ip": "10.0.0.114"}}
+    assert decoder.refills == 0
+    assert decoder.pos == len(data)
+
+
+def test_json_decoder_errors():
+    for data in [
+        b'{"a": 1',
+        b'{"a" 1}',
+        b'{"a": 1,}',
+        b"[1 2]",
+        b"tru",
+        b'"a\\qb"',
+        b'"new\nline"  x',
+        b"{'a': 1}",
+        b"",
+    ]:
+        with pytest.raises(ValueError):
+            decode(data)
+
+    nested = b"[" * 5 + b"]" * 5
+    assert decode(nested, max_depth=5) == [[[[[]]]]]
+    with pytest.raises(ValueError):
+        decode(nested, max_depth=4)
+
+    # The stream ends before Content-Length bytes were received
+    with pytest.raises(OSError):
+        JsonDecoder(io.BytesIO(b'{"a": 1'), 20, bytearray(16)).decode()
@@ -3,7 +3,18 @@
 # Author: Niel Swart
 #
 ##
+import sys
+from unittest.mock import Mock
+
+import pytest
+
+sys.modules["machine"] = Mock()
+
+import esp_io
+from esp_io import LevelSensor, Sensor, DataLogger, Batch, Deadband
+from scheduler import Scheduler
 from util import signal_filter
+import payload
 
 
 def test_calc_volume():
@@ -18,3 +29,311 @@ def test_filter():
     ave = signal_filter(samples)
 
     assert ave - 341.67 < 1
+
+
+class FakeEcho:
+    """
+    Replays distance readings, None is an echo timeout
+    """
+
+    def __init__(self, readings):
+        self.readings = list(readings)
+        self.taken = 0
+
+    def distance_mm(self):
+        t = self.readings[self.taken]
+        self.taken += 1
+        if t is None:
+            raise OSError("Out of range")
+        return t
+
+
+class FakeTime:
+    @staticmethod
+    def sleep_ms(ms):
+        pass
+
+
+def level_sensor(readings, filter=None, **sampling):
+    parameters = {
+        "dam_height": {"value": 1500, "unit": "mm"},
+        "sensor_height": {"value": 1700, "unit": "mm"},
+        "sampling": sampling,
+        "filter": filter,
+    }
+    sensor = LevelSensor("USLS01", {"trigger_pin": 4, "echo_pin": 5}, parameters)
+    sensor.sensor = FakeEcho(readings)
+    return sensor
+
+
+def test_spread():
+    assert LevelSensor.spread([]) == 0
+    assert LevelSensor.spread([500]) == 0
+    assert LevelSensor.spread([500, 510, 520]) == 20
+    assert LevelSensor.spread([100, 500, 502, 503, 900]) == 3
+
+
+def test_adaptive_sampling(monkeypatch):
+    monkeypatch.setattr(esp_io, "time", FakeTime)
+
+    # Agreeing readings stop after the minimum
+    sensor = level_sensor([700, 702, 701] + [0] * 9, mode="adaptive")
+    assert sensor.sample() == [700, 701, 702]
+    assert sensor.sensor.taken == 3
+
+    # An outlier, a timeout and a reading above the full level take more
+    sensor = level_sensor(
+        [700, 950, None, 100, 703, 701, 702] + [0] * 5, mode="adaptive"
+    )
+    assert sensor.sample() == [700, 701, 702, 703, 950]
+    assert sensor.sensor.taken == 7
+
+    # Noisy readings stop at the maximum
+    sensor = level_sensor(range(300, 1500, 100), mode="adaptive", max_samples=6)
+    assert len(sensor.sample()) == 6
+
+    tolerance = {"value": 2, "unit": "cm"}
+    sensor = level_sensor(
+        [700, 710, 720, 730] + [0] * 8, mode="adaptive", tolerance=tolerance
+    )
+    assert sensor.sample() == [700, 710, 720]
+
+    stat = level_sensor([700, 702, 701] + [0] * 9, mode="adaptive").stat()
+    assert stat[0] == {"type": "Level", "unit": "mm", "value": 999}
+    assert stat[3] == {"type": "Samples", "unit": "count", "value": 3}
+    assert stat[4] == {"type": "Spread", "unit": "mm", "value": 2}
+
+
+def test_fixed_sampling(monkeypatch):
+    monkeypatch.setattr(esp_io, "time", FakeTime)
+
+    sensor = level_sensor([700, 702, 701, 700, 705, 699, 700, 701], mode="fixed")
+    assert len(sensor.sample()) == 8
+    assert sensor.sensor.taken == 8
+
+    # Fixed is the default, adaptive sampling is opt-in
+    sensor = level_sensor([700, 702, 701, 700, 705, 699, 700, 701])
+    assert len(sensor.sample()) == 8
+    # Its measurements have the fields of earlier firmware
+    sensor = level_sensor([700, 702, 701, 700, 705, 699, 700, 701])
+    assert [m["type"] for m in sensor.stat()] == ["Level"] * 3
+
+    with pytest.raises(AttributeError):
+        level_sensor([], mode="random")
+
+
+def test_filtered_stat(monkeypatch):
+    monkeypatch.setattr(esp_io, "time", FakeTime)
+
+    # Each measurement is three agreeing readings, the fourth a stray echo
+    distances = [700, 701, 702, 1300, 703, 705]
+    readings = []
+    for d in distances:
+        readings += [d, d, d]
+    readings += [None] * 12
+    sensor = level_sensor(readings, filter="hampel", mode="adaptive")
+
+    # The stray echo is replaced by the median of the previous measurements
+    levels = [sensor.stat()[0]["value"] for d in distances]
+    assert levels == [1000, 999, 998, 999, 997, 995]
+
+    # No readings, the last filtered level is kept
+    assert sensor.stat()[0]["value"] == 995
+
+
+class CountingSensor(Sensor):
+    def __init__(self):
+        super().__init__("USLS01", "LevelSensor")
+        self.n = 0
+
+    def stat(self):
+        self.n += 1
+        return [
+            {"type": "Level", "unit": "mm", "value": self.n},
+            {"type": "Level", "unit": "%", "value": self.n * 10},
+        ]
+
+
+def data_logger(batch, interval="15m", fmt="json", publish=None):
+    sent = []
+    sender = lambda topic, message: sent.append((topic, payload.decode(message)))
+    logger = DataLogger(
+        "FB20GY",
+        (25.5, -23.5),
+        sender,
+        interval,
+        "dam/level",
+        CountingSensor(),
+        batch,
+        fmt,
+        publish,
+    )
+    return (logger, sent)
+
+
+def test_unbatched():
+    (logger, sent) = data_logger(None)
+    logger.run()
+    logger.run()
+    assert len(sent) == 2
+    assert sent[1][1]["measurement"][0] == {"type": "Level", "unit": "mm", "value": 2}
+    assert sent[1][1]["device_id"] == "FB20GY"
+
+
+def test_batch_full():
+    (logger, sent) = data_logger({"size": 3})
+    for i in range(7):
+        logger.run()
+    assert len(sent) == 2
+
+    (topic, payload) = sent[0]
+    assert topic == "dam/level"
+    assert payload["device_id"] == "FB20GY"
+    assert payload["peripheral_id"] == "USLS01"
+    assert payload["location"] == {"lon": 25.5, "lat": -23.5}
+    assert payload["fields"] == [
+        {"type": "Level", "unit": "mm"},
+        {"type": "Level", "unit": "%"},
+    ]
+    assert [m[1:] for m in payload["measurements"]] == [[1, 10], [2, 20], [3, 30]]
+    assert all(m[0] > 0 for m in payload["measurements"])
+
+    # The rest is sent on shutdown
+    logger.stop()
+    assert len(sent) == 3
+    assert [m[1:] for m in sent[2][1]["measurements"]] == [[7, 70]]
+    assert logger.batch.readings == [None] * 3
+    logger.stop()
+    assert len(sent) == 3
+
+
+def test_batch_max_age(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(esp_io, "ticks_ms", lambda: now[0])
+
+    # Sent with the fourth reading, the first is a minute old by then and
+    # would be older than max_age at the fifth
+    (logger, sent) = data_logger({"size": 10, "max_age": "1m"}, "20s")
+    for i in range(5):
+        logger.run()
+        now[0] += 20000
+    assert [len(p["measurements"]) for (t, p) in sent] == [4]
+
+
+def test_batch_fields_change():
+    batch = Batch(4, 1000)
+    batch.add(1, [{"type": "Level", "unit": "mm", "value": 1}])
+    assert batch.accepts([{"type": "Level", "unit": "mm", "value": 2}])
+    assert not batch.accepts([{"type": "Level", "unit": "cm", "value": 2}])
+    assert not batch.accepts([])
+
+    (logger, sent) = data_logger({"size": 4})
+    logger.run()
+    logger.sensor.stat = lambda: [{"type": "Level", "unit": "cm", "value": 5}]
+    logger.run()
+    assert len(sent) == 1
+    assert sent[0][1]["fields"][0]["unit"] == "mm"
+    logger.flush()
+    assert sent[1][1]["measurements"][0][1:] == [5]
+
+
+def test_binary_payload():
+    for fmt in ("cbor", "struct"):
+        (logger, sent) = data_logger(None, fmt=fmt)
+        logger.run()
+        assert [m[1:] for m in sent[0][1]["measurements"]] == [[1, 10]]
+
+        (logger, sent) = data_logger({"size": 2}, fmt=fmt)
+        for i in range(4):
+            logger.run()
+        assert sent[0][1]["peripheral_id"] == "USLS01"
+        assert sent[1][1]["fields"][1] == {"type": "Level", "unit": "%"}
+        assert [m[1:] for m in sent[1][1]["measurements"]] == [[3, 30], [4, 40]]
+
+    with pytest.raises(AttributeError):
+        data_logger(None, fmt="xml")
+
+
+def level(mm, pct=0):
+    return [
+        {"type": "Level", "unit": "mm", "value": mm},
+        {"type": "Level", "unit": "%", "value": pct},
+    ]
+
+
+def test_deadband():
+    deadband = Deadband(10, heartbeat=4)
+    levels = [800, 805, 810, 811, 801, 790, 790, 790, 790, 790, 790]
+    published = [deadband.changed(level(mm)) for mm in levels]
+    # Published on the first reading, changes of more than 10 mm from the last
+    # published level and every fourth interval without one
+    assert published == [1, 0, 0, 1, 0, 1, 0, 0, 0, 1, 0]
+    assert deadband.suppressed == 7
+    assert deadband.heartbeats == 1
+
+    deadband = Deadband({"value": 1, "unit": "cm"}, heartbeat=0)
+    published = [deadband.changed(level(mm)) for mm in [800, 810, 811] + [811] * 9]
+    assert published == [1, 0, 1] + [0] * 9
+
+    deadband = Deadband({"value": 2, "unit": "%"})
+    published = [deadband.changed(level(0, pct)) for pct in [50, 52, 53, 51]]
+    assert published == [1, 0, 1, 0]
+
+    # Config values saved by the web UI are strings
+    deadband = Deadband({"value": "0.01", "unit": "m"}, heartbeat="0")
+    published = [deadband.changed(level(mm)) for mm in [800, 810, 811, 805]]
+    assert published == [1, 0, 1, 0]
+    assert Deadband("10").deadband == 10
+
+    # A reading without the value is always published
+    deadband = Deadband({"value": 100, "unit": "liter"})
+    assert deadband.changed(level(800)) and deadband.changed(level(800))
+
+    with pytest.raises(AttributeError):
+        Deadband({"value": 1, "unit": "inch"})
+
+
+def test_report_on_change():
+    (logger, sent) = data_logger(None, publish={"deadband": 2, "heartbeat": 3})
+    for mm in [800, 801, 803, 803, 803, 803, 803]:
+        logger.sensor.stat = lambda: level(mm)
+        logger.run()
+    assert [p["measurement"][0]["value"] for (t, p) in sent] == [800, 803, 803]
+    assert logger.counters() == {
+        "readings": 7,
+        "published": 3,
+        "suppressed": 4,
+        "heartbeats": 1,
+    }
+
+    # Suppressed readings don't join the batch, but the batch is still sent
+    # before its oldest reading gets too old
+    (logger, sent) = data_logger(
+        {"size": 4, "max_age": "1h"}, publish={"deadband": 5, "heartbeat": 0}
+    )
+    for mm in [800, 810, 810, 810]:
+        logger.sensor.stat = lambda: level(mm)
+        logger.run()
+    assert sent == []
+    logger.batch.started -= 3600000
+    logger.run()
+    assert [m[1] for m in sent[0][1]["measurements"]] == [800, 810]
+    assert logger.counters()["suppressed"] == 3
+
+
+def test_logger_scheduled():
+    now = [0]
+    scheduler = Scheduler(lambda: now[0])
+    (logger, sent) = data_logger({"size": 2}, "1m")
+    logger.start(scheduler)
+    logger.start(scheduler)
+    for i in range(5):
+        now[0] += 60000
+        scheduler.run_pending()
+    assert [len(p["measurements"]) for (t, p) in sent] == [2, 2]
+
+    # The last reading is sent on stop and no more readings are taken
+    logger.stop()
+    now[0] += 60000
+    assert scheduler.run_pending() == 0
+    assert [len(p["measurements"]) for (t, p) in sent] == [2, 2, 1]
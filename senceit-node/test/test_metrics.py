@@ -0,0 +1,86 @@
+import json
+
+from metrics import Histogram, Metrics
+from uhttp import Http, HttpRequest, HttpResponse, HTTP_METHOD, Route
+
+
+def test_histogram():
+    histogram = Histogram((10, 100))
+    for value in [1, 10, 11, 100, 1000]:
+        histogram.observe(value)
+
+    assert list(histogram.counts) == [2, 2, 1]
+    assert histogram.count() == 5
+    assert histogram.sum == 1122
+    assert list(histogram.cumulative()) == [(10, 2), (100, 4), (None, 5)]
+
+
+def test_record():
+    metrics = Metrics(max_routes=2)
+    metrics.record("GET /config", 200, 1500, 20000, 512)
+    metrics.record("GET /config", 404, 800, None, 40)
+    metrics.record("static", 304, 300, None, 100)
+    # Beyond max_routes
+    metrics.record("GET /a", 200, 300, None, 1)
+    metrics.record("GET /b", 500, 300, None, 1)
+
+    assert sorted(metrics.routes) == ["GET /config", "other", "static"]
+    route = metrics.routes["GET /config"]
+    assert list(route.status) == [0, 1, 0, 1, 0]
+    assert route.bytes == 552
+    assert route.latency.count() == 2
+    assert list(metrics.routes[Metrics.OTHER].status) == [0, 1, 0, 0, 1]
+
+
+def metrics_http():
+    http = Http()
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/peripherals/{id}",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.params),
+    )
+    http.serve_metrics()
+    return http
+
+
+def body(resp):
+    # De-chunk the body of a TextStream or JsonStream response
+    (size, rest) = str(resp).split("\r\n\r\n", 1)[1].split("\r\n", 1)
+    return rest[: int(size, 16)]
+
+
+def test_http_metrics():
+    http = metrics_http()
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/peripherals/USLS01"), {}))
+    assert http.label == "GET /peripherals/{id}"
+    http.metrics.record(http.label, 200, 2000, None, 120)
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/css/style.css"), {}))
+    assert http.label == "static"
+    http.handle(HttpRequest(Route(HTTP_METHOD.PUT, "/nowhere"), {}))
+    assert http.label == Metrics.UNMATCHED
+    http.metrics.shed = 3
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/metrics"), {}))
+    resp = http.get_response()
+    assert resp.headers["Content-Type"] == Http.METRICS_TYPE
+    text = body(resp)
+    assert (
+        'senceit_http_requests_total{route="GET /peripherals/{id}",code="2xx"} 1\n'
+        in text
+    )
+    name = "senceit_http_request_duration_seconds"
+    assert name + '_bucket{route="GET /peripherals/{id}",le="0.005"} 1\n' in text
+    assert name + '_count{route="GET /peripherals/{id}"} 1\n' in text
+    assert "senceit_http_shed_total 3\n" in text
+
+    req = HttpRequest(Route(HTTP_METHOD.GET, "/metrics"), {}, {"format": "json"})
+    http.handle(req)
+    resp = http.get_response()
+    data = json.loads(body(resp))
+    route = data["routes"]["GET /peripherals/{id}"]
+    assert route["requests"] == 1
+    assert route["status"] == {"2xx": 1}
+    assert route["bytes"] == 120
+    assert data["shed"] == 3
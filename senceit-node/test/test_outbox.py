@@ -0,0 +1,192 @@
+import struct
+
+import pytest
+
+import outbox
+from outbox import Outbox, RingLog
+
+
+class Broker:
+    """
+    MQTT broker that can go down, publishing or connecting then fails like
+    umqtt.simple does on a dead socket
+    """
+
+    def __init__(self):
+        self.up = True
+        self.connected = True
+        self.received = []
+        self.connects = 0
+        # Messages received before the connection drops
+        self.limit = None
+
+    def publish(self, topic, message):
+        if self.limit is not None and len(self.received) >= self.limit:
+            self.up = False
+        if not (self.up and self.connected):
+            self.connected = False
+            raise OSError(104)
+        if isinstance(message, str):
+            message = message.encode()
+        self.received.append((topic, message))
+
+    def connect(self):
+        self.connects += 1
+        if not self.up:
+            raise OSError(113)
+        self.connected = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(outbox, "ticks_ms", lambda: now[0])
+    return now
+
+
+def message(i) -> str:
+    return '{{"measurement": {}}}'.format(i)
+
+
+def test_ring_log(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    ring = RingLog(path, record_size=64, capacity=4, sync=2).open()
+    assert len(ring) == 0
+    assert list(ring.peek(4)) == []
+
+    for i in range(3):
+        ring.append("dam/level", message(i))
+    assert [m for (s, t, m) in ring.peek(2)] == [
+        b'{"measurement": 0}',
+        b'{"measurement": 1}',
+    ]
+    ring.commit(2)
+    assert [(s, t) for (s, t, m) in ring.peek(4)] == [(2, "dam/level")]
+
+    # The oldest record is overwritten once the ring is full
+    for i in range(3, 8):
+        ring.append("dam/level", message(i))
+    assert len(ring) == 4
+    assert ring.dropped == 2
+    assert [m for (s, t, m) in ring.peek(8)] == [
+        message(i).encode() for i in range(4, 8)
+    ]
+
+    with pytest.raises(ValueError):
+        ring.append("dam/level", "x" * 64)
+
+    # Binary payloads are kept as they are
+    ring.append("dam/level", b"\x21\x87\x00\xff")
+    assert list(ring.peek(8))[-1][2] == b"\x21\x87\x00\xff"
+    ring.close()
+
+
+def test_ring_log_recovery(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    ring = RingLog(path, record_size=64, capacity=8, sync=4).open()
+    for i in range(6):
+        ring.append("dam/level", message(i))
+    ring.commit(1)
+    ring.append("dam/level", message(6))
+    # Reset without closing: the header was last written by the commit
+    ring.file.close()
+
+    ring = RingLog(path, record_size=64, capacity=8, sync=4).open()
+    assert (ring.head, ring.tail) == (1, 7)
+    assert [m for (s, t, m) in ring.peek(8)] == [
+        message(i).encode() for i in range(1, 7)
+    ]
+    ring.close()
+
+    # A log with other dimensions is started over
+    ring = RingLog(path, record_size=128, capacity=8).open()
+    assert len(ring) == 0
+    ring.close()
+
+
+def test_ring_log_wear(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    ring = RingLog(path, record_size=64, capacity=16, sync=8).open()
+    size = RingLog.HEADER_SIZE + 16 * 64
+    with open(path, "rb") as f:
+        assert len(f.read()) == size
+
+    for i in range(100):
+        ring.append("dam/level", message(i))
+    ring.close()
+
+    # The file never grows and the header is written every 8 appends
+    with open(path, "rb") as f:
+        data = f.read()
+    assert len(data) == size
+    assert struct.unpack(RingLog.HEADER, data[: RingLog.HEADER_SIZE])[3:] == (84, 100)
+    assert ring.record_writes == 100
+    assert ring.header_writes == 1 + 100 // 8 + 1
+
+
+def test_broker_outage(tmp_path, clock):
+    broker = Broker()
+    ring = RingLog(str(tmp_path / "outbox.log"), record_size=64, capacity=32).open()
+    box = Outbox(
+        broker.publish, broker.connect, ring, burst=4, interval_ms=1000, retry_ms=10000
+    )
+
+    sent = 0
+    for minute in range(60):
+        # The broker is down from minute 10 to 30
+        broker.up = not 10 <= minute < 30
+        box.send("dam/level", message(sent))
+        sent += 1
+        for i in range(60):
+            box.replay()
+            clock[0] += 1000
+
+    # Every reading arrives once and in order. The reading of minute 30 is
+    # stored too, the broker is back but not reconnected yet.
+    assert [m for (t, m) in broker.received] == [message(i).encode() for i in range(60)]
+    assert box.counters() == {
+        "sent": 39,
+        "stored": 21,
+        "replayed": 21,
+        "queued": 0,
+        "dropped": 0,
+    }
+    # One reconnect attempt every 10 seconds while the broker was down
+    assert 115 <= broker.connects <= 125
+
+
+def test_replay_rate_limit(tmp_path, clock):
+    broker = Broker()
+    broker.up = False
+    ring = RingLog(str(tmp_path / "outbox.log"), record_size=64, capacity=32).open()
+    box = Outbox(
+        broker.publish, broker.connect, ring, burst=4, interval_ms=1000, retry_ms=5000
+    )
+    for i in range(10):
+        box.send("dam/level", message(i))
+    assert box.counters()["stored"] == 10 and not box.online
+
+    broker.up = True
+    assert box.replay() == 0
+    clock[0] += 5000
+    # Reconnected and the first burst sent right away, the next only after
+    # the interval
+    assert box.replay() == 4
+    assert box.replay() == 0
+    clock[0] += 999
+    assert box.replay() == 0
+    clock[0] += 1
+    assert box.replay() == 4
+
+    # The broker drops mid-burst, the unsent record stays in the log
+    clock[0] += 1000
+    broker.limit = 9
+    assert box.replay() == 1
+    assert len(ring) == 1 and not box.online
+
+    broker.up = True
+    broker.limit = None
+    clock[0] += 5000
+    assert box.replay() == 1
+    assert [m for (t, m) in broker.received] == [message(i).encode() for i in range(10)]
+    assert ring.header_writes < 10
@@ -0,0 +1,152 @@
+import json
+
+import pytest
+
+import payload
+from payload import cbor_loads, decode, encode, readings
+
+SHARED = {
+    "device_id": "FB20GY",
+    "peripheral_id": "USLS01",
+    "type": "LevelSensor",
+    "location": {"lon": 25.5, "lat": -23.5},
+}
+FIELDS = [
+    {"type": "Level", "unit": "mm"},
+    {"type": "Level", "unit": "%"},
+    {"type": "Level", "unit": "liter"},
+]
+MEASUREMENTS = [
+    [1600000000, 800, 53, 66400],
+    [1600000900, 799, 53, None],
+    [1600001800, 0, 0, 0],
+]
+
+
+def cbor(value) -> bytes:
+    out = bytearray()
+    payload._cbor(out, value)
+    return bytes(out)
+
+
+def test_cbor_vectors():
+    # RFC 8949 appendix A
+    vectors = [
+        (0, "00"),
+        (23, "17"),
+        (24, "1818"),
+        (1000, "1903e8"),
+        (1000000, "1a000f4240"),
+        (1000000000000, "1b000000e8d4a51000"),
+        (-1, "20"),
+        (-1000, "3903e7"),
+        (1.5, "fa3fc00000"),
+        (False, "f4"),
+        (True, "f5"),
+        (None, "f6"),
+        ("", "60"),
+        ("IETF", "6449455446"),
+        ("ü", "62c3bc"),
+        ([], "80"),
+        ([1, [2, 3], [4, 5]], "8301820203820405"),
+        ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+    ]
+    for (value, expected) in vectors:
+        assert cbor(value).hex() == expected
+        assert cbor_loads(bytes.fromhex(expected)) == (value, len(expected) // 2)
+
+    # Decoded but never encoded
+    assert cbor_loads(bytes.fromhex("fb3ff199999999999a"))[0] == 1.1
+    assert cbor_loads(bytes.fromhex("4401020304"))[0] == b"\x01\x02\x03\x04"
+
+
+@pytest.mark.parametrize("fmt", payload.FORMATS)
+def test_round_trip(fmt):
+    data = encode(fmt, SHARED, FIELDS, MEASUREMENTS)
+    doc = decode(data)
+    assert doc["device_id"] == "FB20GY"
+    assert doc["peripheral_id"] == "USLS01"
+    assert doc["type"] == "LevelSensor"
+    assert doc["location"] == {"lon": 25.5, "lat": -23.5}
+    assert doc["fields"] == FIELDS
+    assert doc["measurements"] == MEASUREMENTS
+
+    assert readings(doc)[1] == {
+        "timestamp": 1600000900,
+        "measurement": [
+            {"type": "Level", "unit": "mm", "value": 799},
+            {"type": "Level", "unit": "%", "value": 53},
+            {"type": "Level", "unit": "liter", "value": None},
+        ],
+    }
+
+
+def test_schema_byte():
+    assert encode("struct", SHARED, FIELDS, MEASUREMENTS)[0] == 0x11
+    assert encode("cbor", SHARED, FIELDS, MEASUREMENTS)[0] == 0x21
+    data = encode("json", SHARED, FIELDS, MEASUREMENTS)
+    assert json.loads(data)["measurements"] == MEASUREMENTS
+    assert decode(data.encode())["fields"] == FIELDS
+
+
+def test_binary_smaller():
+    sizes = dict(
+        (fmt, len(encode(fmt, SHARED, FIELDS, MEASUREMENTS)))
+        for fmt in payload.FORMATS
+    )
+    assert sizes["struct"] < sizes["json"] // 2
+    assert sizes["cbor"] < sizes["json"] // 2
+
+    # A struct measurement takes 4 bytes a value whatever the value, CBOR
+    # takes 1 to 5 bytes
+    more = MEASUREMENTS + [[1600002700, 100000, 100, 8300000]]
+    grow = dict(
+        (fmt, len(encode(fmt, SHARED, FIELDS, more)) - sizes[fmt])
+        for fmt in payload.FORMATS
+    )
+    assert grow == {"struct": 16, "cbor": 18, "json": 36}
+
+
+def test_cbor_unknown_fields():
+    fields = [{"type": "Temperature", "unit": "C"}, {"type": "Level", "unit": "mm"}]
+    measurements = [[1600000000, 21.5, -3]]
+    doc = decode(encode("cbor", SHARED, fields, measurements))
+    assert doc["fields"] == fields
+    assert doc["measurements"] == measurements
+
+
+def test_struct_limits():
+    with pytest.raises(ValueError):
+        encode("struct", SHARED, [{"type": "Temperature", "unit": "C"}], [[1, 2]])
+    with pytest.raises(ValueError):
+        encode("struct", SHARED, FIELDS[:1], [[1, 2.5]])
+
+    # Longer text is cut to the width of its field
+    shared = dict(SHARED, type="UltrasonicLevelSensor")
+    doc = decode(encode("struct", shared, FIELDS[:1], [[1, 2]]))
+    assert doc["type"] == "UltrasonicLe"
+
+    # Location as saved by the web UI
+    shared = dict(SHARED, location={"lon": "25.5", "lat": "-23"})
+    doc = decode(encode("struct", shared, FIELDS, MEASUREMENTS))
+    assert doc["location"] == {"lon": 25.5, "lat": -23.0}
+
+
+def test_invalid_payloads():
+    data = encode("struct", SHARED, FIELDS, MEASUREMENTS)
+    with pytest.raises(ValueError):
+        decode(data[:-1])
+    with pytest.raises(ValueError):
+        decode(data[:10])
+
+    data = encode("cbor", SHARED, FIELDS, MEASUREMENTS)
+    with pytest.raises(ValueError):
+        decode(data[:-1])
+    with pytest.raises(ValueError):
+        decode(data + b"\x00")
+
+    for data in (b"", b"\x12\x00", b"\x31"):
+        with pytest.raises(ValueError):
+            decode(data)
+    with pytest.raises(ValueError):
+        encode("xml", SHARED, FIELDS, MEASUREMENTS)
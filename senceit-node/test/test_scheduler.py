@@ -0,0 +1,166 @@
+import pytest
+
+from scheduler import Scheduler, HIGH, NORMAL, LOW
+
+
+class FakeClock:
+    """
+    ticks_ms that only moves when told to, tasks can take time by advancing
+    it while they run
+    """
+
+    def __init__(self, start=0):
+        self.ticks = start
+
+    def __call__(self):
+        return self.ticks
+
+    def advance(self, ms):
+        self.ticks = (self.ticks + ms) & (2 ** 30 - 1)
+
+
+def run_until(scheduler, clock, end, step=1):
+    while scheduler.now() < end:
+        scheduler.run_pending()
+        clock.advance(step)
+
+
+def test_periodic_and_one_shot():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    scheduler.every(100, lambda: runs.append(("a", scheduler.now())), "a")
+    scheduler.every(250, lambda: runs.append(("b", scheduler.now())), "b", delay=0)
+    scheduler.after(120, lambda: runs.append(("once", scheduler.now())))
+
+    assert scheduler.next_delay() == 0
+    run_until(scheduler, clock, 501)
+    assert runs[:3] == [("b", 0), ("a", 100), ("once", 120)]
+    assert [t for (n, t) in runs if n == "a"] == [100, 200, 300, 400, 500]
+    assert [t for (n, t) in runs if n == "b"] == [0, 250, 500]
+    assert [t for (n, t) in runs if n == "once"] == [120]
+    assert sorted(scheduler.json()) == ["a", "b"]
+
+
+def test_priorities():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    scheduler.every(100, lambda: runs.append("low"), "low", LOW)
+    scheduler.every(100, lambda: runs.append("normal"), "normal", NORMAL)
+    scheduler.every(100, lambda: runs.append("high"), "high", HIGH)
+    # An earlier deadline of the same priority runs first
+    scheduler.every(100, lambda: runs.append("early"), "early", LOW, delay=50)
+
+    clock.advance(100)
+    assert scheduler.run_pending() == 4
+    assert runs == ["high", "normal", "early", "low"]
+
+
+def test_no_drift():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    starts = []
+
+    def work():
+        starts.append(scheduler.now())
+        # Runs take 30 ms and the loop polls every 7 ms
+        clock.advance(30)
+
+    task = scheduler.every(100, work, "work")
+    run_until(scheduler, clock, 10000, 7)
+
+    # Lateness never builds up, each run starts within a poll of its deadline
+    assert len(starts) == 99
+    assert all(0 <= s - 100 * (i + 1) < 7 for (i, s) in enumerate(starts))
+    assert task.max_late < 7
+    assert task.overruns == 0
+
+
+def test_overruns():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+
+    def slow():
+        runs.append(scheduler.now())
+        if len(runs) == 2:
+            clock.advance(350)
+
+    task = scheduler.every(100, slow, "slow", budget=50)
+    run_until(scheduler, clock, 1001)
+
+    # The run at 200 took 350 ms: an overrun, and the runs at 300 and 400
+    # were skipped instead of run back to back, only the run at 500 is late
+    assert runs == [100, 200, 551, 600, 700, 800, 900, 1000]
+    assert task.overruns == 2
+    assert task.skipped == 2
+    assert task.json()["skipped"] == 2
+
+
+def test_cancel_and_failures():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+
+    def fail():
+        runs.append("fail")
+        raise ValueError("sensor")
+
+    failing = scheduler.every(10, fail, "fail")
+    task = scheduler.every(10, lambda: runs.append("ok"), "ok")
+    clock.advance(10)
+    scheduler.run_pending()
+    assert runs == ["fail", "ok"]
+
+    # A task can cancel itself or others while it runs
+    scheduler.every(10, lambda: scheduler.cancel(task), "cancel", HIGH, delay=0)
+    scheduler.cancel(failing)
+    clock.advance(10)
+    scheduler.run_pending()
+    assert runs == ["fail", "ok"]
+    assert sorted(scheduler.json()) == ["cancel"]
+
+    scheduler.cancel(scheduler.tasks[0])
+    assert scheduler.next_delay() is None
+    assert scheduler.run_pending() == 0
+
+
+def test_ticks_wrap_around():
+    # ticks_ms wraps every 2**30 ms, deadlines don't
+    clock = FakeClock(2 ** 30 - 150)
+    scheduler = Scheduler(clock)
+    runs = []
+    scheduler.every(100, lambda: runs.append(scheduler.now()), "a")
+    run_until(scheduler, clock, 401)
+    assert runs == [100, 200, 300, 400]
+
+    # Scheduler time is rebased long before it leaves the small ints, the
+    # deadlines move with it
+    scheduler = Scheduler(clock)
+    scheduler.time = Scheduler.REBASE - 50
+    task = scheduler.every(100, lambda: runs.append(scheduler.now()), "b")
+    clock.advance(60)
+    assert scheduler.run_pending() == 0
+    assert (scheduler.time, task.deadline) == (0, 40)
+    clock.advance(40)
+    assert scheduler.run_pending() == 1
+    assert runs[-1] == 40
+
+
+def test_run_forever():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    sleeps = []
+
+    def sleep_ms(ms):
+        sleeps.append(ms)
+        clock.advance(ms)
+        if len(sleeps) == 5:
+            raise KeyboardInterrupt
+
+    scheduler.every(300, lambda: None, "a")
+    scheduler.every(3000, lambda: None, "b", delay=1000)
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.run_forever(sleep_ms)
+    assert sleeps == [300, 300, 300, 100, 200]
@@ -0,0 +1,160 @@
+import sys
+from unittest.mock import Mock
+
+import json
+
+import pytest
+
+sys.modules["machine"] = Mock()
+
+import esp_io
+import ultrasonic
+from ultrasonic import HCSR04Irq
+from scheduler import Scheduler
+
+from test.sim_pin import SimClock, SimPin, SimHCSR04, SimMachine, SimScheduler
+
+
+@pytest.fixture
+def sim(monkeypatch):
+    # Starts just before the ticks wrap around
+    clock = SimClock((1 << 30) - 3000)
+    machine = SimMachine(clock)
+    scheduler = SimScheduler()
+    monkeypatch.setattr(ultrasonic, "Pin", SimPin)
+    monkeypatch.setattr(ultrasonic, "time", clock)
+    monkeypatch.setattr(ultrasonic, "ticks_us", clock.ticks_us)
+    monkeypatch.setattr(ultrasonic, "machine", machine)
+    monkeypatch.setattr(ultrasonic, "micropython", scheduler)
+    return (clock, machine, scheduler)
+
+
+def create(sim, distance, callback=None):
+    driver = HCSR04Irq(4, 5, callback)
+    hcsr04 = SimHCSR04(sim[0], driver.trigger, driver.echo, distance)
+    return (driver, hcsr04)
+
+
+def test_irq_callback(sim):
+    (clock, machine, scheduler) = sim
+    results = []
+    (driver, hcsr04) = create(sim, 1000, results.append)
+
+    assert driver.start()
+    assert not driver.start()
+    assert hcsr04.pulses == 1
+
+    # Nothing happens until the echo arrives
+    clock.advance(1000)
+    assert driver.state == HCSR04Irq.ECHO
+    clock.advance(10000)
+    assert driver.state == HCSR04Irq.DONE
+    assert results == []
+
+    # The result is handed over outside the interrupt
+    scheduler.run()
+    assert results == [1000]
+    assert driver.state == HCSR04Irq.IDLE
+    driver.poll()
+    assert results == [1000]
+
+    # Without room in the scheduler queue poll delivers the result
+    scheduler.size = 0
+    hcsr04.distance = 250
+    driver.start()
+    clock.advance(5000)
+    driver.poll()
+    assert results == [1000, 250]
+
+
+def test_irq_timeout(sim):
+    (clock, machine, scheduler) = sim
+    results = []
+    (driver, hcsr04) = create(sim, None, results.append)
+
+    driver.start()
+    clock.advance(10000)
+    driver.poll()
+    assert results == []
+    clock.advance(driver.echo_timeout_us)
+    driver.poll()
+    assert results == [None]
+    assert driver.start()
+
+
+def test_irq_distance_mm(sim):
+    (clock, machine, scheduler) = sim
+    (driver, hcsr04) = create(sim, 1200)
+
+    # The CPU idles while the sound is in flight
+    assert driver.distance_mm() == 1200
+    assert machine.idles > 100
+
+    hcsr04.distance = None
+    with pytest.raises(OSError):
+        driver.distance_mm()
+    assert not driver.busy()
+
+
+def test_level_sensor_irq_driver(sim, monkeypatch):
+    (clock, machine, scheduler) = sim
+    monkeypatch.setattr(esp_io, "time", clock)
+    parameters = {
+        "dam_height": {"value": 1500, "unit": "mm"},
+        "sensor_height": {"value": 1700, "unit": "mm"},
+        "sampling": {"mode": "adaptive"},
+        "driver": "irq",
+    }
+    sensor = esp_io.LevelSensor("USLS01", {"trigger_pin": 4, "echo_pin": 5}, parameters)
+    assert isinstance(sensor.sensor, HCSR04Irq)
+    SimHCSR04(clock, sensor.sensor.trigger, sensor.sensor.echo, 900)
+
+    stat = sensor.stat()
+    assert stat[0] == {"type": "Level", "unit": "mm", "value": 800}
+    assert stat[3]["value"] == 3
+
+
+def test_logger_nonblocking(sim):
+    (clock, machine, scheduler) = sim
+    parameters = {
+        "dam_height": {"value": 1500, "unit": "mm"},
+        "sensor_height": {"value": 1700, "unit": "mm"},
+        "sampling": {"mode": "fixed", "samples": 4},
+        "driver": "irq",
+    }
+    sensor = esp_io.LevelSensor("USLS01", {"trigger_pin": 4, "echo_pin": 5}, parameters)
+    hcsr04 = SimHCSR04(clock, sensor.sensor.trigger, sensor.sensor.echo, 900)
+    sent = []
+    logger = esp_io.DataLogger(
+        "FB20GY", (25.5, -23.5), lambda t, m: sent.append(m), "1s", "dam", sensor
+    )
+    tasks = Scheduler(lambda: clock.now // 1000)
+    ticks = []
+    tasks.every(1, lambda: ticks.append(clock.now), "led")
+    logger.start(tasks)
+
+    # The other task keeps running every ms while the echoes are in flight
+    for i in range(1100):
+        clock.advance(1000)
+        scheduler.run()
+        tasks.run_pending()
+    assert len(sent) == 1
+    assert json.loads(sent[0])["measurement"][0]["value"] == 800
+    assert hcsr04.pulses == 4
+    assert machine.idles == 0
+    # Only the 15 us trigger pulse holds them up
+    gaps = [b - a for (a, b) in zip(ticks, ticks[1:])]
+    assert max(gaps) <= 1015
+
+    # Readings without an echo time out
+    hcsr04.distance = None
+    for i in range(1100):
+        clock.advance(1000)
+        scheduler.run()
+        tasks.run_pending()
+    assert len(sent) == 2
+    # Without readings the distance is 0
+    assert json.loads(sent[1])["measurement"][0]["value"] == 1500
+
+    logger.stop()
+    assert logger.poller is None
@@ -1,4 +1,4 @@
-from util import Logger, StringBuilder
+from util import Logger, StringBuilder, ticks_us, ticks_diff, ticks_add
 
 
 def test_string_builder():
@@ -22,3 +22,13 @@ def test_logger_singleton():
     log1.warn("This is a warning")
     log1.info("This is some info")
     log1.severe("This is severe")
+
+
+def test_ticks_wrap_around():
+    period = 1 << 30
+    assert 0 <= ticks_us() < period
+    assert ticks_diff(10, period - 10) == 20
+    assert ticks_diff(period - 10, 10) == -20
+    assert ticks_diff(500, 200) == 300
+    assert ticks_add(period - 10, 30) == 20
+    assert ticks_diff(ticks_add(10, -30), 10) == -30
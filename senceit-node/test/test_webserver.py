@@ -6,52 +6,58 @@ from uhttp import (
     HttpRequest,
     HTTP_METHOD,
     HttpResponse,
+    HttpError,
     File,
+    Manifest,
 )
 
+import gzip
+import hashlib
 import os
 import json
+import shutil
+import sys
+
+import pytest
+
+
+def is_static(http, method, path):
+    """
+    Whether the router serves the path from the file system
+    """
+    (handler, _) = http.router.match(Route(method, path))
+    return handler == http._static
 
 
 def test_http_static_routes():
     http = Http()
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/")
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/index.html"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/index.html")
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/css/styles.css"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/css/styles.css")
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/js/scripts.js"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/js/scripts.js")
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/favicon.ico"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/favicon.ico")
 
-    req = HttpRequest(Route(HTTP_METHOD.GET, "/img/image.png"), [])
-    assert http._match_static_route(req)
+    assert is_static(http, HTTP_METHOD.GET, "/img/image.png")
 
-    req = HttpRequest(Route(HTTP_METHOD.POST, "/img/image.png"), [])
-    assert not http._match_static_route(req)
+    assert not is_static(http, HTTP_METHOD.POST, "/img/image.png")
 
 
 def test_http_handlers():
 
     http = Http()
-    http.register_handler(
-        HTTP_METHOD.POST,
-        "/config",
-        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"]),
-    )
+    handler = lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"])
+    http.register_handler(HTTP_METHOD.POST, "/config", handler)
 
     assert len(http.handlers.items()) == 1
 
     req = HttpRequest(Route(HTTP_METHOD.POST, "/config"), {})
-    assert http._match_route(req).method == HTTP_METHOD.POST
-    assert http._match_route(req).path == "/config"
+    assert http.router.match(req.route) == (handler, None)
+    assert http.router.match(Route(HTTP_METHOD.GET, "/config"))[0] != handler
 
     http.handle(req)
 
@@ -138,3 +144,339 @@ def test_error_resp():
 
     assert resp.has_stream() is False
     assert resp.body is not None
+
+
+def test_router_path_parameters():
+    http = Http()
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/peripherals/{id}",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.params),
+    )
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/peripherals/{id}/readings/{n}",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.params),
+    )
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/peripherals/all",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body={"all": True}),
+    )
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/peripherals/USLS01"), {}))
+    assert http.get_response().body == {"id": "USLS01"}
+
+    http.handle(
+        HttpRequest(Route(HTTP_METHOD.GET, "/peripherals/USLS01/readings/3"), {})
+    )
+    assert http.get_response().body == {"id": "USLS01", "n": "3"}
+
+    # Literal segments win over parameters
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/peripherals/all"), {}))
+    assert http.get_response().body == {"all": True}
+
+    # Parameters never match an empty segment or another method
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/peripherals/"), {}))
+    assert http.get_response().status == 400
+    http.handle(HttpRequest(Route(HTTP_METHOD.DELETE, "/peripherals/USLS01"), {}))
+    assert http.get_response().status == 400
+
+
+def test_router_mounts():
+    http = Http()
+    http.mount("/docs")
+    http.mount("/robots.txt", prefix=False)
+
+    assert is_static(http, HTTP_METHOD.GET, "/docs/a/b.html")
+    assert is_static(http, HTTP_METHOD.GET, "/robots.txt")
+    assert not is_static(http, HTTP_METHOD.GET, "/robots.txt/x")
+    assert not is_static(http, HTTP_METHOD.GET, "/cssx")
+
+    # A registered route takes precedence over a mount
+    http.register_handler(
+        HTTP_METHOD.GET,
+        "/docs/{page}",
+        lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.params),
+    )
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/docs/intro"), {}))
+    assert http.get_response().body == {"page": "intro"}
+    assert is_static(http, HTTP_METHOD.GET, "/docs/a/b.html")
+
+
+def test_handler_http_error():
+    def handler(req):
+        raise HttpError("No wifi credentials specified", 400)
+
+    http = Http()
+    http.register_handler(HTTP_METHOD.POST, "/config", handler)
+    http.handle(HttpRequest(Route(HTTP_METHOD.POST, "/config"), {}))
+
+    assert http.get_response().status == 400
+    assert http.get_response().body == {"error": "No wifi credentials specified"}
+
+
+def create_manifest(root):
+    sys.path.append(os.path.join(os.getcwd(), "tools"))
+    import build_manifest
+
+    with open(os.path.join(root, Manifest.FILE), "w") as f:
+        json.dump(build_manifest.build(root), f)
+
+
+def test_static_manifest(tmp_path):
+    root = str(tmp_path / "www")
+    shutil.copytree(os.path.join(os.getcwd(), "www"), root)
+    with open(os.path.join(root, "js", "scripts.js"), "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    fingerprinted = "/js/scripts.{}.js".format(digest[:8])
+    shutil.copy(os.path.join(root, "js", "scripts.js"), root + fingerprinted)
+    create_manifest(root)
+
+    http = Http()
+    http.set_www_root(root)
+    http.load_manifest()
+    assert http.manifest.get("/" + Manifest.FILE) is None
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/"), {}))
+    resp = http.get_response()
+    assert resp.status == 200
+    assert resp.headers["Content-Type"] == Http.MIME_TYPE["HTML"]
+    assert resp.headers["Content-Length"] == 4098
+    assert resp.headers["Cache-Control"] == Http.CACHE_REVALIDATE
+    assert "Content-Encoding" not in resp.headers
+    etag = resp.headers["ETag"]
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, fingerprinted), {}))
+    resp = http.get_response()
+    assert resp.status == 200
+    assert resp.headers["Cache-Control"] == Http.CACHE_IMMUTABLE
+
+    # A cached copy is revalidated without touching the file system
+    os.remove(os.path.join(root, "index.html"))
+    req = HttpRequest(Route(HTTP_METHOD.GET, "/index.html"), {"If-None-Match": etag})
+    http.handle(req)
+    resp = http.get_response()
+    assert resp.status == 304
+    assert resp.headers["ETag"] == etag
+    assert "Content-Length" not in resp.headers
+    assert str(resp).startswith("HTTP/1.1 304 Not Modified\r\n")
+
+    req = HttpRequest(
+        Route(HTTP_METHOD.GET, "/img/silogo42x136.png"), {"If-None-Match": etag}
+    )
+    http.handle(req)
+    assert http.get_response().status == 200
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/css/missing.css"), {}))
+    assert http.get_response().status == 404
+
+
+def test_manifest_gzip_encoding(tmp_path):
+    root = str(tmp_path)
+    os.mkdir(os.path.join(root, "js"))
+    with gzip.open(os.path.join(root, "js", "scripts.min.js"), "wb") as f:
+        f.write(b"var config = {};")
+    create_manifest(root)
+
+    http = Http()
+    http.set_www_root(root)
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/js/scripts.min.js"), {}))
+    resp = http.get_response()
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Content-Type"] == Http.MIME_TYPE["JS"]
+
+
+def test_accept_encoding():
+    def accepts(value):
+        return Http.accepts_gzip(HttpRequest(Route(HTTP_METHOD.GET, "/"), value))
+
+    assert accepts({"Accept-Encoding": "gzip, deflate, br"})
+    assert accepts({"Accept-Encoding": "br;q=1.0, GZIP;q=0.5"})
+    assert accepts({"Accept-Encoding": "*"})
+    assert accepts({"Accept-Encoding": "*;q=0, gzip"})
+    assert not accepts({"Accept-Encoding": "gzip;q=0"})
+    assert not accepts({"Accept-Encoding": "gzip;q=0, *"})
+    assert not accepts({"Accept-Encoding": "deflate, br"})
+    assert not accepts({"Accept-Encoding": "identity"})
+    assert not accepts({})
+
+
+def create_gzip_variants(root):
+    for path in ["index.html", os.path.join("js", "scripts.js")]:
+        path = os.path.join(root, path)
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dest:
+            dest.write(src.read())
+
+
+def test_manifest_gzip_variant(tmp_path):
+    root = str(tmp_path / "www")
+    shutil.copytree(os.path.join(os.getcwd(), "www"), root)
+    create_gzip_variants(root)
+    create_manifest(root)
+
+    http = Http()
+    http.set_www_root(root)
+    http.load_manifest()
+    assert http.manifest.get("/js/scripts.js.gz") is None
+    gz_size = os.path.getsize(os.path.join(root, "js", "scripts.js.gz"))
+
+    http.handle(
+        HttpRequest(
+            Route(HTTP_METHOD.GET, "/js/scripts.js"), {"Accept-Encoding": "gzip"}
+        )
+    )
+    resp = http.get_response()
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    assert resp.headers["Content-Length"] == gz_size
+    assert resp.body.src.endswith("scripts.js.gz")
+    gz_etag = resp.headers["ETag"]
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/js/scripts.js"), {}))
+    resp = http.get_response()
+    assert "Content-Encoding" not in resp.headers
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    assert resp.body.src.endswith("scripts.js")
+    assert resp.headers["ETag"] != gz_etag
+
+    # Each variant revalidates against its own ETag
+    req = HttpRequest(
+        Route(HTTP_METHOD.GET, "/js/scripts.js"),
+        {"Accept-Encoding": "gzip", "If-None-Match": gz_etag},
+    )
+    http.handle(req)
+    resp = http.get_response()
+    assert resp.status == 304
+    assert resp.headers["Vary"] == "Accept-Encoding"
+
+    # Files without a variant are unaffected
+    http.handle(
+        HttpRequest(
+            Route(HTTP_METHOD.GET, "/css/style.css"), {"Accept-Encoding": "gzip"}
+        )
+    )
+    resp = http.get_response()
+    assert "Content-Encoding" not in resp.headers
+    assert "Vary" not in resp.headers
+
+
+def test_static_fs_gzip_variant(tmp_path):
+    root = str(tmp_path / "www")
+    shutil.copytree(os.path.join(os.getcwd(), "www"), root)
+    create_gzip_variants(root)
+
+    http = Http()
+    http.set_www_root(root)
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/"), {"Accept-Encoding": "gzip"}))
+    resp = http.get_response()
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.body.src.endswith("index.html.gz")
+
+    # Uncompressed files are no longer assumed to be gzip
+    http.handle(
+        HttpRequest(
+            Route(HTTP_METHOD.GET, "/css/style.css"), {"Accept-Encoding": "gzip"}
+        )
+    )
+    resp = http.get_response()
+    assert "Content-Encoding" not in resp.headers
+
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, "/js/scripts.js"), {}))
+    resp = http.get_response()
+    assert "Content-Encoding" not in resp.headers
+    assert resp.body.src.endswith("scripts.js")
+
+
+def test_byte_range():
+    def byte_range(value, size=100, etag='"abc"', if_range=None):
+        header = {"Range": value}
+        if if_range:
+            header["If-Range"] = if_range
+        req = HttpRequest(Route(HTTP_METHOD.GET, "/"), header)
+        return Http.byte_range(req, size, etag)
+
+    assert byte_range("bytes=0-9") == (0, 9)
+    assert byte_range("bytes=90-") == (90, 99)
+    assert byte_range("bytes=90-200") == (90, 99)
+    assert byte_range("bytes=-10") == (90, 99)
+    assert byte_range("bytes=-200") == (0, 99)
+
+    # Invalid ranges are ignored
+    assert byte_range("bytes=9-0") is None
+    assert byte_range("bytes=x-9") is None
+    assert byte_range("bytes=-") is None
+    assert byte_range("bytes=10") is None
+    assert byte_range("items=0-9") is None
+
+    # Only resumed from the same version of the file
+    assert byte_range("bytes=10-", if_range='"abc"') == (10, 99)
+    assert byte_range("bytes=10-", if_range='"def"') is None
+    assert byte_range("bytes=10-", etag=None, if_range='"abc"') is None
+
+    for value in ["bytes=100-", "bytes=-0", "bytes=0-4,10-14"]:
+        with pytest.raises(ValueError):
+            byte_range(value)
+    with pytest.raises(ValueError):
+        byte_range("bytes=-10", size=0)
+
+
+class Sink:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, buf):
+        self.data += buf
+        return len(buf)
+
+
+def get_range(http, path, header):
+    http.handle(HttpRequest(Route(HTTP_METHOD.GET, path), header))
+    resp = http.get_response()
+    sink = Sink()
+    resp.write(sink)
+    return (resp, bytes(sink.data).split(b"\r\n\r\n", 1)[1])
+
+
+def test_static_range(tmp_path):
+    root = str(tmp_path / "www")
+    shutil.copytree(os.path.join(os.getcwd(), "www"), root)
+    create_manifest(root)
+    path = "/js/scripts.js"
+    with open(root + path, "rb") as f:
+        content = f.read()
+
+    http = Http()
+    http.set_www_root(root)
+    (resp, body) = get_range(http, path, {})
+    assert resp.status == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    etag = resp.headers["ETag"]
+
+    # Resume an interrupted download, the range is larger than the buffer
+    (resp, body) = get_range(http, path, {"Range": "bytes=1000-", "If-Range": etag})
+    assert resp.status == 206
+    assert resp.headers["Content-Range"] == "bytes 1000-{}/{}".format(
+        len(content) - 1, len(content)
+    )
+    assert resp.headers["Content-Length"] == len(content) - 1000
+    assert body == content[1000:]
+
+    # The file changed since the partial copy was downloaded
+    (resp, body) = get_range(http, path, {"Range": "bytes=1000-", "If-Range": '"x"'})
+    assert resp.status == 200
+    assert body == content
+
+    (resp, body) = get_range(http, path, {"Range": "bytes=0-1,5-6"})
+    assert resp.status == 416
+    assert resp.headers["Content-Range"] == "bytes */{}".format(len(content))
+
+    # Without a manifest there is no ETag to validate If-Range against
+    os.remove(os.path.join(root, Manifest.FILE))
+    http = Http()
+    http.set_www_root(root)
+    (resp, body) = get_range(http, path, {"Range": "bytes=5-9"})
+    assert resp.status == 206
+    assert body == content[5:10]
+    (resp, body) = get_range(http, path, {"Range": "bytes=5-9", "If-Range": etag})
+    assert resp.status == 200
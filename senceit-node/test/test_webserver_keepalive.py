@@ -0,0 +1,290 @@
+import json
+import socket
+import threading
+import time
+
+import webserver
+from uhttp import Http, HTTP_METHOD, HttpResponse, EventStream, JsonStream
+from metrics import Metrics
+from webserver import Webserver
+
+from test.micro_socket import micro_webserver
+
+
+class Server:
+    def __init__(self, run=True, **kwargs):
+        http = Http()
+        http.register_handler(
+            HTTP_METHOD.GET,
+            "/echo/{n}",
+            lambda req: HttpResponse.ok(200, Http.MIME_TYPE["JSON"], body=req.params),
+        )
+        self.web = micro_webserver(Webserver(http, **kwargs))
+        self.web.start(0, "127.0.0.1")
+        self.port = self.web.server.getsockname()[1]
+        self.running = run
+        self.thread = threading.Thread(target=self.run)
+        if run:
+            self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.web.handle_client(10)
+        self.web.close()
+
+    def stop(self):
+        if not self.running:
+            self.web.close()
+            return
+        self.running = False
+        self.thread.join()
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.settimeout(2)
+        return sock
+
+
+def request(n, connection=None, version="HTTP/1.1"):
+    req = "GET /echo/{} {}\r\nHost: 192.168.4.1\r\n".format(n, version)
+    if connection:
+        req += "Connection: {}\r\n".format(connection)
+    return (req + "\r\n").encode()
+
+
+def read_response(stream):
+    status = stream.readline()
+    if not status:
+        return None
+    headers = {}
+    line = stream.readline()
+    while line != b"\r\n":
+        (k, v) = str(line, "utf-8").split(":", 1)
+        headers[k] = v.strip()
+        line = stream.readline()
+    body = stream.read(int(headers["Content-Length"]))
+    return (status, headers, json.loads(body))
+
+
+def test_keep_alive():
+    server = Server()
+    try:
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        for n in range(3):
+            sock.sendall(request(n))
+            (status, headers, body) = read_response(stream)
+            assert status == b"HTTP/1.1 200 OK\r\n"
+            assert headers["Connection"] == "keep-alive"
+            assert body == {"n": str(n)}
+        assert len(server.web.clients) == 1
+        sock.close()
+    finally:
+        server.stop()
+
+    # Recorded after each response was sent
+    route = server.web.metrics.routes["GET /echo/{n}"]
+    assert list(route.status) == [0, 3, 0, 0, 0]
+    assert route.latency.count() == 3
+    assert route.bytes > 0
+
+
+def test_pipelined_requests():
+    server = Server()
+    try:
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(b"".join([request(n) for n in range(5)]))
+        for n in range(5):
+            (status, headers, body) = read_response(stream)
+            assert body == {"n": str(n)}
+        sock.close()
+    finally:
+        server.stop()
+
+
+def test_connection_close():
+    server = Server(max_requests=2)
+    try:
+        # Request cap
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(request(1) + request(2) + request(3))
+        assert read_response(stream)[1]["Connection"] == "keep-alive"
+        assert read_response(stream)[1]["Connection"] == "close"
+        assert read_response(stream) is None
+
+        # Client asks to close
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(request(1, "close"))
+        assert read_response(stream)[1]["Connection"] == "close"
+        assert read_response(stream) is None
+
+        # HTTP/1.0 is only persistent on request
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(request(1, version="HTTP/1.0"))
+        assert read_response(stream)[1]["Connection"] == "close"
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(request(1, "keep-alive", "HTTP/1.0"))
+        assert read_response(stream)[1]["Connection"] == "keep-alive"
+    finally:
+        server.stop()
+
+
+def test_idle_timeout():
+    server = Server(keep_alive_timeout=100)
+    try:
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(request(1))
+        assert read_response(stream)[1]["Connection"] == "keep-alive"
+        time.sleep(0.3)
+        assert read_response(stream) is None
+        assert len(server.web.clients) == 0
+    finally:
+        server.stop()
+
+
+def test_load_shedding(monkeypatch):
+    # Driven from the test thread, so each request is sent before it is polled
+    server = Server(run=False, max_clients=1)
+    web = server.web
+    try:
+        sock1 = server.connect()
+        stream1 = sock1.makefile("rb")
+        sock1.sendall(request(1))
+        web.handle_client(1000)
+        assert read_response(stream1)[0] == b"HTTP/1.1 200 OK\r\n"
+
+        # Over the connection limit
+        sock2 = server.connect()
+        sock2.sendall(request(2))
+        web.handle_client(1000)
+        resp = sock2.makefile("rb").read()
+        assert resp.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert b"Retry-After: 1\r\n" in resp
+        assert b"Connection: close\r\n" in resp
+        assert web.shed == 1
+        assert len(web.clients) == 1
+
+        # Below the heap watermark, also on a kept alive connection
+        monkeypatch.setattr(webserver, "mem_free", lambda: web.min_free - 1)
+        sock1.sendall(request(3))
+        web.handle_client(1000)
+        assert stream1.read().startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert web.shed == 2
+        assert len(web.clients) == 0
+
+        monkeypatch.setattr(webserver, "mem_free", lambda: web.min_free)
+        sock3 = server.connect()
+        stream3 = sock3.makefile("rb")
+        sock3.sendall(request(4))
+        web.handle_client(1000)
+        assert read_response(stream3)[2] == {"n": "4"}
+        assert web.shed == 2
+    finally:
+        server.stop()
+
+
+def test_event_stream():
+    server = Server(run=False)
+    web = server.web
+    events = EventStream()
+    web.http_handler.serve_events("/events", events)
+    try:
+        sock = server.connect()
+        stream = sock.makefile("rb")
+        sock.sendall(b"GET /events HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n")
+        web.handle_client(1000)
+        assert stream.readline() == b"HTTP/1.1 200 OK\r\n"
+        line = stream.readline()
+        while line != b"\r\n":
+            assert not line.startswith(b"Content-Length")
+            line = stream.readline()
+        assert stream.readline() == b"retry: 3000\n"
+        assert stream.readline() == b"\n"
+        assert len(web.streams) == 1 and len(web.clients) == 0
+
+        # Events are sent from the server loop
+        events.publish('{"level": 42}', "1")
+        web.handle_client(10)
+        assert stream.readline() == b"event: 1\n"
+        assert stream.readline() == b'data: {"level": 42}\n'
+        assert stream.readline() == b"\n"
+
+        # Subscribers count against the connection limit
+        other = server.connect()
+        other.sendall(request(1))
+        web.handle_client(1000)
+        assert read_response(other.makefile("rb"))[2] == {"n": "1"}
+        other.close()
+
+        stream.close()
+        sock.close()
+        web.handle_client(1000)
+        assert len(web.streams) == 0
+        assert not events.subscribers
+    finally:
+        server.stop()
+
+
+def failing_records():
+    yield {"value": 1}
+    raise ValueError("Sensor log corrupt")
+
+
+def test_stream_fails():
+    server = Server(run=False)
+    web = server.web
+    web.http_handler.register_handler(
+        HTTP_METHOD.GET,
+        "/history",
+        lambda req: HttpResponse.ok(
+            200, Http.MIME_TYPE["JSON"], body=JsonStream(failing_records())
+        ),
+    )
+    try:
+        # The response is cut off and only its connection is closed
+        sock = server.connect()
+        sock.sendall(b"GET /history HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n")
+        web.handle_client(1000)
+        assert not sock.makefile("rb").read().endswith(b"0\r\n\r\n")
+        assert len(web.clients) == 0
+        route = web.metrics.routes["GET /history"]
+        assert route.status[4] == 1
+
+        sock = server.connect()
+        sock.sendall(request(1))
+        web.handle_client(1000)
+        assert read_response(sock.makefile("rb"))[2] == {"n": "1"}
+    finally:
+        server.stop()
+
+
+def test_error_send_fails():
+    server = Server(run=False)
+    web = server.web
+    send = web.send
+
+    def reset(resp):
+        raise OSError(104, "ECONNRESET")
+
+    try:
+        # The client is gone before its 400 is sent, the server carries on
+        sock = server.connect()
+        sock.sendall(b"GET\r\n\r\n")
+        web.send = reset
+        web.handle_client(1000)
+        assert len(web.clients) == 0
+        assert web.metrics.routes[Metrics.INVALID].status[3] == 1
+
+        web.send = send
+        sock = server.connect()
+        sock.sendall(request(1))
+        web.handle_client(1000)
+        assert read_response(sock.makefile("rb"))[2] == {"n": "1"}
+    finally:
+        server.stop()
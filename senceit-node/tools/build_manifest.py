@@ -0,0 +1,95 @@
+##
+#
+# Generates the static asset manifest served by uhttp.Http
+#
+# Copyright 2020 - Intersect Technologies CC
+# Author: Niel Swart <niel@nielswart.com>
+#
+# Usage: poetry run python tools/build_manifest.py build/www
+#
+# Every file below the www root gets an entry keyed by its URL path:
+#
+#   "/js/scripts.min.js": [size, mime type, content encoding, etag, immutable, gzip]
+#
+# Files with their content hash in the name, e.g. scripts.3f2a9c1d.min.js,
+# are fingerprinted and may be cached forever by the browser.
+#
+# A pre-compressed variant next to a file, e.g. scripts.min.js.gz, is not
+# listed on its own but as the gzip field of the original: [size, etag].
+##
+
+import hashlib
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from uhttp import File, Manifest
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_fingerprinted(name, digest):
+    for part in name.split(".")[1:-1]:
+        if len(part) >= 8 and digest.startswith(part.lower()):
+            return True
+    return False
+
+
+def read(root, path):
+    with open(os.path.join(root, path.lstrip("/")), "rb") as f:
+        content = f.read()
+    return (content, hashlib.sha1(content).hexdigest())
+
+
+def describe(root, path, variant=None):
+    (content, digest) = read(root, path)
+    encoding = "gzip" if content.startswith(GZIP_MAGIC) else None
+
+    gz = None
+    if variant:
+        (gz_content, gz_digest) = read(root, variant)
+        gz = [len(gz_content), '"{}"'.format(gz_digest[:16])]
+
+    return [
+        len(content),
+        File(root).resolve_type(path),
+        encoding,
+        '"{}"'.format(digest[:16]),
+        1 if is_fingerprinted(os.path.basename(path), digest) else 0,
+        gz,
+    ]
+
+
+def build(root) -> dict:
+    paths = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = "/" + os.path.relpath(os.path.join(dirpath, name), root)
+            path = path.replace(os.sep, "/")
+            if path != "/" + Manifest.FILE:
+                paths.append(path)
+
+    entries = {}
+    for path in paths:
+        if path.endswith(".gz") and path[:-3] in paths:
+            # Served in place of the original
+            continue
+        variant = path + ".gz"
+        entries[path] = describe(root, path, variant if variant in paths else None)
+    return entries
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "build", "www")
+    entries = build(root)
+    with open(os.path.join(root, Manifest.FILE), "w") as f:
+        json.dump(entries, f, separators=(",", ":"))
+    print("Wrote {} entries to {}".format(len(entries), Manifest.FILE))
+
+
+if __name__ == "__main__":
+    main()